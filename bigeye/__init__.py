@@ -1,10 +1,15 @@
-from time import sleep
+from time import sleep, time
 from json import dumps
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
 from .config import Config, LogHandler, CLIArgsParser
+from .instrumentation import PerfRecorder
+from .profiling import Profiler
 from .awsldaClient import LambdaClient, Zipper
 from .tests import TestManager, QualityTest, ConsistencyTest
 from .fetchers import FetcherManager
-from .publishers import PublisherManager
+from .publishers import PublisherManager, OpenMetricsPublisher
+from .workqueue import WorkQueue
 
 
 class BigEye:
@@ -12,7 +17,7 @@ class BigEye:
 
         :param env: environment either 'dev' or 'prop', if run locally choose dev
         :type env: string
-        :param role: role assumed by this instance, choose between 'master' to run all tests, 'slave' to run a portion or debug or 'updateBoards'
+        :param role: role assumed by this instance, choose between 'master' to run all tests, 'slave' to run a portion or debug, 'updateBoards' or 'preflight'
         :type role: string
         :param configPath: relative path to config file formatted as required in the read me
         :type configPath: string
@@ -27,101 +32,321 @@ class BigEye:
         self.role = role
         self.testsPath = testsPath
         self.params = extraParameters
+        configStart = time()
         self.config = Config(configPath, self.env, self.role)
-        self.logger = LogHandler.createLogHandler(self.env)
-        self.testManager = TestManager(self.config, self.logger)
+        self.logger = LogHandler.createTraceLogger(
+            LogHandler.createLogHandler(self.env))
+        self.setTraceContext()
+        self.perf = PerfRecorder(self.logger)
+        self.perf.record('config_load', time() - configStart)
+        self.testManager = TestManager(self.config, self.logger, self.perf)
         if self.role in ['slave', 'updater'] or self.env == 'dev':
-            self.publisherManager = PublisherManager(self.config, self.logger)
-        if self.role == 'slave' or self.env == 'dev':
-            self.fetcherManager = FetcherManager(self.config, self.logger)
+            self.publisherManager = PublisherManager(
+                self.config, self.logger, self.perf)
+        if self.role in ['slave', 'preflight'] or self.env == 'dev':
+            self.fetcherManager = FetcherManager(
+                self.config, self.logger, self.perf)
+        if self.config.run.dispatchMode == 'queue' and self.role in ['master', 'slave']:
+            self.workQueue = WorkQueue.fromConfig(self.config.getValue('WorkQueue'))
+
+    def setTraceContext(self):
+        """Sets the run and batch ids attached to the log lines from the extra parameters,
+        a new run id is generated when the instance is the root of a run
+        """
+
+        self.runId = self.params.get('runId') or uuid4().hex[:12]
+        self.logger.extra['runId'] = self.runId
+        self.logger.extra['batchId'] = self.params.get('batchId')
 
     def executeResponsabilites(self):
+        """Executes tasks based on the instance role, profiled with cProfile and tracemalloc if the profile extra parameter is set"""
+
+        if self.params.get('profile', False):
+            outputDir = self.params.get('profileDir') or self.config.run.profileDir
+            with Profiler(outputDir, self.role, self.logger):
+                self.executeRoleTasks()
+        else:
+            self.executeRoleTasks()
+
+    def executeRoleTasks(self):
         """Executes tasks based on the instance role"""
 
-        if self.role == 'master':
-            self.dispatchWork(self.params.get('startIndex', 0))
+        if self.role == 'master' and self.config.run.dispatchMode == 'queue':
+            self.enqueueWork()
+        elif self.role == 'master' and self.config.run.dispatchMode == 'partitioned' and 'endIndex' not in self.params:
+            self.dispatchPartitions()
+        elif self.role == 'master':
+            self.dispatchWork(self.params.get('startIndex', 0), self.params.get('endIndex'))
+        elif self.role == 'slave' and self.params.get('pull', False):
+            self.pullWork(self.params.get('workerId', '0'))
         elif self.role == 'slave':
-            self.runTests(self.params['filesNames'])
+            self.runTests(self.params['filesNames'],
+                          self.params.get('batchId'))
         elif self.role == 'updateBoards':
             self.updatePublishers()
+        elif self.role == 'preflight':
+            self.preflightTests()
 
-    def dispatchWork(self, startIndex):
+    def dispatchWork(self, startIndex, endIndex=None):
         """Task execution for master instance, dispatches work to slaves
 
         :param startIndex: starting index, ie the number of tests already done by previous instance
         :type startIndex: int
+        :param endIndex: index of the first test not dispatched by this master, for the sub-masters of a partitioned
+            run, defaults to None for all the remaining tests
+        :param endIndex: int, optional
         :raises Exception: if instance role is not master
         """
 
         if self.role != 'master':
             raise Exception(
                 'The orchestrator has been instanciated with another role than master')
+        dispatchStart, firstIndex = time(), startIndex
         tests = self.testManager.buildTests(self.testsPath)
+        if endIndex is not None:
+            # partitions end on a batch boundary, so the batches are the same as the ones of a single master
+            tests = tests[:endIndex]
         iterations = 0
-        maxIterations = self.config.getValue('runConfiguration', 'iterations')
+        maxIterations = self.config.run.iterations
         while startIndex < len(tests) and iterations <= maxIterations:
             iterations += 1
             if iterations > maxIterations:
                 # passes worload to next master
                 self.logger.info(
                     'Reached max iterations for master run, passing to new master with start index of {}'.format(startIndex))
-                self.callMaster(startIndex)
+                self.callMaster(startIndex, endIndex)
             else:
                 # gets the next start Index
                 testBatch, newstartIndex = self.testManager.subsetOfTests(
-                    tests, startIndex, self.config.getValue('runConfiguration', 'batchSize'))
+                    tests, startIndex, self.config.run.batchSize)
                 filesNames = [test.name+'.yaml' for test in testBatch]
                 self.logger.info(
                     'Calling slave with files names {}'.format(set(filesNames)))
-                self.callSlave(filesNames)
+                self.callSlave(filesNames, str(startIndex))
                 startIndex = newstartIndex
+        if firstIndex == 0 and endIndex is None:
+            self.removeStaleOutputs(tests)
+        self.perf.timingRecord('dispatch', dispatchStart, time(),
+                               startIndex=firstIndex, endIndex=endIndex)
 
-    def runTests(self, filesNames):
+    def removeStaleOutputs(self, tests):
+        """Deletes the per batch outputs of the publishers that belong to batches no longer in the run, called by the
+        root master once the batches are dispatched
+
+        :param tests: all the tests of the run
+        :type tests: list of tests
+        """
+
+        batchIds = set(str(start) for start in self.testManager.batchStarts(tests, self.config.run.batchSize))
+        for publisherName in self.config.run.publishers:
+            details = self.config.getValue('Publishers', publisherName)
+            if details.get('type') == 'OpenMetrics' and details.get('textfilePath') is not None:
+                OpenMetricsPublisher.removeStaleTextfiles(details['textfilePath'], batchIds, self.logger)
+
+    def dispatchPartitions(self):
+        """Task execution for the root master of a partitioned run, splits the tests in partitions of whole batches and
+        calls one sub-master per partition in parallel, so that the dispatch time does not grow with the number of tests.
+        The number of partitions is partitions of runConfiguration, or, when it is not set, the smallest number for
+        which each sub-master dispatches at most iterations batches without handing over to another master
+
+        :return: list of (start index, end index) of the partitions
+        :rtype: list of tuples
+        """
+
+        dispatchStart = time()
+        tests = self.testManager.buildTests(self.testsPath)
+        partitions = self.testManager.partitionTests(
+            tests, self.config.run.batchSize, self.config.run.partitions or None, max(self.config.run.iterations, 1))
+        self.logger.info('Calling {0} sub-masters for the partitions {1}'.format(len(partitions), partitions))
+        if self.env == 'prod' and len(partitions) > 0:
+            lambdaClient = LambdaClient(self.config, self.logger, self.env)
+            with ThreadPoolExecutor(max_workers=min(len(partitions), 16)) as executor:
+                list(executor.map(lambda bounds: self.callMaster(bounds[0], bounds[1], lambdaClient), partitions))
+        else:
+            for startIndex, endIndex in partitions:
+                self.callMaster(startIndex, endIndex)
+        self.removeStaleOutputs(tests)
+        self.perf.timingRecord('dispatch', dispatchStart, time(), startIndex=0, partitions=len(partitions))
+        return partitions
+
+    def enqueueWork(self):
+        """Task execution for master instance in queue dispatch mode, enqueues every batch of the run in the work
+        queue in one go and invokes pullWorkers slaves that lease them until the queue is empty
+
+        :raises Exception: if instance role is not master
+        """
+
+        if self.role != 'master':
+            raise Exception(
+                'The orchestrator has been instanciated with another role than master')
+        dispatchStart = time()
+        tests = self.testManager.buildTests(self.testsPath)
+        batches = []
+        startIndex = 0
+        while startIndex < len(tests):
+            testBatch, newstartIndex = self.testManager.subsetOfTests(
+                tests, startIndex, self.config.run.batchSize)
+            batches.append((str(startIndex), [test.name+'.yaml' for test in testBatch]))
+            startIndex = newstartIndex
+        self.workQueue.enqueue(self.runId, batches)
+        self.logger.info('Enqueued {0} batches, calling {1} pulling slaves'.format(
+            len(batches), self.config.run.pullWorkers))
+        for worker in range(self.config.run.pullWorkers):
+            self.callPullingSlave(str(worker))
+        self.removeStaleOutputs(tests)
+        self.perf.timingRecord('dispatch', dispatchStart, time(), batches=len(batches))
+
+    def pullWork(self, workerId):
+        """Task execution for slave instance in queue dispatch mode, leases batches from the work queue and runs them
+        until the queue is empty. A batch that raises is released to be retried, a batch whose lease expired before it
+        was acknowledged is run again by another slave
+
+        :param workerId: id of the slave within the run
+        :type workerId: string
+        :return: number of batches acknowledged
+        :rtype: int
+        """
+
+        workerId = '{0}-{1}'.format(self.runId, workerId)
+        done = 0
+        item = self.workQueue.lease(workerId)
+        while item is not None:
+            # batches left over by a previous run are logged under the id of their run
+            self.logger.extra['runId'] = item.runId
+            try:
+                self.runTests(item.filesNames, item.batchId)
+            except Exception as err:
+                self.logger.exception('Batch {0} failed on attempt {1}, releasing it'.format(
+                    item.batchId, item.attempt))
+                self.workQueue.release(item, str(err))
+            else:
+                if self.workQueue.ack(item):
+                    done += 1
+                else:
+                    self.logger.warning('Lease of batch {} expired before it finished, it was run again'.format(
+                        item.batchId))
+            item = self.workQueue.lease(workerId)
+        self.logger.extra['runId'] = self.runId
+        self.logger.info('Work queue empty after {0} batches, batches of the run per state {1}'.format(
+            done, self.workQueue.stats(self.runId)))
+        return done
+
+    def runTests(self, filesNames, batchId=None):
         """Run tests for given filesNames, used by the slaves
 
         :param filesNames: name of files that need to be run
         :type filesNames: list of strings
+        :param batchId: id of the batch attached to the log lines and timing records, defaults to None
+        :param batchId: str, optional
+        """
+
+        previousBatchId = self.logger.extra['batchId']
+        self.logger.extra['batchId'] = batchId
+        try:
+            batchStart, totalsBefore, checkpoint = time(), self.perf.stageTotals(), self.perf.checkpoint()
+            # For running locally start index is passed in function call
+            tests = self.testManager.buildTests(self.testsPath, filesNames)
+            if len(tests) > 0:
+                if self.config.run.prewarmConnections:
+                    self.fetcherManager.prewarmConnections(tests)
+                testsWithResults = self.fetcherManager.fetchResults(tests)
+                self.testManager.computeResults(testsWithResults)
+                self.publisherManager.publishResults(testsWithResults)
+                self.reportPerformance(checkpoint)
+            stages = dict((stage, total - totalsBefore.get(stage, 0))
+                          for stage, total in self.perf.stageTotals().items())
+            self.perf.timingRecord('batch', batchStart, time(), tests=len(tests),
+                                   stages=stages)
+        finally:
+            # restored even if the batch raises, for example in a pulling slave that goes on with the next batch
+            self.logger.extra['batchId'] = previousBatchId
+
+    def reportPerformance(self, checkpoint=None):
+        """Logs the duration of each stage of the run and, if selfMonitoring is set in runConfiguration,
+        publishes them as metrics through the publishers
+
+        :param checkpoint: checkpoint of the recorder at the start of the batch, so that an instance running several
+            batches reports each one on its own, defaults to None for everything recorded since the invocation started
+        :param checkpoint: tuple, optional
         """
 
-        # For running locally start index is passed in function call
-        tests = self.testManager.buildTests(self.testsPath, filesNames)
-        if len(tests) > 0:
-            testsWithResults = self.fetcherManager.fetchResults(tests)
-            self.testManager.computeResults(testsWithResults)
-            self.publisherManager.publishResults(testsWithResults)
+        self.perf.logSummary(checkpoint)
+        if self.config.run.selfMonitoring:
+            self.publisherManager.publishMetrics(self.perf.toMetrics(since=checkpoint))
 
-    def callMaster(self, startIndex):
+    def callMaster(self, startIndex, endIndex=None, lambdaClient=None):
         """For prod environment, calls a master lambda function to take over dispatching work, for local dispatches work
 
         :param startIndex: number of tests already dispatched for execution
         :type startIndex: int
+        :param endIndex: index of the first test the called master does not dispatch, defaults to None
+        :param endIndex: int, optional
+        :param lambdaClient: client shared by the calls of a partitioned dispatch, defaults to None for a new client
+        :param lambdaClient: LambdaClient, optional
         """
 
-        event = {'role': 'master', 'env': self.env, 'startIndex': startIndex}
+        event = {'role': 'master', 'env': self.env, 'startIndex': startIndex,
+                 'runId': self.runId}
+        if endIndex is not None:
+            event['endIndex'] = endIndex
+        event.update(self.profilingParameters())
         if self.env == 'prod':
-            lambdaClient = LambdaClient(self.config, self.logger, self.env)
+            lambdaClient = lambdaClient or LambdaClient(self.config, self.logger, self.env)
             lambdaClient.invokeFunction(
                 'OverwatchMaster', 'async', dumps(event))
         else:
-            self.dispatchWork(startIndex)
+            self.dispatchWork(startIndex, endIndex)
 
-    def callSlave(self, filesNames):
+    def callSlave(self, filesNames, batchId=None):
         """For prod environment, calls a slave lambda function wigh filenames as input, for dev executes those tests
 
         :param filesNames: file names of tests that need to be run
         :type filesNames: list of strings
+        :param batchId: id of the batch, unique within the run, defaults to None
+        :param batchId: str, optional
         """
 
         event = {'role': 'slave', 'env': self.env,
-                 'filesNames': filesNames}
+                 'filesNames': filesNames, 'runId': self.runId, 'batchId': batchId}
+        event.update(self.profilingParameters())
+        if self.env == 'prod':
+            invokeStart = time()
+            lambdaClient = LambdaClient(self.config, self.logger, self.env)
+            lambdaClient.invokeFunction(
+                'OverwatchSlave', 'async', dumps(event))
+            self.perf.timingRecord('invoke', invokeStart, time(), batchId=batchId)
+            sleep(self.config.run.timeBetweenCalls)
+        else:
+            self.runTests(filesNames, batchId)
+
+    def callPullingSlave(self, workerId):
+        """For prod environment, calls a slave lambda function pulling batches from the work queue, for dev pulls them
+
+        :param workerId: id of the slave within the run
+        :type workerId: string
+        """
+
+        event = {'role': 'slave', 'env': self.env, 'pull': True,
+                 'workerId': workerId, 'runId': self.runId}
+        event.update(self.profilingParameters())
         if self.env == 'prod':
+            invokeStart = time()
             lambdaClient = LambdaClient(self.config, self.logger, self.env)
             lambdaClient.invokeFunction(
                 'OverwatchSlave', 'async', dumps(event))
-            sleep(self.config.getValue(
-                'runConfiguration', 'timeBetweenCalls'))
+            self.perf.timingRecord('invoke', invokeStart, time(), batchId=None, workerId=workerId)
+            sleep(self.config.run.timeBetweenCalls)
         else:
-            self.runTests(filesNames)
+            self.pullWork(workerId)
+
+    def profilingParameters(self):
+        """Returns the profiling parameters of this instance so that the lambdas it invokes are profiled too
+
+        :return: dict with profile and profileDir keys if profiling is on, empty otherwise
+        :rtype: dict
+        """
+
+        return dict((key, self.params[key]) for key in ('profile', 'profileDir') if self.params.get(key) is not None)
 
     def updatePublishers(self):
         """Update the publishers by using the test info
@@ -130,6 +355,67 @@ class BigEye:
         self.logger.info('Updating publishers')
         self.publisherManager.updatePublishers(tests)
 
+    def preflightTests(self):
+        """Estimates the cost of the query of every active test with EXPLAIN, without running them, stores the estimates
+        at estimatesPath and flags or deactivates the tests over preflightCostThreshold, depending on preflightAction
+
+        :return: estimates of the queries over the threshold
+        :rtype: list of dicts
+        """
+
+        tests = self.testManager.buildTests(self.testsPath)
+        estimates = self.fetcherManager.explainTests(tests)
+        self.testManager.saveEstimates(estimates, self.config.run.estimatesPath)
+        self.logger.info('Stored the estimates of {0} queries in {1}'.format(
+            len(estimates), self.config.run.estimatesPath))
+        threshold = self.config.run.preflightCostThreshold
+        if threshold <= 0:
+            return []
+        expensive = [estimate for estimate in estimates if estimate['cost'] > threshold]
+        for estimate in expensive:
+            self.logger.warning('test {0} with tags {1} has an estimated cost of {2:.0f} for {3:.0f} rows on fetcher {4}'.format(
+                estimate['test'], estimate['tags'], estimate['cost'], estimate['rows'], estimate['fetcher']))
+        if self.config.run.preflightAction == 'deactivate' and len(expensive) > 0:
+            deactivated = self.testManager.deactivateQueries(self.testsPath, set(
+                (estimate['test'], estimate['fetcher'], estimate['query']) for estimate in expensive))
+            self.logger.info('Deactivated {} metrics over the cost threshold'.format(deactivated))
+        return expensive
+
+    def prepareForReuse(self, extraParameters):
+        """Prepares an instance kept alive by a warm container for a new invocation
+
+        :param extraParameters: extra parameters of the new invocation
+        :type extraParameters: dict
+        """
+
+        self.params = extraParameters
+        self.setTraceContext()
+        self.perf.reset()
+        if self.env == 'prod':
+            self.refreshSecrets()
+        if hasattr(self, 'fetcherManager'):
+            self.fetcherManager.checkConnections()
+
+    def refreshSecrets(self):
+        """Decrypts again the secrets whose ttl expired, fetchers whose secret changed are closed so they reconnect with
+        it and the publishers are built again if one of theirs changed
+        """
+
+        changed = self.config.decryptSecrets(self.role)
+        if len(changed) == 0:
+            return
+        self.logger.info('Secrets changed since the previous invocation: {}'.format(
+            ', '.join('.'.join(keys[:-1]) for keys in changed)))
+        if hasattr(self, 'fetcherManager'):
+            changedFetchers = set(keys[1] for keys in changed if keys[0] == 'Fetchers')
+            for fetcher in self.fetcherManager.fetchers:
+                if fetcher.fetcherName in changedFetchers:
+                    fetcher.close()
+        if hasattr(self, 'publisherManager') and any(keys[0] == 'Publishers' for keys in changed):
+            self.publisherManager.tearDown()
+            self.publisherManager = PublisherManager(
+                self.config, self.logger, self.perf)
+
     def tearDown(self):
         """Closes the fetchers and publishers connections
         """
@@ -137,8 +423,88 @@ class BigEye:
         if self.role == 'slave':
             self.fetcherManager.tearDown()
             self.publisherManager.tearDown()
+        elif self.role == 'preflight':
+            self.fetcherManager.tearDown()
+        if hasattr(self, 'workQueue'):
+            self.workQueue.close()
+
+
+class RuntimeCache:
+    """Process level cache of BigEye instances, a warm lambda container reuses the managers,
+    connections and parsed tests of the previous invocation instead of building them again
+    """
+
+    runners = {}
+    coldStarts = 0
+    warmStarts = 0
+
+    @classmethod
+    def getRunner(cls, env, role, configPath, testsPath, extraParameters={}):
+        """Returns the cached BigEye instance matching the arguments, building it on a cold start
+
+        :param env: environment either 'dev' or 'prod'
+        :type env: string
+        :param role: role assumed by the instance
+        :type role: string
+        :param configPath: relative path to config file
+        :type configPath: string
+        :param testsPath: relative modular path to tests files
+        :type testsPath: string
+        :param extraParameters: extra parameters of this invocation, defaults to {}
+        :param extraParameters: dict, optional
+        :return: BigEye instance ready to execute its responsabilities
+        :rtype: BigEye
+        """
+
+        key = (env, role, configPath, testsPath)
+        runner = cls.runners.get(key)
+        if runner is None:
+            cls.coldStarts += 1
+            runner = BigEye(env, role, configPath, testsPath, extraParameters)
+            cls.runners[key] = runner
+        else:
+            cls.warmStarts += 1
+            runner.prepareForReuse(extraParameters)
+        runner.logger.info('Runtime cache: {0} warm starts, {1} cold starts'.format(
+            cls.warmStarts, cls.coldStarts))
+        return runner
+
+    @classmethod
+    def stats(cls):
+        """Returns the number of warm and cold starts of this process
+
+        :return: dict with warmStarts and coldStarts counts
+        :rtype: dict
+        """
+
+        return {'warmStarts': cls.warmStarts, 'coldStarts': cls.coldStarts}
+
+    @classmethod
+    def clear(cls):
+        """Tears down and forgets every cached instance"""
+
+        for runner in cls.runners.values():
+            runner.tearDown()
+        cls.runners = {}
 
 
 def parseArg():
     args = CLIArgsParser().parseArgs()
     return args
+
+
+def extraParametersFromArgs(args):
+    """Returns the extra parameters of a BigEye instance set by the cli flags
+
+    :param args: parsed cli arguments
+    :type args: namespace
+    :return: dict with profile and profileDir keys for the flags that were given
+    :rtype: dict
+    """
+
+    params = {}
+    if args.profile:
+        params['profile'] = True
+    if args.profileDir is not None:
+        params['profileDir'] = args.profileDir
+    return params
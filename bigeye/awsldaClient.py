@@ -4,8 +4,21 @@ import zipfile
 from glob import glob
 import os
 from io import BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+import hashlib
+import struct
+import tempfile
+import time
+import zlib
 from .config import Config, CLIArgsParser, LogHandler
 
+# path components never needed at runtime in the lambda package
+DEFAULT_EXCLUDE_PATTERNS = ('__pycache__', '*.pyc', '*.pyo')
+# top level directories of the site-packages left out, test directories nested in a library may be imported by it
+DEFAULT_TOP_LEVEL_EXCLUDE_PATTERNS = ('tests', 'test')
+
 
 class LambdaClient:
     """Lambda client to create, update and invoke lambda functions
@@ -60,6 +73,50 @@ class LambdaClient:
                                                 ZipFile=zipContent)
         print(resp)
 
+    def deployFunction(self, name, zipper, artifactCache=None, splitLayer=True):
+        """Deploys the function only if its inputs changed since the last deployment, when splitLayer is set the
+        dependencies are published as a lambda layer so that code only changes upload the code alone
+
+        :param name: name of the lambda function
+        :type name: string
+        :param zipper: builder configured with the files and the virtual env to package
+        :type zipper: ParallelZipper
+        :param artifactCache: cache of built packages and deployment state, defaults to ArtifactCache()
+        :param artifactCache: ArtifactCache, optional
+        :param splitLayer: publish dependencies in a separate layer, defaults to True
+        :param splitLayer: bool, optional
+        """
+
+        artifactCache = artifactCache or ArtifactCache()
+        state = artifactCache.deployedState(name)
+        codeEntries = zipper.codeEntries()
+        if splitLayer:
+            layerEntries = zipper.dependencyEntries(prefix='python')
+            layerHash = zipper.hashEntries(layerEntries)
+            if layerHash != state.get('layerHash'):
+                print('Dependencies changed, publishing layer...')
+                layerContent = artifactCache.getOrBuild(layerHash, zipper, layerEntries)
+                resp = self.client.publish_layer_version(LayerName=name + '-dependencies',
+                                                         Content={'ZipFile': layerContent},
+                                                         CompatibleRuntimes=['python3.6'])
+                self.client.update_function_configuration(FunctionName=name,
+                                                          Layers=[resp['LayerVersionArn']])
+                # the code cannot be updated while the configuration update is in progress
+                self.client.get_waiter('function_updated').wait(FunctionName=name)
+                artifactCache.recordDeployment(name, layerHash=layerHash, layerArn=resp['LayerVersionArn'])
+            else:
+                print('Dependencies unchanged, skipping layer upload')
+        else:
+            codeEntries = codeEntries + zipper.dependencyEntries()
+        codeHash = zipper.hashEntries(codeEntries)
+        if codeHash == state.get('codeHash'):
+            print('Package {0} is already deployed to {1}, skipping upload'.format(codeHash, name))
+            return
+        zipContent = artifactCache.getOrBuild(codeHash, zipper, codeEntries)
+        print('Uploading {0:.1f} kB'.format(len(zipContent) / 1e3))
+        self.updateFunction(name, zipContent)
+        artifactCache.recordDeployment(name, codeHash=codeHash)
+
     def invokeFunction(self, functionName, mode, event):
         """Invokes function synchronously or asynchronously depending on mode with event as input
 
@@ -160,3 +217,390 @@ class Zipper:
             self.buf.seek(0)
             return self.buf.read()
         self.zip.close()
+
+
+class StreamingZipWriter:
+    """Minimal zip writer for entries that are already compressed, written sequentially to a file object
+
+    :param fileobj: binary file object the archive is written to
+    :type fileobj: file
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.centralDirectory = []
+        self.offset = 0
+
+    def writeEntry(self, arcname, method, crc, compressedData, size, dosTime, dosDate, mode):
+        """Writes the local header and data of an entry and records its central directory header
+
+        :param arcname: path of the entry in the archive
+        :type arcname: string
+        :param method: zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED
+        :type method: int
+        :param crc: crc32 of the uncompressed data
+        :type crc: int
+        :param compressedData: raw deflate stream or stored data
+        :type compressedData: bytes
+        :param size: size of the uncompressed data
+        :type size: int
+        :param dosTime: modification time in ms-dos format
+        :type dosTime: int
+        :param dosDate: modification date in ms-dos format
+        :type dosDate: int
+        :param mode: unix file mode
+        :type mode: int
+        :raises Exception: if the archive needs zip64 extensions
+        """
+
+        if self.offset > 0xFFFFFFFF or size > 0xFFFFFFFF or len(self.centralDirectory) >= 0xFFFF:
+            raise Exception('Package is too large to be zipped without zip64 extensions')
+        name = arcname.encode('utf-8')
+        flags = 0 if len(name) == len(arcname) else 0x800
+        header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, flags, method, dosTime, dosDate,
+                             crc, len(compressedData), size, len(name), 0)
+        self.fileobj.write(header)
+        self.fileobj.write(name)
+        self.fileobj.write(compressedData)
+        self.centralDirectory.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | 20, 20, flags, method,
+                                                 dosTime, dosDate, crc, len(compressedData), size, len(name), 0, 0, 0, 0,
+                                                 (mode & 0xFFFF) << 16, self.offset) + name)
+        self.offset += len(header) + len(name) + len(compressedData)
+
+    def close(self):
+        """Writes the central directory and the end of central directory record"""
+
+        centralDirectoryOffset = self.offset
+        for record in self.centralDirectory:
+            self.fileobj.write(record)
+        centralDirectorySize = sum(len(record) for record in self.centralDirectory)
+        self.fileobj.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(self.centralDirectory),
+                                       len(self.centralDirectory), centralDirectorySize, centralDirectoryOffset, 0))
+
+
+class ParallelZipper(Zipper):
+    """Faster zip package builder for lambda use, entries are compressed in parallel and streamed to the destination
+
+    :param filesToInclude: Where the script will go to look for files to add to the zip package to add to the root of zip
+    :type filesToInclude: list of strings
+    :param pathToEnv: Path to the site-packages directory, for example ../dp-env/lib/python3.6/site-packages/
+    :type pathToEnv: string
+    :param destinationPath: Destination path where the zip folder should be created, defaults to None
+    :param destinationPath: string, optional
+    :param packagesToExclude: Packages to exclude such as linters, defaults to []
+    :param packagesToExclude: list, optional
+    :param toBuffer: true for buffer or false to write to file, defaults to True
+    :param toBuffer: bool, optional
+    :param excludePatterns: glob patterns matched against each path component of the libraries, defaults to DEFAULT_EXCLUDE_PATTERNS
+    :param excludePatterns: tuple, optional
+    :param topLevelExcludePatterns: glob patterns matched against the top level directories of the site-packages only,
+        defaults to DEFAULT_TOP_LEVEL_EXCLUDE_PATTERNS
+    :param topLevelExcludePatterns: tuple, optional
+    :param workers: number of compression threads, defaults to the number of cpus
+    :param workers: int, optional
+    :param compressionLevel: zlib compression level, defaults to 6
+    :param compressionLevel: int, optional
+    """
+
+    def __init__(self, filesToInclude, pathToEnv, destinationPath=None, packagesToExclude=[], toBuffer=True,
+                 excludePatterns=DEFAULT_EXCLUDE_PATTERNS, workers=None, compressionLevel=6,
+                 topLevelExcludePatterns=DEFAULT_TOP_LEVEL_EXCLUDE_PATTERNS):
+        self.filesToInclude = filesToInclude
+        self.pathToEnv = pathToEnv
+        self.packagesToExclude = packagesToExclude
+        self.destinationPath = destinationPath
+        self.toBuffer = toBuffer
+        self.excludePatterns = excludePatterns
+        self.topLevelExcludePatterns = topLevelExcludePatterns
+        self.workers = workers or os.cpu_count() or 1
+        self.compressionLevel = compressionLevel
+
+    def isExcluded(self, relativePath):
+        """Checks whether any component of the path matches one of the exclude patterns, or its first component one
+        of the top level exclude patterns
+
+        :param relativePath: path relative to the root of the package
+        :type relativePath: string
+        :return: true if the file should not be packaged
+        :rtype: bool
+        """
+
+        parts = relativePath.split(os.sep)
+        return any(fnmatch(part, pattern) for part in parts for pattern in self.excludePatterns) or \
+            any(fnmatch(parts[0], pattern) for pattern in self.topLevelExcludePatterns)
+
+    @staticmethod
+    def archiveName(path):
+        """Returns the path of a lookup file in the archive, relative to the root of the zip like Zipper writes it
+
+        :param path: path of the file as matched by the lookup paths, for example ./main.py or ../shared/config.yaml
+        :type path: string
+        :return: normalized path without leading ./, / or .. components
+        :rtype: string
+        """
+
+        parts = os.path.normpath(os.path.splitdrive(path)[1]).split(os.sep)
+        while len(parts) > 1 and parts[0] in ('', '.', '..'):
+            parts = parts[1:]
+        return os.path.join(*parts)
+
+    def filesFromLookUpPaths(self):
+        """Lists the files matching the lookup paths, added to the root of the zip
+
+        :return: list of (source path, path in archive)
+        :rtype: list of tuples
+        """
+
+        return [(filePath, self.archiveName(filePath)) for lookupPath in self.filesToInclude
+                for filePath in glob(os.path.join(lookupPath), recursive=True) if os.path.isfile(filePath)]
+
+    def filesFromLibraries(self):
+        """Walks the site-packages directory once, pruning excluded packages and directories
+
+        :return: list of (source path, path in archive)
+        :rtype: list of tuples
+        """
+
+        entries = []
+        for root, dirs, files in os.walk(self.pathToEnv):
+            relativeRoot = os.path.relpath(root, self.pathToEnv)
+            if relativeRoot == '.':
+                relativeRoot = ''
+                dirs[:] = [d for d in dirs if d not in self.packagesToExclude]
+                files = [f for f in files if f not in self.packagesToExclude]
+            dirs[:] = sorted(d for d in dirs if not self.isExcluded(os.path.join(relativeRoot, d)))
+            for f in sorted(files):
+                relativePath = os.path.join(relativeRoot, f)
+                if not self.isExcluded(relativePath):
+                    entries.append((os.path.join(root, f), relativePath))
+        return entries
+
+    def filesFromExternalLibraries(self):
+        """Lists the files of the external psycopg2 package with static C library as AMI image does not have it
+
+        :return: list of (source path, path in archive)
+        :rtype: list of tuples
+        """
+
+        return [(packageToAdd, os.path.join('psycopg2', *packageToAdd.split('/')[4:]))
+                for packageToAdd in glob('./../awslambda-psycopg2/psycopg2-3.6/**/*', recursive=True)
+                if os.path.isfile(packageToAdd) and not self.isExcluded(packageToAdd)]
+
+    def compressEntry(self, entry):
+        """Reads and compresses a file, run in the compression threads as zlib releases the GIL
+
+        :param entry: (source path, path in archive)
+        :type entry: tuple
+        :return: arguments for StreamingZipWriter.writeEntry
+        :rtype: tuple
+        """
+
+        sourcePath, arcname = entry
+        with open(sourcePath, 'rb') as f:
+            data = f.read()
+        stat = os.stat(sourcePath)
+        year, month, day, hour, minute, second = time.localtime(stat.st_mtime)[:6]
+        if year < 1980:
+            year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+        dosTime = (hour << 11) | (minute << 5) | (second // 2)
+        dosDate = ((year - 1980) << 9) | (month << 5) | day
+        compressor = zlib.compressobj(self.compressionLevel, zlib.DEFLATED, -15)
+        compressedData = compressor.compress(data) + compressor.flush()
+        method = zipfile.ZIP_DEFLATED
+        if len(compressedData) >= len(data):
+            compressedData, method = data, zipfile.ZIP_STORED
+        return (arcname.replace(os.sep, '/'), method, zlib.crc32(data), compressedData, len(data),
+                dosTime, dosDate, stat.st_mode)
+
+    def writeEntries(self, fileobj, entries):
+        """Compresses the entries in parallel and writes them in order, keeping a bounded number in flight
+
+        :param fileobj: binary file object the archive is written to
+        :type fileobj: file
+        :param entries: list of (source path, path in archive)
+        :type entries: list of tuples
+        """
+
+        writer = StreamingZipWriter(fileobj)
+        inFlight = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for entry in entries:
+                inFlight.append(executor.submit(self.compressEntry, entry))
+                if len(inFlight) >= 4 * self.workers:
+                    writer.writeEntry(*inFlight.popleft().result())
+            while inFlight:
+                writer.writeEntry(*inFlight.popleft().result())
+        writer.close()
+
+    def codeEntries(self):
+        """Lists the files of the function code, ie the files matching the lookup paths
+
+        :return: list of (source path, path in archive)
+        :rtype: list of tuples
+        """
+
+        return self.filesFromLookUpPaths()
+
+    def dependencyEntries(self, prefix=''):
+        """Lists the files of the dependencies, ie the virtual env libraries and external libraries
+
+        :param prefix: directory prepended to the paths in archive, 'python' for a lambda layer, defaults to ''
+        :param prefix: str, optional
+        :return: list of (source path, path in archive)
+        :rtype: list of tuples
+        """
+
+        return [(sourcePath, os.path.join(prefix, arcname))
+                for sourcePath, arcname in self.filesFromLibraries() + self.filesFromExternalLibraries()]
+
+    def hashEntries(self, entries):
+        """Hashes the paths and contents of the entries, the hash changes whenever the package would change
+
+        :param entries: list of (source path, path in archive)
+        :type entries: list of tuples
+        :return: hex sha256 digest
+        :rtype: string
+        """
+
+        digest = hashlib.sha256()
+        for sourcePath, arcname in sorted(entries, key=lambda entry: entry[1]):
+            digest.update(arcname.encode('utf-8') + b'\0')
+            with open(sourcePath, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def buildZipFromEntries(self, entries):
+        """Builds a zip of given entries, if toBuffer is set to True return the bytes of the zip
+
+        :param entries: list of (source path, path in archive)
+        :type entries: list of tuples
+        :return: bytes of the zip in buffer mode
+        :rtype: bytes
+        """
+
+        if not self.toBuffer:
+            with open(self.destinationPath, 'wb') as f:
+                self.writeEntries(f, entries)
+            return None
+        # spools to disk so that the archive is only held once in memory, when read
+        with tempfile.TemporaryFile() as f:
+            self.writeEntries(f, entries)
+            f.seek(0)
+            return f.read()
+
+    def buildZip(self):
+        """
+        Builds the zip, if toBuffer is set to True return the bytes of the zip
+        """
+
+        lookupFiles = self.filesFromLookUpPaths()
+        libraries = self.filesFromLibraries()
+        externalLibraries = self.filesFromExternalLibraries()
+        print('Packaging {0} files from the look up paths, {1} files from the virtual env path {2} and {3} external files'.format(
+            len(lookupFiles), len(libraries), self.pathToEnv, len(externalLibraries)))
+        return self.buildZipFromEntries(lookupFiles + libraries + externalLibraries)
+
+
+class ArtifactCache:
+    """Local cache of built packages addressed by the hash of their inputs, also records what was last deployed
+
+    :param cachePath: directory holding the artifacts and the deployment state, defaults to './.bigeye_artifacts'
+    :param cachePath: str, optional
+    """
+
+    def __init__(self, cachePath='./.bigeye_artifacts'):
+        self.cachePath = cachePath
+        os.makedirs(cachePath, exist_ok=True)
+        self.statePath = os.path.join(cachePath, 'deployed.json')
+
+    def artifactPath(self, contentHash):
+        """Returns the path of the artifact with given hash
+
+        :param contentHash: hash of the package inputs
+        :type contentHash: string
+        :return: path of the zip
+        :rtype: string
+        """
+
+        return os.path.join(self.cachePath, contentHash + '.zip')
+
+    def getOrBuild(self, contentHash, zipper, entries):
+        """Returns the cached artifact for the hash, building and storing it if it is not cached
+
+        :param contentHash: hash of the package inputs
+        :type contentHash: string
+        :param zipper: builder used on a cache miss, the zip is written to the cache whether it builds to a buffer or
+            to a file
+        :type zipper: ParallelZipper
+        :param entries: list of (source path, path in archive)
+        :type entries: list of tuples
+        :return: bytes of the zip
+        :rtype: bytes
+        """
+
+        path = self.artifactPath(contentHash)
+        if os.path.exists(path):
+            print('Reusing cached artifact {}'.format(contentHash))
+        else:
+            with open(path + '.tmp', 'wb') as f:
+                zipper.writeEntries(f, entries)
+            os.replace(path + '.tmp', path)
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def deployedState(self, functionName):
+        """Returns what was last deployed for the function
+
+        :param functionName: name of the lambda function
+        :type functionName: string
+        :return: dict with the code hash, layer hash and layer arn deployed
+        :rtype: dict
+        """
+
+        if not os.path.exists(self.statePath):
+            return {}
+        with open(self.statePath) as f:
+            return json.load(f).get(functionName, {})
+
+    def recordDeployment(self, functionName, **state):
+        """Records what has been deployed for the function
+
+        :param functionName: name of the lambda function
+        :type functionName: string
+        """
+
+        allStates = {}
+        if os.path.exists(self.statePath):
+            with open(self.statePath) as f:
+                allStates = json.load(f)
+        allStates.setdefault(functionName, {}).update(state)
+        with open(self.statePath + '.tmp', 'w') as f:
+            json.dump(allStates, f, indent=2)
+        os.replace(self.statePath + '.tmp', self.statePath)
+
+
+def compareZipBuilders(filesToInclude, pathToEnv, packagesToExclude=[]):
+    """Builds the package with Zipper and ParallelZipper and prints the size and build time of each
+
+    :param filesToInclude: lookup paths of files to add to the root of the zip
+    :type filesToInclude: list of strings
+    :param pathToEnv: path to the site-packages directory
+    :type pathToEnv: string
+    :param packagesToExclude: packages to exclude such as linters, defaults to []
+    :param packagesToExclude: list, optional
+    :return: dict of size in bytes and build time in seconds per builder
+    :rtype: dict
+    """
+
+    report = {}
+    for builder in (Zipper, ParallelZipper):
+        t1 = time.time()
+        zipContent = builder(filesToInclude, pathToEnv,
+                             packagesToExclude=packagesToExclude).buildZip()
+        duration = time.time() - t1
+        report[builder.__name__] = {'size': len(zipContent), 'seconds': duration}
+        print('{0}: {1:.2f} MB in {2:.2f} seconds'.format(
+            builder.__name__, len(zipContent) / 1e6, duration))
+    return report
@@ -0,0 +1,275 @@
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from json import dumps, load, dump
+import os
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from . import BigEye
+from .fetchers import Fetcher, FetchError, FetcherManager
+from .instrumentation import PerfRecorder
+
+
+class SyntheticFetcher(Fetcher):
+    """Local fetcher stand-in returning random values after a simulated query latency
+
+    The fetcher config accepts a latency dict with a distribution ('constant', 'uniform', 'exponential' or 'lognormal'),
+    a mean and a sigma in seconds, a failureRate between 0 and 1 and a seed.
+
+    :param fetcherConfig: config of the fetcher
+    :type fetcherConfig: dict
+    :param logger: logger instance
+    :type logger: logger
+    :param fetcherName: name to give to fetcher, used by FetcherManager
+    :type fetcherName: string
+    :param perf: recorder of the stages durations, defaults to None
+    :param perf: PerfRecorder, optional
+    """
+
+    def __init__(self, fetcherConfig, logger, fetcherName, perf=None):
+        self.logger = logger
+        self.fetcherName = fetcherName
+        self.perf = perf or PerfRecorder(logger)
+        latency = dict(fetcherConfig.get('latency', {}))
+        self.distribution = latency.get('distribution', 'constant')
+        self.mean = float(latency.get('mean', 0.))
+        self.sigma = float(latency.get('sigma', 0.))
+        self.failureRate = float(fetcherConfig.get('failureRate', 0.))
+        self.random = random.Random(fetcherConfig.get('seed', 0))
+
+    def sampleLatency(self):
+        """Draws a query latency from the configured distribution
+
+        :return: latency in seconds
+        :rtype: float
+        """
+
+        if self.distribution == 'uniform':
+            return self.random.uniform(max(self.mean - self.sigma, 0.), self.mean + self.sigma)
+        if self.distribution == 'exponential':
+            return self.random.expovariate(1. / self.mean) if self.mean > 0 else 0.
+        if self.distribution == 'lognormal':
+            return self.random.lognormvariate(0., self.sigma) * self.mean
+        return self.mean
+
+    def fetchResults(self, details):
+        """Sleeps for a sampled latency and returns a random value
+
+        :param details: details of the fetcher in the test, a value key fixes the returned value
+        :type details: dict
+        :raises FetchError: with probability failureRate
+        :return: value of the synthetic query
+        :rtype: int
+        """
+
+        time.sleep(self.sampleLatency())
+        if self.random.random() < self.failureRate:
+            raise FetchError('Synthetic failure')
+        return details.get('value', self.random.randint(0, 1000))
+
+    def close(self):
+        pass
+
+
+FetcherManager.fetcherTypes['Synthetic'] = SyntheticFetcher
+
+
+class DatadogStandIn(ThreadingMixIn, HTTPServer):
+    """Local http server standing in for the datadog metric api, counts the requests and bytes received"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), DatadogStandInHandler)
+        self.requests = 0
+        self.bytesReceived = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class DatadogStandInHandler(BaseHTTPRequestHandler):
+    """Accepts any post like the datadog api would"""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.bytesReceived += len(body)
+        response = dumps({'status': 'ok'}).encode()
+        self.send_response(202)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def generateSuite(rootFolder, numberOfTests, metricsPerTest, apiHost, latency, batchSize, compressPayloads=False):
+    """Writes a config file and synthetic test yaml files
+
+    :param rootFolder: folder where the config and tests are written
+    :type rootFolder: string
+    :param numberOfTests: number of test files
+    :type numberOfTests: int
+    :param metricsPerTest: number of metrics per test file
+    :type metricsPerTest: int
+    :param apiHost: url of the datadog stand-in
+    :type apiHost: string
+    :param latency: latency dict of the synthetic fetcher
+    :type latency: dict
+    :param batchSize: number of tests per slave batch
+    :type batchSize: int
+    :param compressPayloads: whether the datadog publisher sends compressed payloads, defaults to False
+    :param compressPayloads: bool, optional
+    :return: path of the config file and glob of the tests files
+    :rtype: tuple
+    """
+
+    config = {
+        'Fetchers': {'synthetic': {'type': 'Synthetic', 'latency': latency}},
+        'Publishers': {'standin_dd': {'type': 'Datadog', 'apiKey': 'benchmark', 'appKey': 'benchmark',
+                                      'batchSize': 2000, 'apiHost': apiHost, 'spoolPath': False,
+                                      'compressPayloads': compressPayloads}},
+        'runConfiguration': {'fetchers': ['synthetic'], 'publishers': ['standin_dd'], 'types': ['quality'],
+                             'batchSize': batchSize, 'maxTestDuration': 30, 'timeBetweenCalls': 0,
+                             'iterations': numberOfTests + 1},
+    }
+    configPath = os.path.join(rootFolder, 'config.yaml')
+    # json is valid yaml, no need for the round trip dumper to write those files
+    with open(configPath, 'w') as f:
+        f.write(dumps(config, indent=2))
+    os.makedirs(os.path.join(rootFolder, 'tests'), exist_ok=True)
+    for i in range(numberOfTests):
+        metrics = {}
+        for j in range(metricsPerTest):
+            metrics['metric{}'.format(j + 1)] = {
+                'active': True,
+                'fetchers': {'synthetic': {'query': 'select {}'.format(j)}},
+                'publishers': {'standin_dd': {'dashboardName': 'Benchmark', 'typeOfDashboard': 'screenboard'}},
+                'tags': {'desco': 'desco{}'.format(j)}}
+        test = {'name': 'synthetic_test_{:05d}'.format(i), 'description': 'synthetic benchmark test',
+                'type': 'quality', 'team': 'benchmark', 'metrics': metrics}
+        with open(os.path.join(rootFolder, 'tests', 'synthetic_test_{:05d}.yaml'.format(i)), 'w') as f:
+            f.write(dumps(test, indent=2))
+    return configPath, os.path.join(rootFolder, 'tests', '**', '*.yaml')
+
+
+def runBenchmark(numberOfTests=200, metricsPerTest=3, latency=None, batchSize=20, compressPayloads=False):
+    """Runs a synthetic suite through BigEye in dev mode against the synthetic fetcher and the datadog stand-in
+
+    :param numberOfTests: number of test files, defaults to 200
+    :param numberOfTests: int, optional
+    :param metricsPerTest: number of metrics per test file, defaults to 3
+    :param metricsPerTest: int, optional
+    :param latency: latency dict of the synthetic fetcher, defaults to constant 1 ms
+    :param latency: dict, optional
+    :param batchSize: number of tests per slave batch, defaults to 20
+    :param batchSize: int, optional
+    :param compressPayloads: whether the datadog publisher sends compressed payloads, defaults to False
+    :param compressPayloads: bool, optional
+    :return: results with tests per second, peak memory and per stage timings
+    :rtype: dict
+    """
+
+    latency = latency or {'distribution': 'constant', 'mean': 0.001}
+    standIn = DatadogStandIn()
+    standIn.start()
+    rootFolder = tempfile.mkdtemp(prefix='bigeye-benchmark-')
+    try:
+        configPath, testsPath = generateSuite(rootFolder, numberOfTests, metricsPerTest, standIn.url,
+                                              latency, batchSize, compressPayloads)
+        start = time.time()
+        runner = BigEye('dev', 'master', configPath, testsPath)
+        runner.executeResponsabilites()
+        duration = time.time() - start
+        runner.tearDown()
+    finally:
+        standIn.shutdown()
+        standIn.server_close()
+        shutil.rmtree(rootFolder)
+    stages = runner.perf.summary()['stages']
+    return {'tests': numberOfTests * metricsPerTest, 'seconds': duration,
+            'testsPerSecond': numberOfTests * metricsPerTest / duration,
+            'peakMemoryMB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3,
+            'publishRequests': standIn.requests, 'publishedBytes': standIn.bytesReceived,
+            'stages': dict((stage, stats['total']) for stage, stats in stages.items())}
+
+
+def compareToBaseline(results, baseline, tolerance):
+    """Lists the regressions of results against a baseline
+
+    :param results: results of runBenchmark
+    :type results: dict
+    :param baseline: stored results of a previous run
+    :type baseline: dict
+    :param tolerance: relative degradation allowed, for example 0.1 for 10%
+    :type tolerance: float
+    :return: list of regression descriptions, empty if none
+    :rtype: list of strings
+    """
+
+    regressions = []
+    if results['testsPerSecond'] < baseline['testsPerSecond'] * (1 - tolerance):
+        regressions.append('throughput {0:.1f} tests/s against {1:.1f} tests/s'.format(
+            results['testsPerSecond'], baseline['testsPerSecond']))
+    if results['peakMemoryMB'] > baseline['peakMemoryMB'] * (1 + tolerance):
+        regressions.append('peak memory {0:.1f} MB against {1:.1f} MB'.format(
+            results['peakMemoryMB'], baseline['peakMemoryMB']))
+    for stage, seconds in results['stages'].items():
+        baselineSeconds = baseline['stages'].get(stage)
+        # ignores noise on stages that take a negligible time
+        if baselineSeconds is not None and seconds > 0.05 and seconds > baselineSeconds * (1 + tolerance):
+            regressions.append('stage {0} {1:.3f} s against {2:.3f} s'.format(stage, seconds, baselineSeconds))
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description='Measures BigEye throughput on a synthetic suite without postgres or datadog')
+    parser.add_argument('--tests', type=int, default=200, help='number of synthetic test files')
+    parser.add_argument('--metrics', type=int, default=3, help='number of metrics per test file')
+    parser.add_argument('--batchSize', type=int, default=20, help='number of tests per slave batch')
+    parser.add_argument('--distribution', default='constant',
+                        choices=['constant', 'uniform', 'exponential', 'lognormal'], help='query latency distribution')
+    parser.add_argument('--mean', type=float, default=0.001, help='mean query latency in seconds')
+    parser.add_argument('--sigma', type=float, default=0., help='spread of the query latency')
+    parser.add_argument('--compressPayloads', action='store_true',
+                        help='publish through pre-serialized gzip compressed payloads')
+    parser.add_argument('--baseline', help='json file of a previous run to compare against')
+    parser.add_argument('--saveBaseline', help='json file where the results are saved')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative degradation allowed against the baseline')
+    args = parser.parse_args()
+    results = runBenchmark(args.tests, args.metrics, {'distribution': args.distribution, 'mean': args.mean,
+                                                      'sigma': args.sigma}, args.batchSize, args.compressPayloads)
+    print('{0} tests in {1:.2f} seconds, {2:.1f} tests/s, peak memory {3:.1f} MB, {4} publish requests, {5} bytes'.format(
+        results['tests'], results['seconds'], results['testsPerSecond'], results['peakMemoryMB'],
+        results['publishRequests'], results['publishedBytes']))
+    for stage, seconds in sorted(results['stages'].items()):
+        print('  {0:<16} {1:.3f} s'.format(stage, seconds))
+    if args.saveBaseline:
+        with open(args.saveBaseline, 'w') as f:
+            dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compareToBaseline(results, load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        if len(regressions) > 0:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
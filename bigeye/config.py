@@ -4,6 +4,93 @@ import logging
 from os import environ
 import boto3
 from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+import time
+
+# Decrypted secrets survive between invocations of a warm lambda container, keyed by
+# environment variable name and ciphertext so that a rotated secret is decrypted again
+_secretsCache = {}
+DEFAULT_SECRETS_TTL = 900
+
+
+class RunConfiguration(NamedTuple):
+    """Frozen snapshot of the runConfiguration section, compiled and validated once when the config is loaded
+    so that hot paths read plain attributes
+    """
+
+    fetchers: tuple
+    publishers: tuple
+    batchSize: int
+    maxTestDuration: float
+    timeBetweenCalls: float
+    iterations: int
+    types: tuple = ()
+    secretsTTL: float = DEFAULT_SECRETS_TTL
+    prewarmConnections: bool = False
+    selfMonitoring: bool = False
+    profileDir: str = '/tmp/bigeye-profiles'
+    preflightCostThreshold: float = 0.
+    preflightAction: str = 'flag'
+    estimatesPath: str = './bigeye_estimates.json'
+    dispatchMode: str = 'push'
+    pullWorkers: int = 1
+    partitions: int = 0
+
+
+# key of runConfiguration: (converter, required)
+RUN_CONFIGURATION_SCHEMA = {
+    'fetchers': (tuple, True),
+    'publishers': (tuple, True),
+    'types': (tuple, False),
+    'batchSize': (int, True),
+    'maxTestDuration': (float, True),
+    'timeBetweenCalls': (float, True),
+    'iterations': (int, True),
+    'secretsTTL': (float, False),
+    'prewarmConnections': (bool, False),
+    'selfMonitoring': (bool, False),
+    'profileDir': (str, False),
+    'preflightCostThreshold': (float, False),
+    'preflightAction': (str, False),
+    'estimatesPath': (str, False),
+    'dispatchMode': (str, False),
+    'pullWorkers': (int, False),
+    'partitions': (int, False),
+}
+
+# what the preflight role does with the tests whose estimated cost is over preflightCostThreshold
+PREFLIGHT_ACTIONS = ('flag', 'deactivate')
+
+# how the master hands the batches to the slaves: invoked with their files names, enqueued in the WorkQueue and pulled,
+# or pushed by sub-masters dispatching partitions of the tests in parallel
+DISPATCH_MODES = ('push', 'queue', 'partitioned')
+
+# keys each type of fetcher or publisher needs in the config, secrets are not listed as they come from the environment in prod
+REQUIRED_FETCHER_KEYS = {
+    # a tuple of keys means any one of them
+    'PostgresDB': (('host', 'hosts'), 'database', 'user'),
+    'HTTPAPI': ('baseUrl',),
+}
+REQUIRED_PUBLISHER_KEYS = {
+    'Datadog': ('batchSize',),
+    'OpenMetrics': (('textfilePath', 'pushgatewayUrl'),),
+    'ResultFile': ('rootPath',),
+}
+
+
+class ConfigError(Exception):
+    """Exception raised if the config file does not match the expected schema
+
+    :param message: message to return when printing this error
+    :type message: string
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
 
 
 class Config():
@@ -15,30 +102,177 @@ class Config():
     :param env: str, optional
     :param role: role, similar as roles in BigEye class, defaults to 'slave'
     :param role: str, optional
+    :param kmsClient: client used to decrypt secrets in prod, a boto3 kms client is created if needed when None, defaults to None
+    :param kmsClient: boto3 client, optional
     """
 
-    def __init__(self, relativePath, env='prod', role='slave'):
+    def __init__(self, relativePath, env='prod', role='slave', kmsClient=None):
         if '.yaml' not in relativePath:
             raise Exception(
                 'Provided path to config file is not an .yaml formated file')
         yaml = YAML()
         with open(relativePath) as f:
             self.config = yaml.load(f)
+        self.kmsClient = kmsClient
+        self.run = self.compileRunConfiguration()
         if env == 'prod':
             # if it is a production run, passwords and keys are not the config file but stored in encrypted environment variables
-            kmsClient = boto3.client('kms')
+            self.decryptSecrets(role)
+
+    def compileRunConfiguration(self):
+        """Validates the config against the schema and compiles the runConfiguration section in a frozen snapshot
+
+        :raises ConfigError: if a key is missing or has a value of the wrong type
+        :return: snapshot of the run configuration
+        :rtype: RunConfiguration
+        """
+
+        for section in ('Fetchers', 'Publishers', 'runConfiguration'):
+            if not isinstance(self.config.get(section), dict):
+                raise ConfigError(
+                    'Config is missing the {} section'.format(section))
+        values = {}
+        for key, (converter, required) in RUN_CONFIGURATION_SCHEMA.items():
+            if key not in self.config['runConfiguration']:
+                if required:
+                    raise ConfigError(
+                        'runConfiguration is missing the {} key'.format(key))
+                continue
+            value = self.config['runConfiguration'][key]
+            if converter is tuple and isinstance(value, str):
+                # tuple() would split the string in characters
+                raise ConfigError('runConfiguration {0} should be a list, got {1}'.format(key, value))
             try:
-                if role == 'slave':
-                    for fet in self.config['Fetchers']:
-                        self.config['Fetchers'][fet]['password'] = self.getPasswordsFromKMS(
-                            kmsClient, fet+'_password')
-                self.config['Publishers']['bboxx_dd']['apiKey'] = self.getPasswordsFromKMS(
-                    kmsClient, 'bboxx_dd_apiKey')
-                self.config['Publishers']['bboxx_dd']['appKey'] = self.getPasswordsFromKMS(
-                    kmsClient, 'bboxx_dd_appKey')
-            except KeyError as err:
+                values[key] = converter(value)
+            except (TypeError, ValueError):
+                raise ConfigError('runConfiguration {0} should be of type {1}, got {2}'.format(
+                    key, converter.__name__, value))
+        if values.get('preflightAction', 'flag') not in PREFLIGHT_ACTIONS:
+            raise ConfigError('runConfiguration preflightAction should be one of {0}, got {1}'.format(
+                ', '.join(PREFLIGHT_ACTIONS), values['preflightAction']))
+        if values.get('dispatchMode', 'push') not in DISPATCH_MODES:
+            raise ConfigError('runConfiguration dispatchMode should be one of {0}, got {1}'.format(
+                ', '.join(DISPATCH_MODES), values['dispatchMode']))
+        if values.get('dispatchMode') == 'queue' and not isinstance(self.config.get('WorkQueue'), dict):
+            raise ConfigError('Config is missing the WorkQueue section required by the queue dispatchMode')
+        if values.get('pullWorkers', 1) < 1:
+            raise ConfigError('runConfiguration pullWorkers should be at least 1, got {}'.format(values['pullWorkers']))
+        if values.get('partitions', 0) < 0:
+            raise ConfigError('runConfiguration partitions should be positive, got {}'.format(values['partitions']))
+        self.validateComponents('Fetchers', values['fetchers'], REQUIRED_FETCHER_KEYS)
+        self.validateComponents('Publishers', values['publishers'], REQUIRED_PUBLISHER_KEYS)
+        return RunConfiguration(**values)
+
+    def validateComponents(self, section, names, requiredKeys):
+        """Checks that each fetcher or publisher used by the run is configured with the keys its type requires
+
+        :param section: 'Fetchers' or 'Publishers'
+        :type section: string
+        :param names: names of the components used by the run
+        :type names: tuple of strings
+        :param requiredKeys: required keys for each type of component
+        :type requiredKeys: dict
+        :raises ConfigError: if a component is not configured or misses a key
+        """
+
+        for name in names:
+            details = self.config[section].get(name)
+            if not isinstance(details, dict) or 'type' not in details:
+                raise ConfigError('{0} {1} is used by runConfiguration but is not configured with a type'.format(
+                    section, name))
+            for key in requiredKeys.get(details['type'], ()):
+                alternatives = key if isinstance(key, tuple) else (key,)
+                if not any(alternative in details for alternative in alternatives):
+                    raise ConfigError('{0} {1} is missing the {2} key'.format(
+                        section, name, ' or '.join(alternatives)))
+
+    def secretsToDecrypt(self, role):
+        """Lists the secrets needed by the fetchers and publishers of this run
+
+        :param role: role of the instance, fetcher secrets are only needed by the slaves and the preflight
+        :type role: string
+        :return: list of tuples with the config keys of the secret and the name of the environment variable holding it
+        :rtype: list of tuples
+        """
+
+        # imported here as the managers are only needed to know the secrets of each type
+        from .fetchers import FetcherManager
+        from .publishers import PublisherManager
+        secrets = []
+        if role in ['slave', 'preflight']:
+            for fet in self.run.fetchers:
+                fetcherType = FetcherManager.fetcherTypes.get(self.getValue('Fetchers', fet, 'type'))
+                for key in getattr(fetcherType, 'secretKeys', ()):
+                    secrets.append((('Fetchers', fet, key), fet+'_'+key))
+        if role != 'master':
+            for pub in self.run.publishers:
+                publisherType = PublisherManager.publisherTypes.get(self.getValue('Publishers', pub, 'type'))
+                for key in getattr(publisherType, 'secretKeys', ()):
+                    secrets.append((('Publishers', pub, key), pub+'_'+key))
+        return secrets
+
+    def decryptSecrets(self, role):
+        """Decrypts concurrently the secrets required by the run and writes them in the config,
+        secrets decrypted by a previous invocation are reused until their ttl expires
+
+        :param role: role of the instance
+        :type role: string
+        :raises Exception: if a secret is not in the environment variables
+        :return: config keys of the secrets whose value changed, for example after a rotation
+        :rtype: list of tuples
+        """
+
+        ttl = self.run.secretsTTL
+        secrets = self.secretsToDecrypt(role)
+        for _, KMSKey in secrets:
+            if KMSKey not in environ:
                 raise Exception(
-                    'Key not in environment variables, {}'.format(err))
+                    'Key not in environment variables, {}'.format(KMSKey))
+        now = time.time()
+        toDecrypt = set([KMSKey for _, KMSKey in secrets
+                         if self.cachedSecret(KMSKey, now) is None])
+        if len(toDecrypt) > 0:
+            client = self.getKmsClient()
+            with ThreadPoolExecutor(max_workers=min(len(toDecrypt), 8)) as executor:
+                plainValues = dict(zip(toDecrypt, executor.map(
+                    lambda KMSKey: self.getPasswordsFromKMS(client, KMSKey), toDecrypt)))
+            for KMSKey, plainValue in plainValues.items():
+                _secretsCache[KMSKey] = (
+                    environ[KMSKey], plainValue, now + float(ttl))
+        changed = []
+        for keys, KMSKey in secrets:
+            details = self.getValue(*keys[:-1])
+            if details.get(keys[-1]) != _secretsCache[KMSKey][1]:
+                changed.append(keys)
+            details[keys[-1]] = _secretsCache[KMSKey][1]
+        return changed
+
+    def cachedSecret(self, KMSKey, now):
+        """Returns the cached plain text of a secret if it has not expired and its ciphertext has not changed
+
+        :param KMSKey: name of the environment variable
+        :type KMSKey: string
+        :param now: current timestamp
+        :type now: float
+        :return: plain text string of variable or None if it needs to be decrypted
+        :rtype: string
+        """
+
+        cached = _secretsCache.get(KMSKey)
+        if cached is None or cached[0] != environ[KMSKey] or cached[2] < now:
+            return None
+        return cached[1]
+
+    def getKmsClient(self):
+        """Returns the kms client, creating it on first use
+
+        :return: kms client
+        :rtype: boto3 client
+        """
+
+        if self.kmsClient is None:
+            self.kmsClient = boto3.client('kms')
+        return self.kmsClient
 
     def getPasswordsFromKMS(self, client, KMSKey):
         """Gets encrypted passwords from envrionment variables and decrypts it
@@ -85,7 +319,11 @@ class CLIArgsParser():
             description='Hunts down mischievous data', epilog='Hope the tool answers some of your monitoring needs ;)')
         # defaults to false
         self.parser.add_argument(
-            'role', help='specify the mode you wish to use', choices=['master', 'slave', 'updateBoards', 'updateLambda', 'invokeMaster', 'invokeSlave'])
+            'role', help='specify the mode you wish to use', choices=['master', 'slave', 'updateBoards', 'preflight', 'updateLambda', 'invokeMaster', 'invokeSlave'])
+        self.parser.add_argument(
+            '--profile', help='profile the run with cProfile and tracemalloc', action='store_true')
+        self.parser.add_argument(
+            '--profileDir', help='directory where the profiling reports are written, defaults to profileDir of runConfiguration')
 
     def parseArgs(self):
         """Parses the args of the command line
@@ -121,3 +359,34 @@ class LogHandler():
             ch.setLevel(logging.INFO)
             logger.addHandler(ch)
         return logger
+
+    @staticmethod
+    def createTraceLogger(logger, runId=None, batchId=None):
+        """Wraps a logger so that every log line is prefixed with the run and batch ids
+
+        :param logger: logger instance from logging module
+        :type logger: logger
+        :param runId: id of the run shared by the master and slaves, defaults to None
+        :param runId: str, optional
+        :param batchId: id of the batch run by a slave, defaults to None
+        :param batchId: str, optional
+        :return: logger adapter whose extra dict can be updated when the ids change
+        :rtype: TraceLogger
+        """
+
+        return TraceLogger(logger, {'runId': runId, 'batchId': batchId})
+
+
+class TraceLogger(logging.LoggerAdapter):
+    """Logger adapter prefixing messages with the run and batch ids held in its extra dict"""
+
+    def process(self, msg, kwargs):
+        prefix = ''
+        if self.extra.get('runId') is not None:
+            prefix += '[run {}]'.format(self.extra['runId'])
+        if self.extra.get('batchId') is not None:
+            prefix += '[batch {}]'.format(self.extra['batchId'])
+        kwargs['extra'] = dict(self.extra, **kwargs.get('extra', {}))
+        if prefix == '':
+            return msg, kwargs
+        return '{0} {1}'.format(prefix, msg), kwargs
@@ -1,5 +1,30 @@
 import psycopg2
+import requests
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+import csv
+import mmap
+import os
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlparse
+from .instrumentation import PerfRecorder
+
+try:
+    # optional, needed for parquet and arrow files and for vectorized scans of csv files
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.csv
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# errors raised while reading a file that fail the test instead of the batch, unicode and arrow parsing errors are
+# value errors
+DATASET_ERRORS = (OSError, ValueError, csv.Error) + ((pyarrow.ArrowException,) if pyarrow is not None else ())
 
 
 class FetcherManager:
@@ -9,17 +34,25 @@ class FetcherManager:
     :type config: Config
     :param logger: logger instance from logger module
     :type logger: logger
+    :param perf: recorder of the stages durations, defaults to a new PerfRecorder
+    :param perf: PerfRecorder, optional
     """
 
-    def __init__(self, config, logger):
+    # fetcher classes by type name in the config, filled in below the fetchers definitions
+    fetcherTypes = {}
+
+    def __init__(self, config, logger, perf=None):
         self.config = config
         self.logger = logger
-        fetchersToInit = config.getValue('runConfiguration', 'fetchers')
+        self.perf = perf or PerfRecorder(logger)
+        fetchersToInit = config.run.fetchers
         self.fetchers = []
         for fetcher in fetchersToInit:
-            if config.getValue('Fetchers', fetcher, 'type') == 'PostgresDB':
-                self.fetchers.append(PostgresDB(
-                    config.getValue('Fetchers', fetcher), logger, fetcher))
+            fetcherType = self.fetcherTypes.get(
+                config.getValue('Fetchers', fetcher, 'type'))
+            if fetcherType is not None:
+                self.fetchers.append(fetcherType(
+                    config.getValue('Fetchers', fetcher), logger, fetcher, self.perf))
 
     def extractFetcher(self,  fetcherName):
         """Returns fetcher object with given name
@@ -48,17 +81,24 @@ class FetcherManager:
 
         t1 = time.time()
         testsWithResults = []
+        maxTestDuration = self.config.run.maxTestDuration
+        pending = self.submitConcurrentFetches(tests)
         for test in tests:
             try:
                 for fetcherDict in test.fetchers:
                     # measure run time for each test and send warning if one test is too long
-                    maxTestDuration = int(self.config.getValue(
-                        'runConfiguration', 'maxTestDuration'))
-                    testStart = time.time()
                     fetcher = self.extractFetcher(fetcherDict['name'])
-                    fetcherDict['result'] = fetcher.fetchResults(
-                        fetcherDict['details'])
-                    testDuration = time.time() - testStart
+                    if id(fetcherDict) in pending:
+                        fetcherDict['result'], testDuration = pending[id(
+                            fetcherDict)].result()
+                    else:
+                        fetcher.ensureConnection()
+                        testStart = time.time()
+                        fetcherDict['result'] = fetcher.fetchResults(
+                            fetcherDict['details'])
+                        testDuration = time.time() - testStart
+                    fetcherDict['duration'] = testDuration
+                    self.perf.record('query', testDuration, fetcher.fetcherName)
                     if testDuration > maxTestDuration:
                         self.logger.warning('test {0} with tags {1} has overran with {2:.2f} seconds runtime'.format(
                             test.name, test.tags, testDuration))
@@ -72,6 +112,105 @@ class FetcherManager:
             len(testsWithResults), interval))
         return testsWithResults
 
+    def submitConcurrentFetches(self, tests):
+        """Submits upfront the fetches of the fetchers that run requests concurrently
+
+        :param tests: list of tests
+        :type tests: list
+        :return: dict of id of fetcher dict to future resolving to the result and duration of the fetch
+        :rtype: dict
+        """
+
+        concurrentFetchers = dict((fet.fetcherName, fet)
+                                  for fet in self.fetchers if fet.supportsConcurrency)
+        pending = {}
+        for test in tests:
+            for fetcherDict in test.fetchers:
+                fetcher = concurrentFetchers.get(fetcherDict['name'])
+                if fetcher is not None:
+                    pending[id(fetcherDict)] = fetcher.submit(
+                        fetcherDict['details'])
+        return pending
+
+    def prewarmConnections(self, tests):
+        """Opens concurrently the connections of the fetchers referenced by the tests,
+        a fetcher that cannot connect is logged and only fails the tests that use it
+
+        :param tests: list of tests that will be run
+        :type tests: list
+        """
+
+        fetcherNames = set([fetcherDict['name']
+                            for test in tests for fetcherDict in test.fetchers])
+        fetchers = [fet for fet in self.fetchers if fet.fetcherName in fetcherNames]
+        if len(fetchers) == 0:
+            return
+        t1 = time.time()
+        with ThreadPoolExecutor(max_workers=len(fetchers)) as executor:
+            for fetcher, error in zip(fetchers, executor.map(self.connectFetcher, fetchers)):
+                if error is not None:
+                    self.logger.error('Could not prewarm fetcher {0}: {1}'.format(
+                        fetcher.fetcherName, error))
+        self.logger.info('Prewarmed {0} fetchers in {1:.2f} seconds'.format(
+            len(fetchers), time.time() - t1))
+
+    def connectFetcher(self, fetcher):
+        """Opens the connection of a fetcher, used by the prewarm thread pool
+
+        :param fetcher: fetcher to connect
+        :type fetcher: Fetcher
+        :return: the error raised while connecting or None
+        :rtype: FetchError
+        """
+
+        try:
+            fetcher.ensureConnection()
+        except FetchError as err:
+            return err
+        return None
+
+    def checkConnections(self):
+        """Checks that the connection of each fetcher is still alive and closes the dead ones so they are
+        reopened on next use, used when the manager is reused by a warm lambda container
+        """
+
+        for fetcher in self.fetchers:
+            if not fetcher.isAlive():
+                self.logger.warning(
+                    'Connection of fetcher {} is dead, it will be reopened on next use'.format(fetcher.fetcherName))
+                fetcher.close()
+
+    def explainTests(self, tests):
+        """Estimates the cost of the query of each fetcher in each test without running it, fetchers that cannot
+        estimate their queries are skipped
+
+        :param tests: list of tests
+        :type tests: list
+        :return: list of dicts with test, tags, fetcher, query, cost and rows keys
+        :rtype: list
+        """
+
+        estimates = []
+        unsupported = set()
+        for test in tests:
+            for fetcherDict in test.fetchers:
+                fetcher = self.extractFetcher(fetcherDict['name'])
+                try:
+                    estimate = fetcher.explainQuery(fetcherDict['details'])
+                except NotImplementedError:
+                    unsupported.add(fetcher.fetcherName)
+                    continue
+                except FetchError as err:
+                    self.logger.warning('Could not estimate test {0} with tags {1}: {2}'.format(
+                        test.name, test.tags, err))
+                    continue
+                estimate.update({'test': test.name, 'tags': dict(test.tags), 'fetcher': fetcher.fetcherName,
+                                 'query': fetcherDict['details'].get('query')})
+                estimates.append(estimate)
+        for fetcherName in sorted(unsupported):
+            self.logger.info('Fetcher {} does not estimate query costs, its tests are skipped'.format(fetcherName))
+        return estimates
+
     def tearDown(self):
         for fetcher in self.fetchers:
             fetcher.close()
@@ -80,6 +219,11 @@ class FetcherManager:
 class Fetcher:
     """Abstract class for interface like behaviour for fetchers"""
 
+    # fetchers that support concurrency implement submit and have their fetches submitted upfront by the manager
+    supportsConcurrency = False
+    # config keys decrypted from the [fetcherName]_[key] environment variables in prod
+    secretKeys = ()
+
     def fetchResult(self, test):
         """Fetches result for each fetcher in the test
 
@@ -91,6 +235,30 @@ class Fetcher:
         print('The fetcher instance does not have the fetchResult method configured')
         raise NotImplementedError
 
+    def ensureConnection(self):
+        """Opens the connection of the fetcher if it requires one and it is not open yet"""
+
+        pass
+
+    def explainQuery(self, details):
+        """Estimates the cost of a query without running it
+
+        :param details: details of the fetcher in the test
+        :type details: dict
+        :raises NotImplementedError: if the fetcher cannot estimate its queries
+        """
+
+        raise NotImplementedError
+
+    def isAlive(self):
+        """Returns whether the fetcher can still be used, fetchers without connections are always alive
+
+        :return: true if the fetcher can be used
+        :rtype: bool
+        """
+
+        return True
+
 
 class FetchError(Exception):
     """Exception raised if a fetcher errors out during fetching a result
@@ -107,23 +275,190 @@ class FetchError(Exception):
         return self.message
 
 
+# policies choosing the host of a postgres fetcher with several hosts
+HOST_SELECTION_POLICIES = ('ordered', 'lowestLatency', 'leastLoaded')
+
+
 class PostgresDB(Fetcher):
     """Postgres sql client for fetching results in pg dbs
 
-    :param dbconfig: connection credentials from config
+    The fetcher connects to a single host and port (defaults to 5432), or to one of a list of hosts chosen by the
+    hostSelection policy: 'ordered' tries the hosts in the order of the config, 'lowestLatency' and 'leastLoaded'
+    probe all the hosts and pick the fastest to answer or the one running the fewest active queries. With
+    preferReplica (defaults to true) hot standbys are picked before the primary. A host that cannot be reached, or
+    whose connection drops during a query, is tried last for failoverCooldown seconds (defaults to 60).
+
+    :param dbconfig: connection credentials from config, with host and port or a list of hosts, optional itersize for
+        streamed queries, prepareStatements (defaults to true) and preparedCacheSize (defaults to 256) for the prepared
+        statements cache, hostSelection, preferReplica, connectTimeout (defaults to 5 seconds) and failoverCooldown
     :type dbconfig: dict
     :param logger: logger instance
     :type logger: logger
     :param fetcherName: name to give to fetcher, used by FetcherManager
     :type fetcherName: string
+    :param perf: recorder of the connections durations, defaults to None
+    :param perf: PerfRecorder, optional
     """
 
-    def __init__(self, dbconfig, logger, fetcherName):
+    secretKeys = ('password',)
+
+    def __init__(self, dbconfig, logger, fetcherName, perf=None):
 
         self.logger = logger
+        self.perf = perf or PerfRecorder(logger)
         self.credentials = dbconfig
-        self.openConnection()
         self.fetcherName = fetcherName
+        self.itersize = int(dbconfig.get('itersize', 2000))
+        self.streamedQueries = 0
+        self.prepareStatements = bool(dbconfig.get('prepareStatements', True))
+        self.preparedCacheSize = int(dbconfig.get('preparedCacheSize', 256))
+        self.resetPreparedStatements()
+        # numbers the prepared statements, never reset so that a name is never reused on a connection
+        self.preparedCount = 0
+        self.preparedHits = 0
+        self.planningTimeSaved = 0.
+        self.hosts = self.hostsFromConfig(dbconfig)
+        self.hostSelection = dbconfig.get('hostSelection', 'ordered')
+        if self.hostSelection not in HOST_SELECTION_POLICIES:
+            raise ValueError('Unknown hostSelection {0} for fetcher {1}, expected one of {2}'.format(
+                self.hostSelection, fetcherName, ', '.join(HOST_SELECTION_POLICIES)))
+        self.preferReplica = bool(dbconfig.get('preferReplica', True))
+        self.connectTimeout = int(dbconfig.get('connectTimeout', 5))
+        self.failoverCooldown = float(dbconfig.get('failoverCooldown', 60))
+        self.failedHosts = {}
+        self.currentHost = None
+        # the connection is opened on first use so unused or unreachable dbs do not fail the whole batch
+        self.conn = None
+        self.cur = None
+        self.connectionError = None
+
+    @staticmethod
+    def hostsFromConfig(dbconfig):
+        """Lists the hosts of the fetcher, given as a single host and port or as a list of 'host:port' strings or of
+        dicts with host, port and an optional role ('primary' or 'replica') used by the ordered policy
+
+        :param dbconfig: config of the fetcher
+        :type dbconfig: dict
+        :return: list of dicts with host, port and role keys
+        :rtype: list
+        """
+
+        defaultPort = int(dbconfig.get('port', 5432))
+        hosts = []
+        for entry in dbconfig.get('hosts', [dbconfig.get('host')]):
+            if isinstance(entry, dict):
+                hosts.append({'host': entry['host'], 'port': int(entry.get('port', defaultPort)),
+                              'role': entry.get('role')})
+            else:
+                host, _, port = str(entry).partition(':')
+                hosts.append({'host': host, 'port': int(port) if port else defaultPort, 'role': None})
+        return hosts
+
+    @staticmethod
+    def hostLabel(hostConfig):
+        return '{0}:{1}'.format(hostConfig['host'], hostConfig['port'])
+
+    def connect(self, hostConfig):
+        """Opens a connection to one host
+
+        :param hostConfig: dict with host and port keys
+        :type hostConfig: dict
+        :return: connection
+        :rtype: psycopg2 connection
+        """
+
+        return psycopg2.connect(host=hostConfig['host'], port=hostConfig['port'],
+                                database=self.credentials['database'], user=self.credentials['user'],
+                                password=self.credentials['password'], connect_timeout=self.connectTimeout)
+
+    def probeHost(self, hostConfig):
+        """Connects to a host and measures how fast it answers, how many queries it is running and whether it is a
+        replica
+
+        :param hostConfig: dict with host and port keys
+        :type hostConfig: dict
+        :return: connection and dict of latency, activeQueries and replica, None and the error if it is not reachable
+        :rtype: tuple
+        """
+
+        conn = None
+        try:
+            start = time.time()
+            conn = self.connect(hostConfig)
+            cur = conn.cursor()
+            cur.execute("SELECT pg_is_in_recovery(), count(*) FROM pg_stat_activity WHERE state = 'active'")
+            replica, activeQueries = cur.fetchall()[0]
+            cur.close()
+            # leaves the transaction opened by the probe so the connection is ready for the queries
+            conn.rollback()
+            return conn, {'latency': time.time() - start, 'activeQueries': activeQueries, 'replica': replica}
+        except psycopg2.Error as err:
+            if conn is not None:
+                conn.close()
+            return None, err
+
+    def rankedHosts(self):
+        """Orders the hosts for the ordered policy: replicas first if preferReplica, hosts that failed recently last
+
+        :return: list of host dicts
+        :rtype: list
+        """
+
+        now = time.time()
+        return sorted(self.hosts, key=lambda hostConfig: (
+            now - self.failedHosts.get(self.hostLabel(hostConfig), 0) < self.failoverCooldown,
+            self.preferReplica and hostConfig['role'] != 'replica'))
+
+    def selectConnection(self):
+        """Connects to the host chosen by the hostSelection policy, failing over to the next hosts
+
+        :raises psycopg2.OperationalError: if no host can be reached
+        :return: connection and host dict
+        :rtype: tuple
+        """
+
+        errors = []
+        if self.hostSelection == 'ordered':
+            for hostConfig in self.rankedHosts():
+                try:
+                    return self.connect(hostConfig), hostConfig
+                except psycopg2.Error as err:
+                    self.markFailed(hostConfig, err)
+                    errors.append('{0}: {1}'.format(self.hostLabel(hostConfig), str(err).strip()))
+        else:
+            with ThreadPoolExecutor(max_workers=len(self.hosts)) as executor:
+                probes = list(executor.map(self.probeHost, self.hosts))
+            now = time.time()
+            candidates = []
+            for hostConfig, (conn, stats) in zip(self.hosts, probes):
+                if conn is None:
+                    self.markFailed(hostConfig, stats)
+                    errors.append('{0}: {1}'.format(self.hostLabel(hostConfig), str(stats).strip()))
+                    continue
+                load = stats['activeQueries'] if self.hostSelection == 'leastLoaded' else 0
+                candidates.append(((now - self.failedHosts.get(self.hostLabel(hostConfig), 0) < self.failoverCooldown,
+                                    self.preferReplica and not stats['replica'], load, stats['latency']),
+                                   conn, hostConfig))
+            candidates.sort(key=lambda candidate: candidate[0])
+            for _, conn, _ in candidates[1:]:
+                conn.close()
+            if len(candidates) > 0:
+                return candidates[0][1], candidates[0][2]
+        raise psycopg2.OperationalError('no host reachable, ' + '; '.join(errors))
+
+    def markFailed(self, hostConfig, err):
+        """Remembers that a host failed so it is tried last during the cooldown
+
+        :param hostConfig: dict with host and port keys
+        :type hostConfig: dict
+        :param err: error raised by the host
+        :type err: Exception
+        """
+
+        self.failedHosts[self.hostLabel(hostConfig)] = time.time()
+        if len(self.hosts) > 1:
+            self.logger.warn('Fetcher {0} failing over from {1}: {2}'.format(
+                self.fetcherName, self.hostLabel(hostConfig), str(err).strip()))
 
     def openConnection(self):
         """Opens connection to db, raise an exception if could not connect to db
@@ -131,13 +466,33 @@ class PostgresDB(Fetcher):
         """
 
         try:
-            self.conn = psycopg2.connect(host=self.credentials['host'], database=self.credentials['database'],
-                                         port=5432, user=self.credentials['user'], password=self.credentials['password'])
+            start = time.time()
+            self.conn, self.currentHost = self.selectConnection()
             self.cur = self.conn.cursor()
+            self.resetPreparedStatements()
+            self.perf.record('connection_open', time.time() - start)
+            if len(self.hosts) > 1:
+                self.logger.info('Fetcher {0} connected to {1}'.format(self.fetcherName, self.hostLabel(self.currentHost)))
         except:
             self.logger.error('could not connect to pg db')
             raise
 
+    def ensureConnection(self):
+        """Opens the connection if it is not open, a failed connection is not retried until the fetcher is closed
+
+        :raises FetchError: if the db cannot be reached
+        """
+
+        if self.connectionError is not None:
+            raise FetchError(self.connectionError)
+        if self.conn is None or self.conn.closed:
+            try:
+                self.openConnection()
+            except psycopg2.Error as err:
+                self.connectionError = 'Could not connect to {0}: {1}'.format(
+                    self.fetcherName, err)
+                raise FetchError(self.connectionError)
+
     def fetchResults(self, details):
         """fetches results from pg db using info from details
 
@@ -150,8 +505,42 @@ class PostgresDB(Fetcher):
         :rtype: int
         """
 
-        self.cur.execute(details['query'])
+        self.ensureConnection()
+        try:
+            return self.queryResults(details)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as err:
+            if not self.conn.closed:
+                # the host is still up, for example the query was cancelled by a statement timeout
+                self.conn.rollback()
+                raise FetchError('pg db error: {}'.format(str(err).strip()))
+            self.markFailed(self.currentHost, err)
+            self.close()
+        # the connection dropped during the query, it is run again once on the next host
+        self.ensureConnection()
+        try:
+            return self.queryResults(details)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as err:
+            if self.conn.closed:
+                self.markFailed(self.currentHost, err)
+                self.close()
+            else:
+                self.conn.rollback()
+            raise FetchError('pg db error: {}'.format(str(err).strip()))
+
+    def queryResults(self, details):
+        """Runs the query of the test on the open connection
+
+        :param details: dictionnary that has a query key value pair
+        :type details: dict
+        :raises FetchError: if query returns zero rows or has an sql error
+        :return: value returned by query
+        :rtype: int
+        """
+
+        if details.get('mode') == 'stream':
+            return self.streamResults(details)
         try:
+            self.executeQuery(details)
             result = self.cur.fetchall()[0][0]
         except IndexError:
             self.logger.warn(
@@ -168,7 +557,750 @@ class PostgresDB(Fetcher):
             raise FetchError('pg db error')
         return result
 
+    def explainQuery(self, details):
+        """Estimates the cost and number of rows of the query with the planner, the query is not run
+
+        :param details: dictionnary that has a query key value pair
+        :type details: dict
+        :raises FetchError: if the query has an sql error or several statements
+        :return: dict with the estimated cost, in planner units, and rows
+        :rtype: dict
+        """
+
+        self.ensureConnection()
+        statement = details['query'].strip().rstrip(';')
+        if ';' in statement:
+            raise FetchError('Cannot estimate a multi statement query')
+        try:
+            self.cur.execute('EXPLAIN (FORMAT JSON) ' + statement)
+            plan = self.cur.fetchall()[0][0][0]['Plan']
+        except psycopg2.Error as err:
+            self.conn.rollback()
+            raise FetchError('SQL Error: {}'.format(str(err).strip()))
+        # leaves the transaction so the estimates do not hold locks between queries
+        self.conn.rollback()
+        return {'cost': plan['Total Cost'], 'rows': plan['Plan Rows']}
+
+    def resetPreparedStatements(self):
+        """Forgets the prepared statements, they only live as long as the connection"""
+
+        self.preparedStatements = OrderedDict()
+        self.planningTimes = {}
+        self.unpreparableQueries = set()
+        # queries run once on the connection, prepared if they run again
+        self.seenQueries = OrderedDict()
+
+    def executeQuery(self, details):
+        """Executes the query of the test, through a server side prepared statement unless the fetcher or the test
+        opts out with prepareStatements or prepare set to false
+
+        :param details: dict with query and optional prepare keys
+        :type details: dict
+        """
+
+        query = details['query']
+        statementName = None
+        if self.prepareStatements and details.get('prepare', True):
+            statementName = self.preparedStatement(query)
+        if statementName is None:
+            self.cur.execute(query)
+            return
+        try:
+            self.cur.execute('EXECUTE ' + statementName)
+        except psycopg2.Error as err:
+            # statement deallocated behind our back, for example by a pooler
+            if err.pgcode != '26000':
+                raise
+            self.conn.rollback()
+            # the other statements may still exist, they are dropped so the cache matches the server again
+            self.cur.execute('DEALLOCATE ALL')
+            self.resetPreparedStatements()
+            self.cur.execute(query)
+
+    def preparedStatement(self, query):
+        """Returns the name of the prepared statement of the query, preparing it the second time it runs on the
+        connection, so that a query run once does not pay for the preparation, and evicting the least recently used
+        statement when the cache is full
+
+        :param query: sql query
+        :type query: string
+        :return: name of the statement, None if the query cannot be prepared
+        :rtype: string
+        """
+
+        if query in self.preparedStatements:
+            self.preparedStatements.move_to_end(query)
+            self.preparedHits += 1
+            self.planningTimeSaved += self.planningTimes[query]
+            self.perf.record('planning_saved', self.planningTimes[query])
+            return self.preparedStatements[query]
+        if query in self.unpreparableQueries:
+            return None
+        if query not in self.seenQueries:
+            self.seenQueries[query] = True
+            if len(self.seenQueries) > self.preparedCacheSize:
+                self.seenQueries.popitem(last=False)
+            return None
+        del self.seenQueries[query]
+        statement = query.strip().rstrip(';')
+        if ';' in statement:
+            # multi statement queries cannot be prepared, they are executed directly
+            self.unpreparableQueries.add(query)
+            return None
+        self.preparedCount += 1
+        statementName = 'bigeye_prepared_{}'.format(self.preparedCount)
+        try:
+            # planning time of the query, saved by each later execution of the prepared statement
+            self.cur.execute('EXPLAIN (SUMMARY TRUE, FORMAT JSON) ' + statement)
+            planningTime = self.cur.fetchall()[0][0][0].get('Planning Time', 0.) / 1000.
+            self.cur.execute('PREPARE {0} AS {1}'.format(statementName, statement))
+        except psycopg2.Error:
+            # utility queries cannot be prepared, errors of the query itself are raised again by the direct execution
+            self.conn.rollback()
+            self.unpreparableQueries.add(query)
+            return None
+        self.preparedStatements[query] = statementName
+        self.planningTimes[query] = planningTime
+        if len(self.preparedStatements) > self.preparedCacheSize:
+            evictedQuery, evictedName = self.preparedStatements.popitem(last=False)
+            del self.planningTimes[evictedQuery]
+            self.cur.execute('DEALLOCATE ' + evictedName)
+        return statementName
+
+    def streamResults(self, details):
+        """Streams the rows of the query through a named server side cursor, fetched itersize rows at a time, and
+        aggregates a column incrementally so that memory stays bounded whatever the size of the result
+
+        :param details: dict with query, aggregate (count, sum, min, max or null_fraction), column (index or name,
+            defaults to the first column) and optional itersize
+        :type details: dict
+        :raises FetchError: if the aggregate is unknown, the query has an sql error or returns zero rows
+        :return: value of the aggregate
+        :rtype: float
+        """
+
+        aggregatorType = STREAM_AGGREGATORS.get(details.get('aggregate'))
+        if aggregatorType is None:
+            raise FetchError('Unknown aggregate {}'.format(details.get('aggregate')))
+        aggregator = aggregatorType()
+        column = details.get('column', 0)
+        self.streamedQueries += 1
+        cursor = self.conn.cursor(
+            name='bigeye_stream_{}'.format(self.streamedQueries))
+        cursor.itersize = int(details.get('itersize', self.itersize))
+        try:
+            cursor.execute(details['query'])
+            columnIndex = None
+            for row in cursor:
+                if columnIndex is None:
+                    columnIndex = self.columnIndex(cursor, column)
+                aggregator.add(row[columnIndex])
+            cursor.close()
+        except FetchError:
+            cursor.close()
+            raise
+        except psycopg2.ProgrammingError as err:
+            self.logger.warn(
+                'SQL error for case {0}'.format(err.args))
+            self.conn.rollback()
+            raise FetchError('SQL Error')
+        except psycopg2.InternalError as err:
+            self.logger.error("internal pg error: {}".format(err))
+            self.conn.rollback()
+            raise FetchError('pg db error')
+        return aggregator.result()
+
+    def columnIndex(self, cursor, column):
+        """Resolves the column to aggregate in the rows of the cursor
+
+        :param cursor: cursor that has fetched at least one row
+        :type cursor: cursor
+        :param column: index or name of the column
+        :type column: int or string
+        :raises FetchError: if the column is not in the result
+        :return: index of the column
+        :rtype: int
+        """
+
+        names = [description[0] for description in cursor.description]
+        if isinstance(column, int) and 0 <= column < len(names):
+            return column
+        if column in names:
+            return names.index(column)
+        raise FetchError('Column {} not in query result'.format(column))
+
+    def isAlive(self):
+        """Checks the connection is open and answers a trivial query, a fetcher that failed to connect is reported
+        dead so that the failure is forgotten and the connection attempted again by the next invocation
+
+        :return: true if the connection can be reused
+        :rtype: bool
+        """
+
+        if self.connectionError is not None:
+            return False
+        if self.conn is None:
+            return True
+        if self.conn.closed:
+            return False
+        try:
+            self.cur.execute('SELECT 1')
+            self.cur.fetchall()
+        except psycopg2.Error:
+            return False
+        return True
+
     def close(self):
         """Closes connection to db for clean exit"""
-        self.cur.close()
-        self.conn.close()
+        if self.preparedHits > 0:
+            self.logger.info('Fetcher {0} reused prepared statements {1} times, saving {2:.3f} seconds of planning'.format(
+                self.fetcherName, self.preparedHits, self.planningTimeSaved))
+        if self.conn is not None and not self.conn.closed:
+            self.cur.close()
+            self.conn.close()
+        self.conn, self.cur, self.connectionError, self.currentHost = None, None, None, None
+
+
+class StreamAggregator:
+    """Abstract class for incremental aggregators over streamed values"""
+
+    def __init__(self):
+        self.rows = 0
+
+    def add(self, value):
+        raise NotImplementedError(
+            'The aggregator does not implement the add method')
+
+    def value(self):
+        raise NotImplementedError(
+            'The aggregator does not implement the value method')
+
+    def result(self):
+        """Returns the aggregate, aggregates other than count are undefined for zero rows
+
+        :raises FetchError: if no rows were streamed
+        :return: value of the aggregate
+        :rtype: float
+        """
+
+        if self.rows == 0:
+            raise FetchError('Query returned zero rows')
+        return self.value()
+
+
+class CountAggregator(StreamAggregator):
+    """Counts the streamed rows"""
+
+    def add(self, value):
+        self.rows += 1
+
+    def result(self):
+        return self.rows
+
+
+class SumAggregator(StreamAggregator):
+    """Sums the non null streamed values"""
+
+    def __init__(self):
+        super().__init__()
+        self.total = 0
+
+    def add(self, value):
+        self.rows += 1
+        if value is not None:
+            self.total += value
+
+    def value(self):
+        return self.total
+
+
+class MinAggregator(StreamAggregator):
+    """Keeps the smallest non null streamed value"""
+
+    def __init__(self):
+        super().__init__()
+        self.current = None
+
+    def add(self, value):
+        self.rows += 1
+        if value is not None and (self.current is None or value < self.current):
+            self.current = value
+
+    def value(self):
+        if self.current is None:
+            raise FetchError('Query returned only null values')
+        return self.current
+
+
+class MaxAggregator(MinAggregator):
+    """Keeps the largest non null streamed value"""
+
+    def add(self, value):
+        self.rows += 1
+        if value is not None and (self.current is None or value > self.current):
+            self.current = value
+
+
+class NullFractionAggregator(StreamAggregator):
+    """Computes the fraction of null streamed values"""
+
+    def __init__(self):
+        super().__init__()
+        self.nulls = 0
+
+    def add(self, value):
+        self.rows += 1
+        if value is None:
+            self.nulls += 1
+
+    def value(self):
+        return self.nulls / float(self.rows)
+
+
+STREAM_AGGREGATORS = {'count': CountAggregator, 'sum': SumAggregator, 'min': MinAggregator,
+                      'max': MaxAggregator, 'null_fraction': NullFractionAggregator}
+
+
+class RateLimiter:
+    """Spaces calls to at most a given number per second, thread safe
+
+    :param callsPerSecond: maximum rate of calls
+    :type callsPerSecond: float
+    """
+
+    def __init__(self, callsPerSecond):
+        self.interval = 1. / float(callsPerSecond)
+        self.nextSlot = 0.
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until the next call is allowed"""
+
+        with self.lock:
+            now = time.time()
+            self.nextSlot = max(self.nextSlot, now)
+            wait = self.nextSlot - now
+            self.nextSlot += self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class JSONPathExtractor:
+    """Extracts a value from a json document with a JSONPath style expression such as $.data.items[0].count,
+    $['key with spaces'], $.items[*].count or $.items.length()
+
+    :param expression: path expression starting with $
+    :type expression: string
+    """
+
+    tokenPattern = re.compile(
+        r"\.length\(\)|\.([A-Za-z_][\w-]*)|\[(-?\d+)\]|\[\*\]|\['([^']*)'\]|\[\"([^\"]*)\"\]")
+
+    def __init__(self, expression):
+        self.expression = expression
+        if not expression.startswith('$'):
+            raise FetchError('JSONPath expression {} should start with $'.format(expression))
+        self.steps = []
+        position = 1
+        while position < len(expression):
+            match = self.tokenPattern.match(expression, position)
+            if match is None:
+                raise FetchError('Could not parse JSONPath expression {}'.format(expression))
+            key, index, quoted, doubleQuoted = match.groups()
+            if key is not None:
+                self.steps.append(('key', key))
+            elif index is not None:
+                self.steps.append(('index', int(index)))
+            elif quoted is not None or doubleQuoted is not None:
+                self.steps.append(('key', quoted if quoted is not None else doubleQuoted))
+            elif match.group(0) == '[*]':
+                self.steps.append(('wildcard', None))
+            else:
+                self.steps.append(('length', None))
+            position = match.end()
+
+    def extract(self, document):
+        """Applies the expression to the document
+
+        :param document: parsed json
+        :type document: dict or list
+        :raises FetchError: if the path does not exist in the document
+        :return: value at the path, a list when the path contains a wildcard
+        :rtype: object
+        """
+
+        values, spread = [document], False
+        for step, argument in self.steps:
+            try:
+                if step in ('key', 'index'):
+                    values = [value[argument] for value in values]
+                elif step == 'wildcard':
+                    values = [item for value in values for item in (
+                        value.values() if isinstance(value, dict) else value)]
+                    spread = True
+                else:
+                    values = [len(values) if spread else len(values[0])]
+                    spread = False
+            except (KeyError, IndexError, TypeError):
+                raise FetchError('Path {} not found in response'.format(self.expression))
+        return values if spread else values[0]
+
+
+class HTTPAPI(Fetcher):
+    """Fetcher for http json apis, requests go through a pooled keep alive session and run concurrently
+
+    :param apiConfig: config with baseUrl and optional headers, timeout, maxConcurrency, rateLimits (requests per second per host) and defaultRateLimit
+    :type apiConfig: dict
+    :param logger: logger instance
+    :type logger: logger
+    :param fetcherName: name to give to fetcher, used by FetcherManager
+    :type fetcherName: string
+    :param perf: recorder of the stages durations, defaults to None
+    :param perf: PerfRecorder, optional
+    """
+
+    supportsConcurrency = True
+
+    def __init__(self, apiConfig, logger, fetcherName, perf=None):
+        self.logger = logger
+        self.fetcherName = fetcherName
+        self.perf = perf or PerfRecorder(logger)
+        self.baseUrl = apiConfig['baseUrl']
+        self.timeout = float(apiConfig.get('timeout', 10))
+        self.maxConcurrency = int(apiConfig.get('maxConcurrency', 8))
+        self.rateLimits = dict(apiConfig.get('rateLimits', {}))
+        self.defaultRateLimit = apiConfig.get('defaultRateLimit')
+        self.rateLimiters = {}
+        self.rateLimitersLock = threading.Lock()
+        self.extractors = {}
+        self.session = requests.Session()
+        self.session.headers.update(dict(apiConfig.get('headers', {})))
+        adapter = HTTPAdapter(pool_connections=self.maxConcurrency,
+                              pool_maxsize=self.maxConcurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = None
+
+    def rateLimiter(self, host):
+        """Returns the rate limiter of a host, None if the host is not rate limited
+
+        :param host: host and port of the request
+        :type host: string
+        :return: rate limiter
+        :rtype: RateLimiter
+        """
+
+        with self.rateLimitersLock:
+            if host not in self.rateLimiters:
+                limit = self.rateLimits.get(host, self.defaultRateLimit)
+                self.rateLimiters[host] = RateLimiter(limit) if limit else None
+            return self.rateLimiters[host]
+
+    def extractor(self, expression):
+        """Returns the compiled extractor of an expression
+
+        :param expression: JSONPath style expression
+        :type expression: string
+        :return: extractor
+        :rtype: JSONPathExtractor
+        """
+
+        if expression not in self.extractors:
+            self.extractors[expression] = JSONPathExtractor(expression)
+        return self.extractors[expression]
+
+    def fetchResults(self, details):
+        """Requests the url in details and extracts the result value from the json response
+
+        :param details: dict with a path relative to baseUrl or a url, and optional method, params, json and extract keys
+        :type details: dict
+        :raises FetchError: if the request fails, the response is not json or the extracted value is not a number
+        :return: extracted value
+        :rtype: float
+        """
+
+        url = details['url'] if 'url' in details else urljoin(
+            self.baseUrl, details.get('path', ''))
+        limiter = self.rateLimiter(urlparse(url).netloc)
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            resp = self.session.request(details.get('method', 'GET'), url, params=details.get('params'),
+                                        json=details.get('json'), timeout=self.timeout)
+            resp.raise_for_status()
+            document = resp.json()
+        except (requests.RequestException, ValueError) as err:
+            self.logger.warning('request to {0} failed: {1}'.format(url, err))
+            raise FetchError('HTTP Error')
+        value = self.extractor(details.get('extract', '$')).extract(document)
+        if isinstance(value, bool):
+            return int(value)
+        if isinstance(value, (int, float)):
+            return value
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise FetchError('Extracted value {} is not a number'.format(value))
+
+    def timedFetch(self, details):
+        """Fetches the result and measures the duration of the request, run in the request threads
+
+        :param details: details of the fetcher in the test
+        :type details: dict
+        :return: result and duration
+        :rtype: tuple
+        """
+
+        start = time.time()
+        result = self.fetchResults(details)
+        return result, time.time() - start
+
+    def submit(self, details):
+        """Submits a fetch to the request threads
+
+        :param details: details of the fetcher in the test
+        :type details: dict
+        :return: future resolving to the result and duration of the fetch
+        :rtype: Future
+        """
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.maxConcurrency)
+        return self.executor.submit(self.timedFetch, details)
+
+    def close(self):
+        """Waits for pending requests and closes the session"""
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.session.close()
+
+
+class ArrowDataset:
+    """Dataset held in an arrow table, backed by a memory map for arrow and parquet files, aggregates are vectorized
+
+    :param table: arrow table
+    :type table: pyarrow.Table
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.numRows = table.num_rows
+
+    def column(self, name):
+        """Returns the column of given name, raises FetchError if it does not exist"""
+
+        if name not in self.table.column_names:
+            raise FetchError('Column {} not in dataset'.format(name))
+        return self.table.column(name)
+
+    def count(self, name):
+        """Number of rows, or of non null values of the column if a column is given"""
+
+        return self.numRows if name is None else pyarrow.compute.count(self.column(name)).as_py()
+
+    def nullRatio(self, name):
+        """Ratio of null values in the column"""
+
+        return self.column(name).null_count / float(self.numRows)
+
+    def sum(self, name):
+        """Sum of the non null values of the column"""
+
+        return pyarrow.compute.sum(self.column(name)).as_py() or 0
+
+    def distinct(self, name):
+        """Number of distinct non null values of the column"""
+
+        return pyarrow.compute.count_distinct(self.column(name)).as_py()
+
+
+class CSVDataset:
+    """Dataset streamed from a memory mapped csv file without pyarrow, each aggregate scans the file once and only
+    keeps the values of its column, empty values are nulls
+
+    :param path: path of the csv file
+    :type path: string
+    :param delimiter: delimiter of the fields
+    :type delimiter: string
+    """
+
+    def __init__(self, path, delimiter):
+        self.path = path
+        self.delimiter = delimiter
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise FetchError('File {} is empty'.format(path))
+        self.header = next(self.rows())
+        self.rowsCount = None
+
+    def rows(self):
+        """Yields the parsed rows of the file, header included"""
+
+        with open(self.path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                lines = (line.decode('utf-8') for line in iter(mapped.readline, b''))
+                for row in csv.reader(lines, delimiter=self.delimiter):
+                    yield row
+
+    def values(self, name):
+        """Yields the values of the column of given name, raises FetchError if it does not exist"""
+
+        if name not in self.header:
+            raise FetchError('Column {} not in dataset'.format(name))
+        index = self.header.index(name)
+        rows = self.rows()
+        next(rows)
+        for row in rows:
+            yield row[index] if index < len(row) else ''
+
+    @property
+    def numRows(self):
+        """Number of rows, counted on first use"""
+
+        if self.rowsCount is None:
+            self.rowsCount = sum(1 for _ in self.rows()) - 1
+        return self.rowsCount
+
+    def count(self, name):
+        """Number of rows, or of non null values of the column if a column is given"""
+
+        return self.numRows if name is None else sum(1 for value in self.values(name) if value != '')
+
+    def nullRatio(self, name):
+        """Ratio of null values in the column"""
+
+        return sum(1 for value in self.values(name) if value == '') / float(self.numRows)
+
+    def sum(self, name):
+        """Sum of the non null values of the column"""
+
+        try:
+            return sum(float(value) for value in self.values(name) if value != '')
+        except ValueError:
+            raise FetchError('Column {} is not numeric'.format(name))
+
+    def distinct(self, name):
+        """Number of distinct non null values of the column"""
+
+        return len(set(value for value in self.values(name) if value != ''))
+
+
+class ColumnarFile(Fetcher):
+    """Fetcher evaluating aggregates on local csv, parquet or arrow files, opened datasets are cached until the fetcher
+    is closed or the file changes so that the tests of a batch share them
+
+    :param fileConfig: config with an optional rootPath that file paths are relative to
+    :type fileConfig: dict
+    :param logger: logger instance
+    :type logger: logger
+    :param fetcherName: name to give to fetcher, used by FetcherManager
+    :type fetcherName: string
+    :param perf: recorder of the stages durations, defaults to None
+    :param perf: PerfRecorder, optional
+    """
+
+    formats = {'.csv': 'csv', '.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow', '.ipc': 'arrow'}
+    aggregates = {'count': 'count', 'null_ratio': 'nullRatio', 'sum': 'sum', 'distinct': 'distinct'}
+
+    def __init__(self, fileConfig, logger, fetcherName, perf=None):
+        self.logger = logger
+        self.fetcherName = fetcherName
+        self.perf = perf or PerfRecorder(logger)
+        self.rootPath = fileConfig.get('rootPath', '.')
+        self.datasets = {}
+
+    def openDataset(self, path, fileFormat, delimiter):
+        """Opens a dataset, memory mapping the file
+
+        :param path: path of the file
+        :type path: string
+        :param fileFormat: 'csv', 'parquet' or 'arrow'
+        :type fileFormat: string
+        :param delimiter: delimiter of csv files
+        :type delimiter: string
+        :raises FetchError: if the format needs pyarrow and it is not installed
+        :return: dataset
+        :rtype: ArrowDataset or CSVDataset
+        """
+
+        if pyarrow is None:
+            if fileFormat != 'csv':
+                raise FetchError('pyarrow is required to read {} files'.format(fileFormat))
+            return CSVDataset(path, delimiter)
+        if fileFormat == 'parquet':
+            table = pyarrow.parquet.read_table(path, memory_map=True)
+        elif fileFormat == 'arrow':
+            table = pyarrow.ipc.open_file(pyarrow.memory_map(path, 'r')).read_all()
+        else:
+            # empty strings are nulls as in the csv fallback
+            table = pyarrow.csv.read_csv(pyarrow.memory_map(path, 'r'),
+                                         parse_options=pyarrow.csv.ParseOptions(delimiter=delimiter),
+                                         convert_options=pyarrow.csv.ConvertOptions(strings_can_be_null=True))
+        return ArrowDataset(table)
+
+    def dataset(self, details):
+        """Returns the cached dataset of the file in details, opening it if it is not cached or has changed
+
+        :param details: details of the fetcher in the test
+        :type details: dict
+        :raises FetchError: if the file does not exist or its format is unknown
+        :return: dataset
+        :rtype: ArrowDataset or CSVDataset
+        """
+
+        path = os.path.join(self.rootPath, details['file'])
+        fileFormat = details.get('format', self.formats.get(os.path.splitext(path)[1].lower()))
+        if fileFormat not in ('csv', 'parquet', 'arrow'):
+            raise FetchError('Unknown format for file {}'.format(path))
+        try:
+            modificationTime = os.path.getmtime(path)
+        except OSError:
+            raise FetchError('File {} does not exist'.format(path))
+        delimiter = details.get('delimiter', ',')
+        key = (path, fileFormat, delimiter)
+        cached = self.datasets.get(key)
+        if cached is None or cached[0] != modificationTime:
+            start = time.time()
+            cached = (modificationTime, self.openDataset(path, fileFormat, delimiter))
+            self.datasets[key] = cached
+            self.perf.record('dataset_open', time.time() - start)
+        return cached[1]
+
+    def fetchResults(self, details):
+        """Evaluates the aggregate in details on a column of the file
+
+        :param details: dict with file, aggregate (count, null_ratio, sum or distinct), column (optional for count), and optional format and delimiter
+        :type details: dict
+        :raises FetchError: if the aggregate is unknown, the column does not exist, the dataset is empty or the file
+            cannot be read
+        :return: value of the aggregate
+        :rtype: float
+        """
+
+        aggregate = self.aggregates.get(details.get('aggregate'))
+        if aggregate is None:
+            raise FetchError('Unknown aggregate {}'.format(details.get('aggregate')))
+        if 'file' not in details:
+            raise FetchError('Fetcher details need a file')
+        column = details.get('column')
+        if column is None and aggregate != 'count':
+            raise FetchError('Aggregate {} needs a column'.format(details['aggregate']))
+        try:
+            dataset = self.dataset(details)
+            if dataset.numRows == 0 and aggregate != 'count':
+                raise FetchError('Dataset returned zero rows')
+            return getattr(dataset, aggregate)(column)
+        except DATASET_ERRORS as err:
+            raise FetchError('Could not read file {0}: {1}'.format(details['file'], err))
+
+    def close(self):
+        """Releases the cached datasets and their memory maps"""
+
+        self.datasets = {}
+
+
+FetcherManager.fetcherTypes['PostgresDB'] = PostgresDB
+FetcherManager.fetcherTypes['HTTPAPI'] = HTTPAPI
+FetcherManager.fetcherTypes['ColumnarFile'] = ColumnarFile
@@ -0,0 +1,229 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from json import dumps
+import math
+import time
+
+# marker of the structured timing records in the logs, parsed by bigeye.timeline
+TIMING_MARKER = 'BIGEYE_TIMING'
+
+# upper bounds in seconds of the fetchers latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+
+class PerfRecorder:
+    """Records the duration of each stage of a run, and the latency of each query per fetcher
+
+    Stages recorded by BigEye are config_load, yaml_load, test_build, connection_open, query, compute,
+    message_build and publish_send.
+
+    :param logger: logger instance
+    :type logger: logger
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.reset()
+
+    def reset(self):
+        """Forgets the recorded durations, called at the start of each run by a reused instance"""
+
+        self.durations = defaultdict(list)
+        self.fetcherLatencies = defaultdict(list)
+
+    def record(self, stage, duration, fetcherName=None):
+        """Records the duration of a stage
+
+        :param stage: name of the stage
+        :type stage: string
+        :param duration: duration in seconds
+        :type duration: float
+        :param fetcherName: name of the fetcher for per fetcher stages, defaults to None
+        :param fetcherName: str, optional
+        """
+
+        self.durations[stage].append(duration)
+        if fetcherName is not None:
+            self.fetcherLatencies[fetcherName].append(duration)
+
+    @contextmanager
+    def timeStage(self, stage, fetcherName=None):
+        """Context manager recording the duration of the enclosed block
+
+        :param stage: name of the stage
+        :type stage: string
+        :param fetcherName: name of the fetcher for per fetcher stages, defaults to None
+        :param fetcherName: str, optional
+        """
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, time.time() - start, fetcherName)
+
+    @staticmethod
+    def percentile(values, q):
+        """Returns the q-th percentile of values with nearest rank
+
+        :param values: sorted list of values
+        :type values: list
+        :param q: percentile between 0 and 100
+        :type q: float
+        :return: percentile value
+        :rtype: float
+        """
+
+        if len(values) == 0:
+            return 0.
+        rank = max(int(math.ceil(q / 100. * len(values))) - 1, 0)
+        return values[min(rank, len(values) - 1)]
+
+    @staticmethod
+    def histogram(values):
+        """Counts values per latency bucket
+
+        :param values: list of durations in seconds
+        :type values: list
+        :return: dict of bucket upper bound to count
+        :rtype: dict
+        """
+
+        counts = dict((bound, 0) for bound in LATENCY_BUCKETS)
+        for value in values:
+            for bound in LATENCY_BUCKETS:
+                if value <= bound:
+                    counts[bound] += 1
+                    break
+        return counts
+
+    def describe(self, values):
+        """Summarises a list of durations
+
+        :param values: list of durations in seconds
+        :type values: list
+        :return: dict of count, total, p50, p95 and p99
+        :rtype: dict
+        """
+
+        values = sorted(values)
+        return {'count': len(values), 'total': sum(values),
+                'p50': self.percentile(values, 50), 'p95': self.percentile(values, 95),
+                'p99': self.percentile(values, 99)}
+
+    def checkpoint(self):
+        """Returns the number of durations recorded so far for each stage and fetcher, summaries given a checkpoint
+        only cover what was recorded after it, for example the current batch of a reused instance
+
+        :return: tuple of dicts of stage and fetcher name to number of durations
+        :rtype: tuple
+        """
+
+        return (dict((stage, len(values)) for stage, values in self.durations.items()),
+                dict((fetcherName, len(values)) for fetcherName, values in self.fetcherLatencies.items()))
+
+    def summary(self, since=None):
+        """Returns the summary of each stage and of the query latency of each fetcher
+
+        :param since: checkpoint from which durations are summarised, defaults to None for all of them
+        :param since: tuple, optional
+        :return: dict with a 'stages' and a 'fetchers' dict, fetchers summaries include their latency histogram
+        :rtype: dict
+        """
+
+        stagesStart, fetchersStart = since or ({}, {})
+        stages = {}
+        for stage, values in self.durations.items():
+            values = values[stagesStart.get(stage, 0):]
+            if len(values) > 0:
+                stages[stage] = self.describe(values)
+        fetchers = {}
+        for fetcherName, values in self.fetcherLatencies.items():
+            values = values[fetchersStart.get(fetcherName, 0):]
+            if len(values) > 0:
+                fetchers[fetcherName] = self.describe(values)
+                fetchers[fetcherName]['histogram'] = self.histogram(values)
+        return {'stages': stages, 'fetchers': fetchers}
+
+    @staticmethod
+    def bucketLabel(bound):
+        """Formats the upper bound of a latency bucket
+
+        :param bound: upper bound in seconds
+        :type bound: float
+        :return: label such as '0.25' or 'inf'
+        :rtype: string
+        """
+
+        return 'inf' if math.isinf(bound) else '{:g}'.format(bound)
+
+    def logSummary(self, since=None):
+        """Logs one line per stage and two per fetcher, its latency percentiles and histogram
+
+        :param since: checkpoint from which durations are summarised, defaults to None for all of them
+        :param since: tuple, optional
+        """
+
+        summary = self.summary(since)
+        for stage, stats in sorted(summary['stages'].items()):
+            self.logger.info('Stage {0}: {1} calls, {2:.3f} s total, p50 {3:.3f} s, p95 {4:.3f} s, p99 {5:.3f} s'.format(
+                stage, stats['count'], stats['total'], stats['p50'], stats['p95'], stats['p99']))
+        for fetcherName, stats in sorted(summary['fetchers'].items()):
+            self.logger.info('Fetcher {0}: {1} queries, p50 {2:.3f} s, p95 {3:.3f} s, p99 {4:.3f} s'.format(
+                fetcherName, stats['count'], stats['p50'], stats['p95'], stats['p99']))
+            self.logger.info('Fetcher {0} latency histogram in seconds: {1}'.format(fetcherName, ', '.join(
+                '<={0}: {1}'.format(self.bucketLabel(bound), stats['histogram'][bound]) for bound in LATENCY_BUCKETS)))
+
+    def timingRecord(self, kind, start, end, **fields):
+        """Logs a structured timing record tagged with the run and batch ids of the logger, the records of all the
+        lambdas of a run are assembled in a timeline by bigeye.timeline
+
+        :param kind: kind of span, 'dispatch', 'invoke' or 'batch'
+        :type kind: string
+        :param start: start timestamp
+        :type start: float
+        :param end: end timestamp
+        :type end: float
+        """
+
+        record = {'kind': kind, 'start': start, 'end': end}
+        context = getattr(self.logger, 'extra', {})
+        record['runId'] = context.get('runId')
+        record['batchId'] = fields.pop('batchId', context.get('batchId'))
+        record.update(fields)
+        self.logger.info('{0} {1}'.format(TIMING_MARKER, dumps(record, sort_keys=True)))
+
+    def stageTotals(self):
+        """Returns the total duration of each stage
+
+        :return: dict of stage to seconds
+        :rtype: dict
+        """
+
+        return dict((stage, sum(values)) for stage, values in self.durations.items())
+
+    def toMetrics(self, prefix='BigEye.perf', since=None):
+        """Builds self monitoring messages in the same format as the datadog publisher messages
+
+        :param prefix: prefix of the metric names, defaults to 'BigEye.perf'
+        :param prefix: str, optional
+        :param since: checkpoint from which durations are summarised, defaults to None for all of them
+        :param since: tuple, optional
+        :return: list of message dicts
+        :rtype: list
+        """
+
+        metrics = []
+        summary = self.summary(since)
+        for stage, stats in summary['stages'].items():
+            for stat in ('count', 'total', 'p50', 'p95', 'p99'):
+                metrics.append({'metric': prefix + '.' + stage, 'points': stats[stat],
+                                'tags': {'stat': stat}})
+        for fetcherName, stats in summary['fetchers'].items():
+            for stat in ('count', 'p50', 'p95', 'p99'):
+                metrics.append({'metric': prefix + '.query_latency', 'points': stats[stat],
+                                'tags': {'stat': stat, 'fetcher': fetcherName}})
+            for bound in LATENCY_BUCKETS:
+                metrics.append({'metric': prefix + '.query_latency_bucket', 'points': stats['histogram'][bound],
+                                'tags': {'fetcher': fetcherName, 'upper_bound': self.bucketLabel(bound)}})
+        return metrics
@@ -0,0 +1,54 @@
+import cProfile
+import os
+import pstats
+import time
+import tracemalloc
+
+
+class Profiler:
+    """Context manager profiling the enclosed block with cProfile and tracemalloc, writes a pstats file and a report
+    of the top allocations to the output directory when the block exits
+
+    :param outputDir: directory where the reports are written, created if needed
+    :type outputDir: string
+    :param label: prefix of the reports file names, for example the role of the instance
+    :type label: string
+    :param logger: logger instance
+    :type logger: logger
+    :param topAllocations: number of allocation sites listed in the report, defaults to 25
+    :param topAllocations: int, optional
+    """
+
+    def __init__(self, outputDir, label, logger, topAllocations=25):
+        self.outputDir = outputDir
+        self.label = label
+        self.logger = logger
+        self.topAllocations = topAllocations
+
+    def __enter__(self):
+        os.makedirs(self.outputDir, exist_ok=True)
+        tracemalloc.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        # the run and batch ids of the logger and the pid keep concurrent slaves from overwriting each other's reports
+        context = getattr(self.logger, 'extra', {})
+        parts = [self.label, time.strftime('%Y%m%dT%H%M%S'), context.get('runId'), context.get('batchId'), os.getpid()]
+        prefix = os.path.join(self.outputDir, '-'.join(str(part) for part in parts if part is not None))
+        self.profile.dump_stats(prefix + '.pstats')
+        with open(prefix + '-allocations.txt', 'w') as f:
+            f.write('Peak traced memory: {0:.1f} MB\n'.format(peak / 1e6))
+            for stat in snapshot.statistics('lineno')[:self.topAllocations]:
+                f.write(str(stat) + '\n')
+            f.write('\n')
+            stats = pstats.Stats(self.profile, stream=f)
+            stats.sort_stats('cumulative').print_stats(self.topAllocations)
+        self.logger.info('Wrote profiling reports {0}.pstats and {0}-allocations.txt, peak memory {1:.1f} MB'.format(
+            prefix, peak / 1e6))
+        return False
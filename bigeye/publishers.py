@@ -1,5 +1,26 @@
 from datadog import initialize, api
+from datadog.api.exceptions import DatadogException
+import requests
+from collections import OrderedDict
+from datetime import datetime
+from glob import glob, escape as escapeGlob
+from json import dumps, load
+import gzip
+from urllib.parse import quote
+import math
+import os
+import re
+import socket
+import tempfile
 import time
+from .instrumentation import PerfRecorder
+
+try:
+    # optional, needed to write the results in parquet files
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 
 class PublisherManager:
@@ -9,17 +30,25 @@ class PublisherManager:
         :type config: Config
         :param logger: Logger instance
         :type logger: logger
+        :param perf: recorder of the stages durations, defaults to a new PerfRecorder
+        :param perf: PerfRecorder, optional
     """
 
-    def __init__(self, config, logger):
+    # publisher classes by type name in the config, filled in below the publishers definitions
+    publisherTypes = {}
+
+    def __init__(self, config, logger, perf=None):
         self.config = config
         self.logger = logger
-        publishersToInit = config.getValue('runConfiguration', 'publishers')
+        self.perf = perf or PerfRecorder(logger)
+        publishersToInit = config.run.publishers
         self.publishers = []
         for publisher in publishersToInit:
-            if config.getValue('Publishers', publisher, 'type') == 'Datadog':
-                self.publishers.append(DatadogPublisher(
-                    config.getValue('Publishers',  publisher), logger, publisher))
+            publisherType = self.publisherTypes.get(
+                config.getValue('Publishers', publisher, 'type'))
+            if publisherType is not None:
+                self.publishers.append(publisherType(
+                    config.getValue('Publishers',  publisher), logger, publisher, self.perf))
 
     def extractPublisher(self, publisherName):
         """returns a publisher that has a matching name
@@ -64,6 +93,22 @@ class PublisherManager:
             except PublishError:
                 pass
 
+    def publishMetrics(self, metrics):
+        """Publishes self monitoring metrics through the publishers that support it
+
+        :param metrics: list of message dicts with metric, points and tags
+        :type metrics: list
+        """
+
+        for p in self.publishers:
+            try:
+                p.publishMetrics(metrics)
+            except NotImplementedError:
+                pass
+            except PublishError as err:
+                self.logger.warning(
+                    'Could not publish self monitoring metrics with {0}: {1}'.format(p.name, err))
+
     def updatePublishers(self, tests):
         """updates the publishers of given tests
 
@@ -89,10 +134,17 @@ class PublisherManager:
 class Publisher:
     """Abstract class for interface like behaviour for publishers, not supposed to be instanciated"""
 
+    # config keys decrypted from the [publisherName]_[key] environment variables in prod
+    secretKeys = ()
+
     def publishResults(self, tests):
         raise NotImplementedError(
             'The publisher instance does not implement the publishResults method')
 
+    def publishMetrics(self, metrics):
+        raise NotImplementedError(
+            'The publisher instance does not implement the publishMetrics method')
+
     def update(self, tests):
         raise NotImplementedError(
             'The publisher instance does not implement the update method')
@@ -112,29 +164,314 @@ class PublishError(Exception):
         return self.message
 
 
+# series emitted per test by the datadog publishers: the detailed series named after the test, the summary series
+# of the dashboard tagged with test_name, or both
+EMISSION_MODES = ('both', 'detailed', 'summary')
+# aggregates of the results of a batch computed before publishing, per team or per dashboard
+ROLLUP_GROUPS = ('team', 'dashboard')
+ROLLUP_AGGREGATES = ('sum', 'count', 'min', 'max')
+
+
+class MetricSpool:
+    """Write ahead spool of the batches of messages a publisher could not send, each batch is a json file in the
+    spool folder, replayed oldest first by the next publish
+
+    The spool keeps at most maxBytes of batches, the oldest are dropped first, and batches older than maxAge seconds
+    are dropped when replayed, as datadog rejects points too far in the past. A batch is claimed by renaming it before
+    it is replayed, so publishers sharing the spool never send the same batch twice.
+
+    :param path: folder of the spooled batches, created if needed
+    :type path: string
+    :param logger: logger instance
+    :type logger: logger
+    :param maxBytes: maximum size of the spool, defaults to 50 MB
+    :param maxBytes: int, optional
+    :param maxAge: age in seconds after which a batch is dropped, defaults to 3600
+    :param maxAge: float, optional
+    """
+
+    def __init__(self, path, logger, maxBytes=50000000, maxAge=3600):
+        self.path = path
+        self.logger = logger
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.spooledCount = 0
+        os.makedirs(path, exist_ok=True)
+
+    def batchFiles(self):
+        """Lists the spooled batches, oldest first
+
+        :return: list of paths
+        :rtype: list of strings
+        """
+
+        # file names start with a zero padded timestamp so they sort in spooling order
+        return sorted(glob(os.path.join(self.path, '*.json')))
+
+    def depth(self):
+        """Returns the number of batches waiting in the spool
+
+        :return: number of batches
+        :rtype: int
+        """
+
+        return len(self.batchFiles())
+
+    def spool(self, messages, spooledAt):
+        """Persists a batch of messages, with their points stamped with the time of the failed publish so they keep
+        their original timestamps when replayed
+
+        :param messages: list of message dicts with metric, points and tags
+        :type messages: list
+        :param spooledAt: timestamp of the failed publish
+        :type spooledAt: float
+        """
+
+        stamped = []
+        for msg in messages:
+            msg = dict(msg)
+            if not isinstance(msg['points'], (list, tuple)):
+                msg['points'] = [(spooledAt, msg['points'])]
+            stamped.append(msg)
+        self.spooledCount += 1
+        name = '{0:020d}-{1}-{2}.json'.format(int(spooledAt * 1e6), os.getpid(), self.spooledCount)
+        # written under a temporary name so a crash never leaves a partial batch to replay
+        temporaryPath = os.path.join(self.path, '.' + name + '.tmp')
+        with open(temporaryPath, 'w') as f:
+            f.write(dumps({'spooledAt': spooledAt, 'messages': stamped}, default=str))
+        os.replace(temporaryPath, os.path.join(self.path, name))
+        self.enforceSize()
+
+    def enforceSize(self):
+        """Drops the oldest batches while the spool is over maxBytes"""
+
+        files, sizes = [], []
+        for path in self.batchFiles():
+            try:
+                sizes.append(os.path.getsize(path))
+                files.append(path)
+            except OSError:
+                # claimed by a publisher replaying the spool
+                pass
+        total, dropped = sum(sizes), 0
+        while total > self.maxBytes and len(files) > 1:
+            self.discard(files.pop(0))
+            total -= sizes.pop(0)
+            dropped += 1
+        if dropped > 0:
+            self.logger.warning('Spool {0} is full, dropped the {1} oldest batches'.format(self.path, dropped))
+
+    @staticmethod
+    def discard(path):
+        """Removes a batch file, ignored if another publisher already removed it
+
+        :param path: path of the batch file
+        :type path: string
+        """
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def replay(self, sendBatch):
+        """Sends the spooled batches oldest first, a batch that fails is kept for the next publish unless the api
+        rejected it, and the following batches are still sent
+
+        :param sendBatch: function sending a list of messages and returning a response with an errors key on failure,
+            and a retryable key set to false if the batch was rejected and must not be sent again
+        :type sendBatch: function
+        :return: number of batches replayed
+        :rtype: int
+        """
+
+        replayed = 0
+        # batches claimed by a publisher that died while replaying them
+        for claimedPath in glob(os.path.join(self.path, '*.json.replaying')):
+            try:
+                if time.time() - os.path.getmtime(claimedPath) > self.maxAge:
+                    self.discard(claimedPath)
+            except OSError:
+                pass
+        for path in self.batchFiles():
+            claimedPath = path + '.replaying'
+            try:
+                # atomic, only one of the publishers sharing the spool claims the batch
+                os.rename(path, claimedPath)
+            except OSError:
+                continue
+            try:
+                with open(claimedPath) as f:
+                    batch = load(f)
+            except (OSError, ValueError) as err:
+                self.logger.warning('Dropped unreadable spooled batch {0}: {1}'.format(path, err))
+                self.discard(claimedPath)
+                continue
+            if time.time() - batch['spooledAt'] > self.maxAge:
+                self.logger.warning('Dropped spooled batch {} older than the max age'.format(path))
+                self.discard(claimedPath)
+                continue
+            try:
+                resp = sendBatch(batch['messages'])
+            except DatadogException as err:
+                resp = {'errors': [str(err)], 'retryable': True}
+            if 'errors' not in resp:
+                self.discard(claimedPath)
+                replayed += 1
+            elif resp.get('retryable', True):
+                self.logger.warning('Could not replay spooled batch {0}, kept for the next publish: {1}'.format(
+                    path, resp['errors']))
+                try:
+                    os.rename(claimedPath, path)
+                except OSError:
+                    pass
+            else:
+                self.logger.warning('Dropped spooled batch {0} rejected by the api: {1}'.format(path, resp['errors']))
+                self.discard(claimedPath)
+        return replayed
+
+
 class DatadogPublisher(Publisher):
     """Publisher for datadog metrics and dashboards
 
-        :param datadogConfig: dict containing apiKey, appKey and batchsize
+        :param datadogConfig: dict containing apiKey, appKey and batchsize, and optional spoolPath (defaults to
+            /tmp/bigeye-spool/[publisherName]), spoolMaxBytes and spoolMaxAge for the batches that could not be sent,
+            spoolPath set to false turns the spool off, compressPayloads to send the results as pre-serialized gzip
+            compressed payloads instead of through the datadog client, emission ('both', 'detailed' or 'summary',
+            can be overridden per test) and rollups, a list of dicts with by ('team' or 'dashboard') and aggregate
+            ('sum', 'count', 'min' or 'max')
         :type datadogConfig: dict
         :param logger: logger instance
         :type logger: logger
         :param publisherName: name to give this instance
         :type publisherName: string
+        :param perf: recorder of the stages durations, defaults to None
+        :param perf: PerfRecorder, optional
         """
 
-    def __init__(self, datadogConfig, logger, publisherName):
+    secretKeys = ('apiKey', 'appKey')
+
+    def __init__(self, datadogConfig, logger, publisherName, perf=None):
+        # apiHost is only needed to point the client to another endpoint, such as a local stand-in for benchmarks
         initialize(api_key=datadogConfig['apiKey'],
-                   app_key=datadogConfig['appKey'])
+                   app_key=datadogConfig['appKey'],
+                   api_host=datadogConfig.get('apiHost'))
         self.batchSize = int(datadogConfig['batchSize'])
         self.config = datadogConfig
         self.logger = logger
+        self.perf = perf or PerfRecorder(logger)
         self.publisherType = 'Datadog'
         self.name = publisherName
+        spoolPath = datadogConfig.get('spoolPath', os.path.join('/tmp/bigeye-spool', publisherName))
+        self.spool = None
+        if spoolPath:
+            self.spool = MetricSpool(spoolPath, logger, int(datadogConfig.get('spoolMaxBytes', 50000000)),
+                                     float(datadogConfig.get('spoolMaxAge', 3600)))
+        self.compressPayloads = bool(datadogConfig.get('compressPayloads', False))
+        self.emission, self.rollups = self.emissionSettings(datadogConfig, publisherName)
+        self.seriesUrl = (datadogConfig.get('apiHost') or 'https://api.datadoghq.com').rstrip('/') + '/api/v2/series'
+        self.session = None
+        # serialized series of each test up to the timestamp, built once per test
+        self.seriesPrefixes = {}
+        self.bytesOnWire = 0
+
+    @staticmethod
+    def emissionSettings(publisherConfig, publisherName):
+        """Reads and checks the emission mode and the rollups of the publisher config
+
+        :param publisherConfig: config of the publisher
+        :type publisherConfig: dict
+        :param publisherName: name of the publisher
+        :type publisherName: string
+        :raises PublishError: if the mode or a rollup is unknown
+        :return: emission mode and list of (group, aggregate) rollups
+        :rtype: tuple
+        """
+
+        emission = publisherConfig.get('emission', 'both')
+        if emission not in EMISSION_MODES:
+            raise PublishError('Unknown emission {0} for publisher {1}, expected one of {2}'.format(
+                emission, publisherName, ', '.join(EMISSION_MODES)))
+        rollups = []
+        for rollup in publisherConfig.get('rollups', []):
+            if rollup.get('by') not in ROLLUP_GROUPS or rollup.get('aggregate') not in ROLLUP_AGGREGATES:
+                raise PublishError('Unknown rollup {0} for publisher {1}, by is one of {2} and aggregate one of {3}'.format(
+                    dict(rollup), publisherName, ', '.join(ROLLUP_GROUPS), ', '.join(ROLLUP_AGGREGATES)))
+            rollups.append((rollup['by'], rollup['aggregate']))
+        return emission, rollups
 
     ##############################################
     ########## Metrics reporting #################
     ##############################################
+    def emissionOf(self, test):
+        """Returns the emission mode of a test, set in its publisher details or defaulting to the publisher one
+
+        :param test: test
+        :type test: test
+        :return: 'both', 'detailed' or 'summary'
+        :rtype: string
+        """
+
+        emission = self.extractPublisherDetails(test).get('emission', self.emission)
+        if emission not in EMISSION_MODES:
+            self.logger.warning('Unknown emission {0} for test {1}, using {2}'.format(emission, test.name, self.emission))
+            return self.emission
+        return emission
+
+    def buildMessages(self, test):
+        """Builds the messages of a test according to its emission mode
+
+        :param test: test for which to build messages
+        :type test: test
+        :return: list of messages for datadog api
+        :rtype: list of dicts
+        """
+
+        emission = self.emissionOf(test)
+        msgs = []
+        if emission != 'summary':
+            msgs.append(self.buildMessageForDetailedGraphs(test))
+        if emission != 'detailed':
+            msgs.append(self.buildMessageForSummaryGraphs(test))
+        return msgs
+
+    def buildRollupMessages(self, tests):
+        """Aggregates the results of the tests per team or dashboard for each configured rollup, the aggregates of
+        each batch are tagged with the batch id so the boards combine the batches of a run
+
+        :param tests: list of tests with results
+        :type tests: list of tests
+        :return: list of messages for datadog api
+        :rtype: list of dicts
+        """
+
+        msgs = []
+        batchId = str(getattr(self.logger, 'extra', {}).get('batchId'))
+        for by, aggregate in self.rollups:
+            groups = OrderedDict()
+            for test in tests:
+                if by == 'team':
+                    group = test.team
+                else:
+                    group = self.extractPublisherDetails(test)['dashboardName'].replace(' ', '_')
+                groups.setdefault(group, []).append(test.result)
+            for group, results in groups.items():
+                # postgres numerics come as decimals, which cannot be compared or added to floats
+                values = [float(result) for result in results if result is not None]
+                if aggregate == 'count':
+                    value = len(results)
+                elif len(values) == 0:
+                    continue
+                elif aggregate == 'sum':
+                    value = sum(values)
+                elif aggregate == 'min':
+                    value = min(values)
+                else:
+                    value = max(values)
+                msgs.append({'metric': 'DataPolice.rollup.' + aggregate, 'points': value,
+                             'tags': {by: group, 'batch': batchId}})
+        return msgs
+
     def buildMessageForDetailedGraphs(self, test):
         """Builds dict for datadog api, use test name in metric name
 
@@ -191,27 +528,159 @@ class DatadogPublisher(Publisher):
 
         t1 = time.time()
         msgBuffer = []
-        for i in range(len(tests)):
-            msg1 = self.buildMessageForDetailedGraphs(tests[i])
-            msg2 = self.buildMessageForSummaryGraphs(tests[i])
-            msgBuffer.append(msg1)
-            msgBuffer.append(msg2)
-        resp = self.sendBatch(msgBuffer)
+        with self.perf.timeStage('message_build'):
+            if self.compressPayloads:
+                series = [serialized for test in tests for serialized in self.serializeTest(test, t1)]
+            else:
+                for test in tests:
+                    msgBuffer += self.buildMessages(test)
+            extraMessages = self.buildRollupMessages(tests)
+        with self.perf.timeStage('publish_send'):
+            if self.spool is not None:
+                replayed = self.spool.replay(self.sendBatch)
+                if replayed > 0:
+                    self.logger.info('Replayed {} spooled batches'.format(replayed))
+                extraMessages.append({'metric': 'BigEye.spool.depth', 'points': self.spool.depth(),
+                                      'tags': {'publisher': self.name}})
+            try:
+                if self.compressPayloads:
+                    resp = self.sendSeries(series + [self.serializeMessage(msg, t1) for msg in extraMessages])
+                else:
+                    msgBuffer += extraMessages
+                    resp = self.sendBatch(msgBuffer)
+            except DatadogException as err:
+                resp = {'errors': [str(err)]}
         if 'errors' in resp:
             self.logger.error(resp['errors'])
+            if self.spool is not None and resp.get('retryable', True):
+                if self.compressPayloads:
+                    # the messages are only built as dicts in the rare case they have to be spooled
+                    msgBuffer = [msg for test in tests for msg in self.buildMessages(test)] + extraMessages
+                self.spool.spool(msgBuffer, t1)
+                self.logger.warning('Spooled {0} messages to {1}'.format(len(msgBuffer), self.spool.path))
         t2 = time.time()
         self.logger.info('sent {0} metric points for  to datadog in {1:.2f} seconds'.format(
             len(tests), t2-t1))
 
+    def publishMetrics(self, metrics):
+        """Publishes self monitoring metrics to datadog api
+
+        :param metrics: list of message dicts with metric, points and tags
+        :type metrics: list
+        :raises PublishError: if datadog api returns errors
+        """
+
+        resp = self.sendBatch(metrics)
+        if 'errors' in resp:
+            raise PublishError(str(resp['errors']))
+
     def sendBatch(self, msgBuffer):
         """Send a batch of messages to datadog metric api
 
         :param msgBuffer: list of message dictionnaries
         :type msgBuffer: list
-        :return: dict response from datadog metric api
+        :return: dict response from datadog metric api, with retryable set to false if the batch was rejected
         :rtype: dict
         """
-        return api.Metric.send(msgBuffer)
+        if self.compressPayloads:
+            return self.sendSeries([self.serializeMessage(msg, time.time()) for msg in msgBuffer])
+        resp = api.Metric.send(msgBuffer)
+        if 'errors' in resp:
+            # the client returns connection errors and 5xx as a message, and the errors list of the 4xx responses
+            resp['retryable'] = not isinstance(resp['errors'], list)
+        return resp
+
+    @staticmethod
+    def renderTags(tags):
+        """Serializes tags as a json array of 'key:value' strings
+
+        :param tags: tags
+        :type tags: dict
+        :return: json array
+        :rtype: string
+        """
+
+        return dumps(['{0}:{1}'.format(key, value) for key, value in tags.items()], separators=(',', ':'))
+
+    @staticmethod
+    def renderPoint(timestamp, value):
+        return '{0},"value":{1}}}]}}'.format(int(timestamp), dumps(float(value)))
+
+    def serializeTest(self, test, timestamp):
+        """Serializes the detailed and summary series of a test, the metric names and tags of the test are rendered
+        once and reused by the following batches
+
+        :param test: test with its result
+        :type test: test
+        :param timestamp: timestamp of the points
+        :type timestamp: float
+        :return: json objects of the series api, one per series of the emission mode of the test
+        :rtype: list of strings
+        """
+
+        details = self.extractPublisherDetails(test)
+        key = (test.name, details['dashboardName'], details.get('emission'), tuple(test.tags.items()))
+        prefixes = self.seriesPrefixes.get(key)
+        if prefixes is None:
+            # gauges are type 3 in the series api
+            prefixes = [('{{"metric":{0},"type":3,"tags":{1},"points":[{{"timestamp":'.format(
+                dumps(msg['metric']), self.renderTags(msg['tags']))) for msg in self.buildMessages(test)]
+            self.seriesPrefixes[key] = prefixes
+        point = self.renderPoint(timestamp, test.result)
+        return [prefix + point for prefix in prefixes]
+
+    def serializeMessage(self, msg, timestamp):
+        """Serializes a message dict, its points can be a value or a list of (timestamp, value)
+
+        :param msg: message dict with metric, points and tags
+        :type msg: dict
+        :param timestamp: timestamp of a point given as a value
+        :type timestamp: float
+        :return: json object of the series api
+        :rtype: string
+        """
+
+        points = msg['points'] if isinstance(msg['points'], (list, tuple)) else [(timestamp, msg['points'])]
+        return dumps({'metric': msg['metric'], 'type': 3, 'tags': ['{0}:{1}'.format(key, value) for key, value in msg['tags'].items()],
+                      'points': [{'timestamp': int(pointTimestamp), 'value': float(value)} for pointTimestamp, value in points]},
+                     separators=(',', ':'))
+
+    def sendSeries(self, series):
+        """Sends serialized series to the series api in gzip compressed requests of at most batchSize series
+
+        :param series: json objects of the series api
+        :type series: list of strings
+        :return: dict response, with errors and retryable keys if a request failed, retryable is false if all the
+            failed requests were rejected by the api
+        :rtype: dict
+        """
+
+        if self.session is None:
+            self.session = requests.Session()
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip',
+                   'DD-API-KEY': str(self.config['apiKey'])}
+        rawBytes, wireBytes, errors, retryable = 0, 0, [], False
+        for start in range(0, len(series), self.batchSize):
+            body = ('{"series":[' + ','.join(series[start:start + self.batchSize]) + ']}').encode('utf-8')
+            compressed = gzip.compress(body, 6)
+            rawBytes += len(body)
+            wireBytes += len(compressed)
+            try:
+                resp = self.session.post(self.seriesUrl, data=compressed, headers=headers, timeout=30)
+            except requests.RequestException as err:
+                errors.append(str(err))
+                retryable = True
+                continue
+            if resp.status_code >= 300:
+                errors.append('series api returned {0}: {1}'.format(resp.status_code, resp.text[:200]))
+                # other 4xx are rejected payloads that would be rejected again
+                retryable = retryable or resp.status_code >= 500 or resp.status_code in (408, 429)
+        self.bytesOnWire += wireBytes
+        self.logger.info('Sent {0} series in {1} bytes on the wire, {2} bytes uncompressed'.format(
+            len(series), wireBytes, rawBytes))
+        if len(errors) > 0:
+            return {'errors': errors, 'retryable': retryable}
+        return {'status': 'ok'}
 
     def updateMetricsMetadata(self, tests):
         """update the metrics description from the tests description, pretty slow so not part of main process
@@ -220,13 +689,13 @@ class DatadogPublisher(Publisher):
         :type tests: list of tests
         """
         t1 = time.time()
-        testsAlreadyUpdated = []
+        testsAlreadyUpdated = set()
         for test in tests:
             if test.name not in testsAlreadyUpdated and test.description != '':
                 metricName = "DataPolice." + test.team + "." + test.name
                 params = {'description': test.description}
                 print(api.Metadata.update(metric_name=metricName, **params))
-                testsAlreadyUpdated.append(test.name)
+                testsAlreadyUpdated.add(test.name)
         t2 = time.time()
         print('updated {0} descriptions in datadog in {1:.2f} seconds'.format(
             len(testsAlreadyUpdated), t2-t1))
@@ -242,23 +711,16 @@ class DatadogPublisher(Publisher):
         :type tests: list of tests
         """
 
-        # Need to group test by board type and board name
-        timeboardsNames = set([pub['details']['dashboardName']
-                               for test in tests for pub in test.publishers
-                               if pub['name'] == self.name and pub['details']['typeOfDashboard'].lower() == 'timeboard'])
-        screenboardNames = set([pub['details']['dashboardName']
-                                for test in tests for pub in test.publishers
-                                if pub['name'] == self.name and pub['details']['typeOfDashboard'].lower() == 'screenboard'])
-        namesPerType = {'timeboard': timeboardsNames,
-                        'screenboard': screenboardNames}
+        # Need to group test by board type and board name, in a single pass over the tests
+        testsPerBoard = {'timeboard': OrderedDict(), 'screenboard': OrderedDict()}
+        for test in tests:
+            details = self.extractPublisherDetails(test)
+            boards = testsPerBoard.get(details['typeOfDashboard'].lower())
+            if boards is not None:
+                boards.setdefault(details['dashboardName'], []).append(test)
 
         for boardType in ('screenboard', 'timeboard'):
-            for boardName in namesPerType[boardType]:
-                testsPerDashboard = []
-                for test in tests:
-                    details = self.extractPublisherDetails(test)
-                    if details['typeOfDashboard'].lower() == boardType and details['dashboardName'] == boardName:
-                        testsPerDashboard.append(test)
+            for boardName, testsPerDashboard in testsPerBoard[boardType].items():
                 self.logger.info('Updating {0} {1} with {2} tests'.format(
                     boardType, boardName, len(testsPerDashboard)))
                 if boardType == 'timeboard':
@@ -270,31 +732,106 @@ class DatadogPublisher(Publisher):
     ########## Timeboard utilities ###############
     ##############################################
 
-    def generateDetailedGraph(self, test, TBName):
-        """generates dict of graph for datadog api for timeboards
+    def detailedQuery(self, test, boardName):
+        """Returns the query of the graph of a test, on its detailed series or, if the test only emits the summary
+        series, on the summary series filtered on its name
 
-        :param test: test to create timeline for
+        :param test: test to graph
         :type test: test
-        :param TBName: name of timeboard
-        :type TBName: string
+        :param boardName: name of the board
+        :type boardName: string
+        :return: datadog query
+        :rtype: string
+        """
+
+        if self.emissionOf(test) == 'summary':
+            return "avg:DataPolice." + boardName.replace(' ', '_') + "{test_name:" + test.name + "} by {desco}"
+        return "avg:DataPolice." + boardName.replace(' ', '_') + "." + test.name + "{*} by {desco}"
+
+    def hasSummaryGraphs(self, tests):
+        """Returns whether the top offenders and change graphs can be built, ie a test emits the summary series
+
+        :param tests: tests of the board
+        :type tests: list of tests
+        :return: true if a test emits the summary series
+        :rtype: bool
+        """
+
+        return any(self.emissionOf(test) != 'detailed' for test in tests)
+
+    def rollupQueries(self, boardName):
+        """Returns the title and query of a graph per rollup, the batches of a run are combined by the space aggregation
+
+        :param boardName: name of the board
+        :type boardName: string
+        :return: list of (title, query)
+        :rtype: list of tuples
+        """
+
+        queries = []
+        for by, aggregate in self.rollups:
+            spaceAggregation = aggregate if aggregate in ('min', 'max') else 'sum'
+            if by == 'dashboard':
+                scope = "{dashboard:" + boardName.replace(' ', '_') + "}"
+            else:
+                scope = "{*} by {team}"
+            queries.append(('{0} per {1}'.format(aggregate, by),
+                            spaceAggregation + ":DataPolice.rollup." + aggregate + scope))
+        return queries
+
+    @staticmethod
+    def uniqueTests(tests):
+        """Returns the first test of each name, in order, a board has one graph per test name
+
+        :param tests: list of tests
+        :type tests: list
+        :return: list of tests with distinct names
+        :rtype: list
+        """
+
+        testsByName = OrderedDict()
+        for test in tests:
+            testsByName.setdefault(test.name, test)
+        return list(testsByName.values())
+
+    def generateQueryGraph(self, title, query):
+        """generates dict of a timeseries graph of a query for timeboards
+
+        :param title: title of the graph
+        :type title: string
+        :param query: datadog query
+        :type query: string
         :return: dict of graph for datadog api
         :rtype: dict
         """
 
         graph = {
-            "title": test.name,
+            "title": title,
 
             "definition": {
                 "viz": "timeseries",
                 "requests": [
                     {
-                        "q": "avg:DataPolice." + TBName.replace(' ', '_') + "." + test.name + "{*} by {desco}"
+                        "q": query
                     }
                 ],
             }
         }
         return graph
 
+    def generateDetailedGraph(self, test, TBName):
+        """generates dict of graph for datadog api for timeboards
+
+        :param test: test to create timeline for
+        :type test: test
+        :param TBName: name of timeboard
+        :type TBName: string
+        :return: dict of graph for datadog api
+        :rtype: dict
+        """
+
+        return self.generateQueryGraph(test.name, self.detailedQuery(test, TBName))
+
     def generateTopList(self, TBName):
         """Returns a dictionary of a summary graph listing top offenders by descending order
 
@@ -358,13 +895,13 @@ class DatadogPublisher(Publisher):
         :rtype: list of dicts
         """
 
-        graphs = [self.generateTopList(TBName), self.generateTopChange(TBName)]
-        testsAlreadyLoaded = []
-        for test in tests:
-            if test.name not in testsAlreadyLoaded:
-                graph = self.generateDetailedGraph(test, TBName)
-                graphs.append(graph)
-                testsAlreadyLoaded.append(test.name)
+        graphs = []
+        if self.hasSummaryGraphs(tests):
+            graphs += [self.generateTopList(TBName), self.generateTopChange(TBName)]
+        for title, query in self.rollupQueries(TBName):
+            graphs.append(self.generateQueryGraph(title, query))
+        for test in self.uniqueTests(tests):
+            graphs.append(self.generateDetailedGraph(test, TBName))
         return graphs
 
     def createTimeBoard(self, TBName, tests):
@@ -474,11 +1011,13 @@ class DatadogPublisher(Publisher):
         } for i in range(23)]
         return imgs
 
-    def generateTopWidget(self, SBName):
+    def generateTopWidget(self, SBName, y=1):
         """Returns a dictionary of a summary widget listing top offenders by descending order
 
         :param SBName: name of screenboard
         :type SBName: string
+        :param y: vertical coordinate of the widget, defaults to 1
+        :param y: int, optional
         :return: dict of top widget
         :rtype: dict
         """
@@ -493,7 +1032,7 @@ class DatadogPublisher(Publisher):
             "height": 20,
             "width": 50,
 
-            "y": 1,
+            "y": y,
             "x": 1,
 
             "time": {
@@ -515,11 +1054,13 @@ class DatadogPublisher(Publisher):
         }
         return widget
 
-    def generateChangeWidget(self, SBName):
+    def generateChangeWidget(self, SBName, y=1):
         """returns a dict for top change widget
 
         :param SBName: name of screenboard
         :type SBName: string
+        :param y: vertical coordinate of the widget, defaults to 1
+        :param y: int, optional
         :return: dict of top change widget
         :rtype: dict
         """
@@ -534,7 +1075,7 @@ class DatadogPublisher(Publisher):
             "height": 20,
             "width": 52,
 
-            "y": 1,
+            "y": y,
             "x": 55,
 
             "time": {
@@ -577,13 +1118,30 @@ class DatadogPublisher(Publisher):
         :rtype: dict
         """
 
+        return self.generateQueryTimeseriesForSB(test.name, self.detailedQuery(test, SBName), x, y)
+
+    def generateQueryTimeseriesForSB(self, title, query, x, y):
+        """Generates a timeseries line graph of a query
+
+        :param title: title of the widget
+        :type title: string
+        :param query: datadog query
+        :type query: string
+        :param x: horizontal coordinate to place timeseries graph
+        :type x: int
+        :param y: vertical coordinate to place timeseries graph
+        :type y: int
+        :return: timeseries dict for datadog api
+        :rtype: dict
+        """
+
         timeSeries = {
             "type": "timeseries",
 
             "title": True,
             "title_size": 16,
             "title_align": "left",
-            "title_text": test.name,
+            "title_text": title,
 
             "height": 13,
             "width": 35,
@@ -595,7 +1153,7 @@ class DatadogPublisher(Publisher):
                 "viz": "timeseries",
                 "requests": [
                     {
-                        "q": "avg:DataPolice." + SBName.replace(' ', '_') + "." + test.name + "{*} by {desco}"
+                        "q": query
                     }
                 ],
                 "events": [
@@ -605,32 +1163,112 @@ class DatadogPublisher(Publisher):
         }
         return timeSeries
 
-    def generateWidgetsForSB(self, tests, SBName):
+    def generateWidgetsForSB(self, tests, SBName, shardIndex=0, shardCount=1):
         """Generates widget for screenboard
 
         :param tests: list of tests
         :type tests: list
         :param SBName: name of screenboard
         :type SBName: string
+        :param shardIndex: index of the board when the tests are sharded over several boards, defaults to 0
+        :param shardIndex: int, optional
+        :param shardCount: number of boards the tests are sharded over, defaults to 1
+        :param shardCount: int, optional
         :return: list of widgets
         :rtype: list
         """
         # Removed images for faster load of page
         widgets = []
-        widgets.append(self.generateTopWidget(SBName))
-        widgets.append(self.generateChangeWidget(SBName))
-        yStart, graphsPerRow, i = 28, 3, 0
-        testsWithWidget = []
-        for test in tests:
-            if test.name not in testsWithWidget:
-                x = 1 + 37*(i % graphsPerRow)
-                y = yStart + 17*(i//graphsPerRow)
-                ts = self.generateTimeseriesForSB(test, SBName, x, y)
-                widgets.append(ts)
-                testsWithWidget.append(test.name)
+        yStart, graphsPerRow, i = 1, 3, 0
+        if shardCount > 1:
+            widgets.append(self.generateShardLinksWidget(SBName, shardIndex, shardCount))
+            yStart = 8
+        # the summary widgets cover the whole dashboard, they are only on its first board
+        if shardIndex == 0:
+            if self.hasSummaryGraphs(tests):
+                widgets.append(self.generateTopWidget(SBName, yStart))
+                widgets.append(self.generateChangeWidget(SBName, yStart))
+                yStart += 27
+            for title, query in self.rollupQueries(SBName):
+                widgets.append(self.generateQueryTimeseriesForSB(
+                    title, query, 1 + 37*(i % graphsPerRow), yStart + 17*(i//graphsPerRow)))
                 i += 1
+        for test in self.uniqueTests(tests):
+            x = 1 + 37*(i % graphsPerRow)
+            y = yStart + 17*(i//graphsPerRow)
+            widgets.append(self.generateTimeseriesForSB(test, SBName, x, y))
+            i += 1
         return widgets
 
+    @staticmethod
+    def shardTitle(SBName, shardIndex):
+        """Returns the title of a board of a sharded screenboard, the first one keeps the name of the dashboard
+
+        :param SBName: name of screenboard
+        :type SBName: string
+        :param shardIndex: index of the board
+        :type shardIndex: int
+        :return: title of the board
+        :rtype: string
+        """
+
+        return SBName if shardIndex == 0 else '{0} ({1})'.format(SBName, shardIndex + 1)
+
+    def shardTests(self, tests):
+        """Splits the tests of a screenboard over boards of at most maxWidgetsPerBoard test widgets, the tests of a
+        same name stay on the same board
+
+        :param tests: list of tests
+        :type tests: list
+        :return: list of lists of tests, one per board
+        :rtype: list
+        """
+
+        maxWidgets = int(self.config.get('maxWidgetsPerBoard', 100))
+        testsByName = OrderedDict()
+        for test in tests:
+            testsByName.setdefault(test.name, []).append(test)
+        names = list(testsByName)
+        return [[test for name in names[start:start + maxWidgets] for test in testsByName[name]]
+                for start in range(0, max(len(names), 1), maxWidgets)]
+
+    def generateShardLinksWidget(self, SBName, shardIndex, shardCount):
+        """Returns a note widget linking the boards of a sharded screenboard
+
+        :param SBName: name of screenboard
+        :type SBName: string
+        :param shardIndex: index of the board the widget is on
+        :type shardIndex: int
+        :param shardCount: number of boards
+        :type shardCount: int
+        :return: note widget dict
+        :rtype: dict
+        """
+
+        links = []
+        for index in range(shardCount):
+            title = self.shardTitle(SBName, index)
+            if index == shardIndex:
+                links.append('**{}**'.format(title))
+            else:
+                # boards are found by title, their ids change when they are created again
+                links.append('[{0}](/dashboard/lists?q={1})'.format(title, quote(title)))
+        widget = {
+            "type": "note",
+            "html": 'Part {0} of {1}: '.format(shardIndex + 1, shardCount) + ' | '.join(links),
+            "text_align": "left",
+            "font_size": "14",
+            "bgcolor": "white",
+            "tick": False,
+
+            "height": 5,
+            "width": 107,
+
+            "y": 1,
+            "x": 1
+        }
+        return widget
+
     def generateTemplateVariablesForSB(self):
         """generates templates varibales for screenboard
 
@@ -645,16 +1283,19 @@ class DatadogPublisher(Publisher):
         }]
         return template_variables
 
-    def createScreenboard(self, SBName, tests):
+    def createScreenboard(self, SBName, tests, widgets=None):
         """creates a screenboard with given name and tests
 
         :param SBName: name of screenboard to create
         :type SBName: string
         :param tests: list of tests to include in screenboard
         :type tests: list
+        :param widgets: widgets of the board, generated from the tests if None, defaults to None
+        :param widgets: list, optional
         """
 
-        widgets = self.generateWidgetsForSB(tests, SBName)
+        if widgets is None:
+            widgets = self.generateWidgetsForSB(tests, SBName)
         tv = self.generateTemplateVariablesForSB()
         resp = api.Screenboard.create(
             board_title=SBName, description='', widgets=widgets, width=1024)
@@ -693,19 +1334,27 @@ class DatadogPublisher(Publisher):
         """
 
         if len(tests) > 0:
-            widgets = self.generateWidgetsForSB(tests, SBname)
+            # tests past maxWidgetsPerBoard go to linked boards, each with its own layout
+            shards = self.shardTests(tests)
             tv = self.generateTemplateVariablesForSB()
-            try:
-                id = self.getIdOfScreenboard(SBname)
-            except Exception as e:
-                if e.__str__() == 'Screenboard does not exist':
-                    self.createScreenboard(SBname, tests)
+            boardIds = dict((sb['title'], sb['id']) for sb in self.getAllScreenboards()['screenboards'])
+            for shardIndex, shardTests in enumerate(shards):
+                title = self.shardTitle(SBname, shardIndex)
+                widgets = self.generateWidgetsForSB(shardTests, SBname, shardIndex, len(shards))
+                if title not in boardIds:
+                    self.createScreenboard(title, shardTests, widgets)
                     self.logger.info(
-                        'Created screenboard {0}'.format(SBname))
-            else:
-                self.apiUpdateSB(id, SBname, widgets, tv)
-                self.logger.info(
-                    'Updated screenboard {0}'.format(SBname))
+                        'Created screenboard {0}'.format(title))
+                else:
+                    self.apiUpdateSB(boardIds[title], title, widgets, tv)
+                    self.logger.info(
+                        'Updated screenboard {0}'.format(title))
+            # boards left over from a dashboard that had more tests
+            shardIndex = len(shards)
+            while self.shardTitle(SBname, shardIndex) in boardIds:
+                api.Screenboard.delete(boardIds[self.shardTitle(SBname, shardIndex)])
+                self.logger.info('Deleted screenboard {0}'.format(self.shardTitle(SBname, shardIndex)))
+                shardIndex += 1
 
     def getAllScreenboards(self):
         """To get the ids of the board in order to be able to update them, as name is not enough
@@ -739,4 +1388,594 @@ class DatadogPublisher(Publisher):
 
         """
 
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+
+class DogStatsDPublisher(DatadogPublisher):
+    """Publisher sending the results as gauges to a local DogStatsD agent over UDP, with the same metric names and
+    tags as the datadog publisher so the boards work with both
+
+    Several metrics are packed in each datagram up to maxPacketSize bytes, 1432 by default to fit an ethernet MTU,
+    8192 is safe when the agent runs on the same host. The socket is non blocking: a datagram the kernel cannot
+    buffer is dropped and counted instead of slowing the run down.
+
+        :param statsdConfig: dict with optional host (defaults to 127.0.0.1), port (defaults to 8125) and
+            maxPacketSize, and apiKey and appKey if the boards are updated by this publisher
+        :type statsdConfig: dict
+        :param logger: logger instance
+        :type logger: logger
+        :param publisherName: name to give this instance
+        :type publisherName: string
+        :param perf: recorder of the stages durations, defaults to None
+        :param perf: PerfRecorder, optional
+        """
+
+    secretKeys = ()
+
+    def __init__(self, statsdConfig, logger, publisherName, perf=None):
+        self.config = statsdConfig
+        self.logger = logger
+        self.perf = perf or PerfRecorder(logger)
+        self.publisherType = 'DogStatsD'
+        self.name = publisherName
+        # gauges without timestamps cannot be replayed later
+        self.spool = None
+        self.compressPayloads = False
+        self.emission, self.rollups = self.emissionSettings(statsdConfig, publisherName)
+        self.maxPacketSize = int(statsdConfig.get('maxPacketSize', 1432))
+        # resolved once so sending does not go through dns
+        family, _, _, _, self.address = socket.getaddrinfo(
+            statsdConfig.get('host', '127.0.0.1'), int(statsdConfig.get('port', 8125)),
+            0, socket.SOCK_DGRAM)[0]
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.datagramsSent = 0
+        self.datagramsDropped = 0
+
+    @staticmethod
+    def sanitize(value):
+        """Replaces the characters reserved by the statsd protocol
+
+        :param value: metric name, tag key or tag value
+        :type value: string
+        :return: value safe to put in a datagram
+        :rtype: string
+        """
+
+        return str(value).replace('|', '_').replace(',', '_').replace('#', '_').replace('\n', '_')
+
+    def formatMessage(self, msg):
+        """Formats a message dict built for the datadog api as a DogStatsD gauge line
+
+        :param msg: dict with metric, points and tags
+        :type msg: dict
+        :return: gauge line, for example 'metric:1|g|#key:value'
+        :rtype: bytes
+        """
+
+        line = '{0}:{1}|g'.format(self.sanitize(msg['metric']).replace(':', '_'), msg['points'])
+        if len(msg['tags']) > 0:
+            line += '|#' + ','.join(self.sanitize(key) + ':' + self.sanitize(value)
+                                    for key, value in msg['tags'].items())
+        return line.encode('utf-8')
+
+    def packDatagrams(self, msgBuffer):
+        """Packs the gauge lines of the messages in as few datagrams as possible
+
+        :param msgBuffer: list of message dictionnaries
+        :type msgBuffer: list
+        :return: list of datagrams
+        :rtype: list of bytes
+        """
+
+        datagrams, lines, size = [], [], 0
+        for msg in msgBuffer:
+            line = self.formatMessage(msg)
+            # lines are separated by a newline
+            if len(lines) > 0 and size + 1 + len(line) > self.maxPacketSize:
+                datagrams.append(b'\n'.join(lines))
+                lines, size = [], 0
+            size += len(line) + (1 if len(lines) > 0 else 0)
+            lines.append(line)
+        if len(lines) > 0:
+            datagrams.append(b'\n'.join(lines))
+        return datagrams
+
+    def sendBatch(self, msgBuffer):
+        """Sends a batch of messages to the agent, never waits on the socket
+
+        :param msgBuffer: list of message dictionnaries
+        :type msgBuffer: list
+        :return: dict with an errors key if datagrams were dropped, in the format of the datadog api responses
+        :rtype: dict
+        """
+
+        dropped = 0
+        for datagram in self.packDatagrams(msgBuffer):
+            try:
+                self.socket.sendto(datagram, self.address)
+                self.datagramsSent += 1
+            except OSError:
+                # full socket buffer, unreachable agent or datagram over the size the network accepts
+                dropped += 1
+        self.datagramsDropped += dropped
+        if dropped > 0:
+            return {'errors': ['dropped {0} datagrams to the statsd agent at {1}'.format(dropped, self.address)]}
+        return {'status': 'ok'}
+
+    def update(self, tests):
+        """Updates the boards through the datadog api if apiKey and appKey are configured
+
+        :param tests: list of tests to publish to dashboards
+        :type tests: list of tests
+        """
+
+        if 'apiKey' not in self.config or 'appKey' not in self.config:
+            self.logger.info('Publisher {} has no api keys, its boards are left to the datadog publisher'.format(self.name))
+            return
+        initialize(api_key=self.config['apiKey'], app_key=self.config['appKey'],
+                   api_host=self.config.get('apiHost'))
+        super().update(tests)
+
+    def tearDown(self):
+        """Closes the socket
+
+        """
+
+        if self.datagramsDropped > 0:
+            self.logger.warning('Publisher {0} dropped {1} of {2} datagrams'.format(
+                self.name, self.datagramsDropped, self.datagramsSent + self.datagramsDropped))
+        self.socket.close()
+
+
+class OpenMetricsPublisher(Publisher):
+    """Publisher rendering the results in the OpenMetrics text format, for prometheus
+
+    The results are written for the node exporter textfile collector next to textfilePath, one file per batch id so
+    that concurrent slaves do not overwrite each other and a batch rewrites its own file on the next run, or pushed to
+    the pushgatewayUrl. Each test is a sample of the gauge family named after its dashboard, labelled with its tags and
+    test_name, like the summary metrics of the datadog publisher. The label strings are rendered once per test and
+    reused by the following runs.
+
+        :param openMetricsConfig: dict with textfilePath or pushgatewayUrl, and optional job (defaults to bigeye),
+            namespace (defaults to DataPolice) and timeout in seconds (defaults to 10)
+        :type openMetricsConfig: dict
+        :param logger: logger instance
+        :type logger: logger
+        :param publisherName: name to give this instance
+        :type publisherName: string
+        :param perf: recorder of the stages durations, defaults to None
+        :param perf: PerfRecorder, optional
+        """
+
+    def __init__(self, openMetricsConfig, logger, publisherName, perf=None):
+        self.config = openMetricsConfig
+        self.logger = logger
+        self.perf = perf or PerfRecorder(logger)
+        self.publisherType = 'OpenMetrics'
+        self.name = publisherName
+        self.textfilePath = openMetricsConfig.get('textfilePath')
+        self.pushgatewayUrl = openMetricsConfig.get('pushgatewayUrl')
+        if (self.textfilePath is None) == (self.pushgatewayUrl is None):
+            raise PublishError('Publisher {} needs either a textfilePath or a pushgatewayUrl'.format(publisherName))
+        self.job = openMetricsConfig.get('job', 'bigeye')
+        self.namespace = openMetricsConfig.get('namespace', 'DataPolice')
+        self.timeout = float(openMetricsConfig.get('timeout', 10))
+        self.session = requests.Session() if self.pushgatewayUrl is not None else None
+        # rendered 'family{labels}' prefix of the samples by test, built once per test
+        self.seriesByTest = {}
+        # samples of the current batch, written to the textfile of the batch
+        self.samples = OrderedDict()
+
+    @staticmethod
+    def metricName(name):
+        """Turns a name into a valid OpenMetrics metric or label name
+
+        :param name: name, for example a datadog metric name
+        :type name: string
+        :return: name with the invalid characters replaced by underscores
+        :rtype: string
+        """
+
+        name = re.sub('[^a-zA-Z0-9_]', '_', str(name))
+        return '_' + name if name[:1].isdigit() else name
+
+    @staticmethod
+    def labelValue(value):
+        """Escapes a label value
+
+        :param value: value of the label
+        :type value: string
+        :return: escaped value
+        :rtype: string
+        """
+
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @classmethod
+    def renderSeries(cls, family, labels):
+        """Renders the family name and the label set of a sample
+
+        :param family: name of the metric family
+        :type family: string
+        :param labels: labels of the sample
+        :type labels: dict
+        :return: for example 'family{key="value"}'
+        :rtype: string
+        """
+
+        if len(labels) == 0:
+            return family
+        return family + '{' + ','.join('{0}="{1}"'.format(cls.metricName(key), cls.labelValue(value))
+                                       for key, value in sorted(labels.items())) + '}'
+
+    @staticmethod
+    def renderValue(value):
+        value = float(value)
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+
+    def extractPublisherDetails(self, test):
+        for p in test.publishers:
+            if p['name'] == self.name:
+                return p['details']
+        return {}
+
+    def seriesOfTest(self, test):
+        """Returns the family and rendered series of the sample of a test, from the cache after the first call
+
+        :param test: test
+        :type test: test
+        :return: family name and rendered series
+        :rtype: tuple
+        """
+
+        dashboardName = self.extractPublisherDetails(test).get('dashboardName', 'results')
+        batchLabels = self.batchLabels()
+        key = (test.name, dashboardName, tuple(sorted((k, str(v)) for k, v in test.tags.items())),
+               tuple(batchLabels.items()))
+        series = self.seriesByTest.get(key)
+        if series is None:
+            family = self.metricName(self.namespace + '_' + dashboardName)
+            labels = dict(test.tags)
+            labels['test_name'] = test.name
+            labels.update(batchLabels)
+            series = (family, self.renderSeries(family, labels))
+            self.seriesByTest[key] = series
+        return series
+
+    @classmethod
+    def render(cls, samples):
+        """Renders samples in the OpenMetrics text format
+
+        :param samples: dict of family name to dict of rendered series to value
+        :type samples: dict
+        :return: exposition text
+        :rtype: string
+        """
+
+        lines = []
+        for family, series in samples.items():
+            lines.append('# TYPE {} gauge'.format(family))
+            for labels, value in series.items():
+                lines.append(labels + ' ' + cls.renderValue(value))
+        lines.append('# EOF\n')
+        return '\n'.join(lines)
+
+    def publishResults(self, tests):
+        """Writes or pushes the results of the tests
+
+        :param tests: list of tests
+        :type tests: list of tests
+        :raises PublishError: if the textfile cannot be written or the pushgateway refuses the samples
+        """
+
+        t1 = time.time()
+        samplesByTestName = OrderedDict()
+        with self.perf.timeStage('message_build'):
+            for test in tests:
+                family, series = self.seriesOfTest(test)
+                samplesByTestName.setdefault(test.name, OrderedDict()).setdefault(family, OrderedDict())[series] = test.result
+        with self.perf.timeStage('publish_send'):
+            if self.textfilePath is not None:
+                self.samples = OrderedDict()
+                for samples in samplesByTestName.values():
+                    for family, series in samples.items():
+                        self.samples.setdefault(family, OrderedDict()).update(series)
+                self.writeTextfile(self.render(self.samples))
+            else:
+                # tests with the same name run in the same batch, so a group per test name is replaced as a whole
+                for testName, samples in samplesByTestName.items():
+                    self.push({'test_name': testName}, self.render(samples))
+        self.logger.info('{0} {1} results in OpenMetrics format in {2:.2f} seconds'.format(
+            'Wrote' if self.textfilePath is not None else 'Pushed', len(tests), time.time() - t1))
+
+    def publishMetrics(self, metrics):
+        """Writes or pushes self monitoring metrics
+
+        :param metrics: list of message dicts with metric, points and tags
+        :type metrics: list
+        :raises PublishError: if the textfile cannot be written or the pushgateway refuses the samples
+        """
+
+        samples = OrderedDict()
+        for msg in metrics:
+            family = self.metricName(msg['metric'])
+            labels = dict(msg['tags'])
+            labels.update(self.batchLabels())
+            samples.setdefault(family, OrderedDict())[self.renderSeries(family, labels)] = msg['points']
+        if self.textfilePath is not None:
+            for family, series in samples.items():
+                self.samples.setdefault(family, OrderedDict()).update(series)
+            self.writeTextfile(self.render(self.samples))
+        else:
+            self.push({'source': 'self_monitoring'}, self.render(samples))
+
+    def batchLabels(self):
+        """Returns the batch label of the samples written to a textfile, the collector rejects a scrape where two
+        files hold the same series, for example the self monitoring metrics of two batches
+
+        :return: dict with the batch label, empty when pushing or outside of a batch
+        :rtype: dict
+        """
+
+        batchId = getattr(self.logger, 'extra', {}).get('batchId')
+        if self.textfilePath is None or batchId is None:
+            return {}
+        return {'batch': str(batchId)}
+
+    @staticmethod
+    def textfileOfBatch(textfilePath, batchId):
+        """Returns the textfile of a batch, textfilePath with the batch id before its extension
+
+        :param textfilePath: textfilePath of the publisher config
+        :type textfilePath: string
+        :param batchId: id of the batch
+        :type batchId: string
+        :return: path of the textfile
+        :rtype: string
+        """
+
+        root, extension = os.path.splitext(textfilePath)
+        return '{0}-batch-{1}{2}'.format(root, re.sub('[^a-zA-Z0-9_.-]', '_', str(batchId)), extension)
+
+    @classmethod
+    def removeStaleTextfiles(cls, textfilePath, batchIds, logger):
+        """Deletes the textfiles of batches that are not part of the run any more, left over when the test list
+        changed and the batch boundaries moved
+
+        :param textfilePath: textfilePath of the publisher config
+        :type textfilePath: string
+        :param batchIds: ids of the batches of the current run
+        :type batchIds: set of strings
+        :param logger: logger instance
+        :type logger: logger
+        :return: number of files deleted
+        :rtype: int
+        """
+
+        current = set(cls.textfileOfBatch(textfilePath, batchId) for batchId in batchIds)
+        root, extension = os.path.splitext(textfilePath)
+        removed = 0
+        for path in glob(escapeGlob(root) + '-batch-*' + escapeGlob(extension)):
+            if path not in current:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError as err:
+                    logger.warning('Could not remove stale textfile {0}: {1}'.format(path, err))
+        if removed > 0:
+            logger.info('Removed {} textfiles of batches no longer in the run'.format(removed))
+        return removed
+
+    def batchTextfilePath(self):
+        """Returns the textfile of the current batch, textfilePath with the batch id before its extension, for
+        example bigeye-batch-40.prom, or textfilePath itself outside of a batch
+
+        :return: path of the textfile
+        :rtype: string
+        """
+
+        batchId = getattr(self.logger, 'extra', {}).get('batchId')
+        if batchId is None:
+            return self.textfilePath
+        return self.textfileOfBatch(self.textfilePath, batchId)
+
+    def writeTextfile(self, text):
+        """Replaces the textfile of the batch atomically so the collector never reads a partial file
+
+        :param text: exposition text
+        :type text: string
+        :raises PublishError: if the file cannot be written
+        """
+
+        path = self.batchTextfilePath()
+        folder = os.path.dirname(os.path.abspath(path))
+        try:
+            # the temporary file is in the same folder so the rename does not cross file systems
+            with tempfile.NamedTemporaryFile('w', dir=folder, prefix='.bigeye-', suffix='.tmp', delete=False) as f:
+                f.write(text)
+            os.chmod(f.name, 0o644)
+            os.replace(f.name, path)
+        except OSError as err:
+            raise PublishError('Could not write {0}: {1}'.format(path, err))
+
+    def push(self, groupingKey, text):
+        """Replaces the samples of a group in the pushgateway
+
+        :param groupingKey: labels identifying the group in addition to the job
+        :type groupingKey: dict
+        :param text: exposition text
+        :type text: string
+        :raises PublishError: if the pushgateway cannot be reached or refuses the samples
+        """
+
+        url = self.pushgatewayUrl.rstrip('/') + '/metrics/job/' + quote(self.job, safe='')
+        for key, value in sorted(groupingKey.items()):
+            url += '/{0}/{1}'.format(key, quote(str(value), safe=''))
+        try:
+            resp = self.session.put(url, data=text.encode('utf-8'), timeout=self.timeout,
+                                    headers={'Content-Type': 'application/openmetrics-text; version=1.0.0; charset=utf-8'})
+        except requests.RequestException as err:
+            raise PublishError('Could not push to {0}: {1}'.format(self.pushgatewayUrl, err))
+        if resp.status_code >= 300:
+            raise PublishError('Pushgateway returned {0}: {1}'.format(resp.status_code, resp.text[:200]))
+
+    def update(self, tests):
+        """Nothing to update, prometheus has no boards to create"""
+
         pass
+
+    def tearDown(self):
+        """Closes the pushgateway session
+
+        """
+
+        if self.session is not None:
+            self.session.close()
+
+
+class ResultFilePublisher(Publisher):
+    """Publisher appending the results of each run to local files for bulk historical analysis
+
+    The files are partitioned by day in rootPath/date=YYYY-MM-DD/ folders, readable as a hive partitioned dataset.
+    In jsonl format (default) the records of a batch are appended to the results.jsonl file of the day in a single
+    write, in parquet format (requires pyarrow) each batch is written to its own file in the folder of the day.
+
+        :param fileConfig: dict with rootPath and optional format, 'jsonl' or 'parquet'
+        :type fileConfig: dict
+        :param logger: logger instance
+        :type logger: logger
+        :param publisherName: name to give this instance
+        :type publisherName: string
+        :param perf: recorder of the stages durations, defaults to None
+        :param perf: PerfRecorder, optional
+        """
+
+    def __init__(self, fileConfig, logger, publisherName, perf=None):
+        self.config = fileConfig
+        self.logger = logger
+        self.perf = perf or PerfRecorder(logger)
+        self.publisherType = 'ResultFile'
+        self.name = publisherName
+        self.rootPath = fileConfig['rootPath']
+        self.format = fileConfig.get('format', 'jsonl')
+        if self.format not in ('jsonl', 'parquet'):
+            raise PublishError('Unknown format {0} for publisher {1}, expected jsonl or parquet'.format(
+                self.format, publisherName))
+        if self.format == 'parquet' and pyarrow is None:
+            raise PublishError('pyarrow is required to write parquet files')
+        self.filesWritten = 0
+
+    def buildRecord(self, test, publishedAt):
+        """Builds the record of a test
+
+        :param test: test with its fetchers results and durations
+        :type test: test
+        :param publishedAt: timestamp of the batch
+        :type publishedAt: float
+        :return: record with the run, the test, its tags, fetchers values and durations, and its result
+        :rtype: dict
+        """
+
+        context = getattr(self.logger, 'extra', {})
+        return {'timestamp': publishedAt, 'runId': context.get('runId'), 'batchId': context.get('batchId'),
+                'test': test.name, 'team': test.team, 'type': test.type, 'tags': dict(test.tags),
+                'fetchers': [{'name': fetcherDict['name'], 'value': fetcherDict.get('result'),
+                              'duration': fetcherDict.get('duration')} for fetcherDict in test.fetchers],
+                'result': test.result}
+
+    def partitionPath(self, publishedAt):
+        """Returns the folder of the day of the timestamp, created if needed
+
+        :param publishedAt: timestamp
+        :type publishedAt: float
+        :return: path of the folder
+        :rtype: string
+        """
+
+        path = os.path.join(self.rootPath, 'date=' + datetime.utcfromtimestamp(publishedAt).strftime('%Y-%m-%d'))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def publishResults(self, tests):
+        """Appends the results of the tests to the file of the day
+
+        :param tests: list of tests
+        :type tests: list of tests
+        :raises PublishError: if the file cannot be written
+        """
+
+        if len(tests) == 0:
+            return
+        publishedAt = time.time()
+        with self.perf.timeStage('message_build'):
+            records = [self.buildRecord(test, publishedAt) for test in tests]
+        with self.perf.timeStage('publish_send'):
+            self.writeRecords(records, publishedAt)
+
+    def publishMetrics(self, metrics):
+        """Appends self monitoring metrics, as records without a test
+
+        :param metrics: list of message dicts with metric, points and tags
+        :type metrics: list
+        :raises PublishError: if the file cannot be written
+        """
+
+        publishedAt = time.time()
+        context = getattr(self.logger, 'extra', {})
+        self.writeRecords([{'timestamp': publishedAt, 'runId': context.get('runId'), 'batchId': context.get('batchId'),
+                            'test': msg['metric'], 'team': None, 'type': 'self_monitoring', 'tags': dict(msg['tags']),
+                            'fetchers': [], 'result': msg['points']} for msg in metrics], publishedAt)
+
+    def writeRecords(self, records, publishedAt):
+        """Writes a batch of records in one go
+
+        :param records: list of records
+        :type records: list of dicts
+        :param publishedAt: timestamp of the batch, used for the partition
+        :type publishedAt: float
+        :raises PublishError: if the file cannot be written
+        """
+
+        try:
+            folder = self.partitionPath(publishedAt)
+            if self.format == 'jsonl':
+                # a single write per batch, lines of concurrent writers in append mode are not interleaved
+                with open(os.path.join(folder, 'results.jsonl'), 'a') as f:
+                    f.write(''.join(dumps(record, default=str) + '\n' for record in records))
+            else:
+                # parquet files cannot be appended to, tags are kept as json since they differ between tests
+                for record in records:
+                    record['tags'] = dumps(record['tags'], default=str)
+                    record['result'] = None if record['result'] is None else float(record['result'])
+                    for fetcher in record['fetchers']:
+                        fetcher['value'] = None if fetcher['value'] is None else float(fetcher['value'])
+                pyarrow.parquet.write_table(pyarrow.Table.from_pylist(records), os.path.join(
+                    folder, 'results-{0}-{1}.parquet'.format(int(publishedAt * 1e6), os.getpid())))
+        except (OSError, TypeError, ValueError) as err:
+            raise PublishError('Could not write results to {0}: {1}'.format(self.rootPath, err))
+        self.filesWritten += 1
+
+    def update(self, tests):
+        """Nothing to update, the files have no boards"""
+
+        pass
+
+    def tearDown(self):
+        """Nothing to close, files are closed after each batch
+
+        """
+
+        pass
+
+
+PublisherManager.publisherTypes['Datadog'] = DatadogPublisher
+PublisherManager.publisherTypes['DogStatsD'] = DogStatsDPublisher
+PublisherManager.publisherTypes['OpenMetrics'] = OpenMetricsPublisher
+PublisherManager.publisherTypes['ResultFile'] = ResultFilePublisher
@@ -1,7 +1,9 @@
 from ruamel.yaml import YAML
 from glob import glob
+from json import dump
 import os
 from time import time
+from .instrumentation import PerfRecorder
 
 
 class TestManager():
@@ -11,11 +13,16 @@ class TestManager():
         :type config: Config
         :param logger: logger instance
         :type logger: logger
+        :param perf: recorder of the stages durations, defaults to a new PerfRecorder
+        :param perf: PerfRecorder, optional
     """
 
-    def __init__(self, config, logger):
+    def __init__(self, config, logger, perf=None):
         self.config = config
         self.logger = logger
+        self.perf = perf or PerfRecorder(logger)
+        # parsed yaml files by path with their modification time, kept for the life of the instance so warm runs skip parsing
+        self.parsedFiles = {}
 
     def findTestFiles(self, relativePath, filesNames=None):
         """Explores the relative path recursively to find matching files
@@ -47,8 +54,14 @@ class TestManager():
         testDicts = []
         yaml = YAML()
         for testFile in testFilePaths:
-            with open(testFile) as f:
-                testDict = yaml.load(f)
+            modificationTime = os.path.getmtime(testFile)
+            cached = self.parsedFiles.get(testFile)
+            if cached is not None and cached[0] == modificationTime:
+                testDict = cached[1]
+            else:
+                with open(testFile) as f:
+                    testDict = yaml.load(f)
+                self.parsedFiles[testFile] = (modificationTime, testDict)
             testDicts.append(dict(testDict))
         return testDicts
 
@@ -129,8 +142,10 @@ class TestManager():
 
         start = time()
         filePaths = self.findTestFiles(relativePath, filesNames)
-        testDicts = self.loadtestDictsFromFilePaths(filePaths)
-        tests = self.buildTestsFromDicts(testDicts)
+        with self.perf.timeStage('yaml_load'):
+            testDicts = self.loadtestDictsFromFilePaths(filePaths)
+        with self.perf.timeStage('test_build'):
+            tests = self.buildTestsFromDicts(testDicts)
         if onlyActive:
             tests = [test for test in tests if test.active == True]
         duration = time() - start
@@ -145,8 +160,9 @@ class TestManager():
         :type tests: list of tests
         """
 
-        for test in tests:
-            test.computeResult()
+        with self.perf.timeStage('compute'):
+            for test in tests:
+                test.computeResult()
 
     def subsetOfTests(self, tests, startIndex, maxsize):
         """Returns a subset of given test list, ideally os size maxsize but can be shorter
@@ -173,6 +189,95 @@ class TestManager():
                 name=tests[-1].name)]
         return subset, startIndex+len(subset)
 
+    def batchStarts(self, tests, maxsize):
+        """Returns the start index of each batch as cut by subsetOfTests, ie the batch ids of a run
+
+        :param tests: list of tests
+        :type tests: list of tests
+        :param maxsize: maximum length of a batch
+        :type maxsize: int
+        :return: start indexes
+        :rtype: list of ints
+        """
+
+        starts = []
+        startIndex = 0
+        while startIndex < len(tests):
+            starts.append(startIndex)
+            startIndex = self.subsetOfTests(tests, startIndex, maxsize)[1]
+        return starts
+
+    def partitionTests(self, tests, maxsize, partitions=None, maxBatches=None):
+        """Splits the tests in contiguous partitions of whole batches, as cut by subsetOfTests, so that tests with the
+        same name never span two partitions and each partition dispatches the same batches as a single master would
+
+        :param tests: list of tests to partition
+        :type tests: list of tests
+        :param maxsize: maximum length of a batch
+        :type maxsize: int
+        :param partitions: number of partitions, defaults to None
+        :param partitions: int, optional
+        :param maxBatches: when partitions is None, maximum number of batches in a partition, defaults to None
+        :param maxBatches: int, optional
+        :return: list of (start index, end index) of the partitions, the end index being excluded
+        :rtype: list of tuples
+        """
+
+        starts = self.batchStarts(tests, maxsize)
+        if len(starts) == 0:
+            return []
+        if partitions is None:
+            partitions = -(-len(starts) // maxBatches)
+        partitions = min(partitions, len(starts))
+        boundaries = [starts[len(starts) * k // partitions] for k in range(partitions)] + [len(tests)]
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+    def saveEstimates(self, estimates, path):
+        """Writes the query cost estimates of the preflight to a json file
+
+        :param estimates: estimates as returned by FetcherManager.explainTests
+        :type estimates: list of dicts
+        :param path: path of the json file
+        :type path: string
+        """
+
+        with open(path, 'w') as f:
+            dump({'generatedAt': time(), 'estimates': estimates}, f, indent=2, sort_keys=True)
+
+    def deactivateQueries(self, relativePath, queries):
+        """Sets active to false in the yaml files for the metrics running one of the queries, comments and
+        formatting of the files are kept
+
+        :param relativePath: path to find test files
+        :type relativePath: string
+        :param queries: set of (test name, fetcher name, query) tuples
+        :type queries: set of tuples
+        :return: number of metrics deactivated
+        :rtype: int
+        """
+
+        yaml = YAML()
+        # keeps long queries on one line instead of folding them
+        yaml.width = 4096
+        deactivated = 0
+        for testFile in self.findTestFiles(relativePath):
+            with open(testFile) as f:
+                testDict = yaml.load(f)
+            changed = False
+            for metricName in testDict['metrics']:
+                metricAttr = testDict['metrics'][metricName]
+                for fetcherName in metricAttr['fetchers']:
+                    query = metricAttr['fetchers'][fetcherName].get('query')
+                    if metricAttr['active'] and (testDict['name'], fetcherName, query) in queries:
+                        metricAttr['active'] = False
+                        changed = True
+                        deactivated += 1
+            if changed:
+                with open(testFile, 'w') as f:
+                    yaml.dump(testDict, f)
+                self.logger.info('Deactivated expensive metrics in {}'.format(testFile))
+        return deactivated
+
     def testToYAMLs(self, tests, rootFolder='./testsNewBuild/'):
         """Writes a batch of tests to file in the yaml format, grouping them by team and name
 
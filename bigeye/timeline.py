@@ -0,0 +1,136 @@
+from argparse import ArgumentParser
+from collections import defaultdict
+from json import loads
+from .instrumentation import TIMING_MARKER
+
+
+class RunTimeline:
+    """Assembles the timing records logged by the master and slave lambdas into one timeline per run
+
+    :param records: timing records as logged by PerfRecorder.timingRecord
+    :type records: list of dicts
+    """
+
+    def __init__(self, records):
+        self.runs = defaultdict(list)
+        for record in records:
+            self.runs[record['runId']].append(record)
+        for runRecords in self.runs.values():
+            runRecords.sort(key=lambda record: record['start'])
+
+    @staticmethod
+    def parseLines(lines):
+        """Extracts the timing records from log lines, other lines are ignored
+
+        :param lines: iterable of log lines, for example an exported cloudwatch log file
+        :type lines: iterable of strings
+        :return: list of timing records
+        :rtype: list of dicts
+        """
+
+        records = []
+        for line in lines:
+            position = line.find(TIMING_MARKER + ' ')
+            if position >= 0:
+                records.append(loads(line[position + len(TIMING_MARKER) + 1:].strip()))
+        return records
+
+    @classmethod
+    def fromFiles(cls, paths):
+        """Builds the timelines from log files
+
+        :param paths: paths of the log files
+        :type paths: list of strings
+        :return: timelines of the runs found in the files
+        :rtype: RunTimeline
+        """
+
+        records = []
+        for path in paths:
+            with open(path) as f:
+                records += cls.parseLines(f)
+        return cls(records)
+
+    def criticalPath(self, runId):
+        """Returns the chain of spans ending with the batch that finished last, ie the straggler:
+        the master dispatches up to the invocation of the straggler, the wait before it started and its execution
+
+        :param runId: id of the run
+        :type runId: string
+        :return: list of (label, start, end) segments
+        :rtype: list of tuples
+        """
+
+        records = self.runs[runId]
+        batches = [record for record in records if record['kind'] == 'batch']
+        if len(batches) == 0:
+            return []
+        straggler = max(batches, key=lambda record: record['end'])
+        path = []
+        invokes = [record for record in records
+                   if record['kind'] == 'invoke' and record['batchId'] == straggler['batchId']]
+        if len(invokes) > 0:
+            invoke = invokes[0]
+            for dispatch in records:
+                if dispatch['kind'] == 'dispatch' and dispatch['start'] <= invoke['start'] and \
+                        self.dispatches(dispatch, straggler['batchId']):
+                    path.append(('master from index {}'.format(dispatch.get('startIndex', 0)),
+                                 dispatch['start'], min(dispatch['end'], invoke['end'])))
+            path.append(('wait for batch {}'.format(straggler['batchId']), invoke['end'], straggler['start']))
+        path.append(('batch {}'.format(straggler['batchId']), straggler['start'], straggler['end']))
+        return path
+
+    @staticmethod
+    def dispatches(dispatch, batchId):
+        """Tells whether a master dispatch record covers a batch, sub-masters of a partitioned run only cover the
+        batches of their partition, batch ids being the start index of the batch
+
+        :param dispatch: dispatch timing record
+        :type dispatch: dict
+        :param batchId: id of the batch
+        :type batchId: string
+        :return: false if the batch is outside the partition of the master
+        :rtype: bool
+        """
+
+        if dispatch.get('endIndex') is None or not str(batchId).isdigit():
+            return True
+        return dispatch.get('startIndex', 0) <= int(batchId) < dispatch['endIndex']
+
+    def report(self, runId):
+        """Formats the timeline and critical path of a run
+
+        :param runId: id of the run
+        :type runId: string
+        :return: human readable report
+        :rtype: string
+        """
+
+        records = self.runs[runId]
+        runStart = min(record['start'] for record in records)
+        runEnd = max(record['end'] for record in records)
+        lines = ['Run {0}: {1:.2f} seconds, {2} batches'.format(
+            runId, runEnd - runStart, len([r for r in records if r['kind'] == 'batch']))]
+        for record in records:
+            lines.append('  {0:>9.2f}s {1:>9.2f}s  {2:<8} batch {3}'.format(
+                record['start'] - runStart, record['end'] - record['start'], record['kind'], record['batchId']))
+        lines.append('Critical path:')
+        for label, start, end in self.criticalPath(runId):
+            lines.append('  {0:>9.2f}s {1:>9.2f}s  {2}'.format(start - runStart, end - start, label))
+        return '\n'.join(lines)
+
+
+def main():
+    parser = ArgumentParser(
+        description='Assembles BigEye timing records from log files into per run timelines and critical paths')
+    parser.add_argument('logFiles', nargs='+', help='log files containing {} lines'.format(TIMING_MARKER))
+    parser.add_argument('--run', help='only report the run with this id')
+    args = parser.parse_args()
+    timeline = RunTimeline.fromFiles(args.logFiles)
+    for runId in timeline.runs:
+        if args.run is None or args.run == runId:
+            print(timeline.report(runId))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+from json import dumps, loads
+from typing import NamedTuple
+import sqlite3
+import time
+
+
+class WorkItem(NamedTuple):
+    """Batch of tests leased by a slave, attempt is the lease token checked when the batch is acknowledged"""
+
+    id: int
+    runId: str
+    batchId: str
+    filesNames: list
+    attempt: int
+
+
+class WorkQueue:
+    """Abstract class for the queues of batches of tests pulled by the slaves in queue dispatch mode
+
+    A leased batch is invisible to the other slaves until its visibility timeout expires, it is then leased again,
+    up to maxAttempts times, so the batches of a slave that crashed are run by another one.
+
+    :param visibilityTimeout: seconds a leased batch stays invisible, defaults to 900
+    :param visibilityTimeout: float, optional
+    :param maxAttempts: number of leases after which a batch is marked as failed, defaults to 3
+    :param maxAttempts: int, optional
+    """
+
+    # queue classes by type name in the WorkQueue section of the config, filled in below the queues definitions
+    queueTypes = {}
+
+    def __init__(self, visibilityTimeout=900, maxAttempts=3):
+        self.visibilityTimeout = visibilityTimeout
+        self.maxAttempts = maxAttempts
+
+    @classmethod
+    def fromConfig(cls, queueConfig):
+        """Builds the queue described by the WorkQueue section of the config
+
+        :param queueConfig: dict with type and the options of the queue type
+        :type queueConfig: dict
+        :raises WorkQueueError: if the type is unknown
+        :return: queue
+        :rtype: WorkQueue
+        """
+
+        queueType = cls.queueTypes.get(queueConfig.get('type'))
+        if queueType is None:
+            raise WorkQueueError('Unknown work queue type {0}, expected one of {1}'.format(
+                queueConfig.get('type'), ', '.join(sorted(cls.queueTypes))))
+        return queueType(queueConfig)
+
+    def enqueue(self, runId, batches):
+        raise NotImplementedError(
+            'The queue instance does not implement the enqueue method')
+
+    def lease(self, workerId):
+        raise NotImplementedError(
+            'The queue instance does not implement the lease method')
+
+    def ack(self, item):
+        raise NotImplementedError(
+            'The queue instance does not implement the ack method')
+
+    def release(self, item, error=None):
+        raise NotImplementedError(
+            'The queue instance does not implement the release method')
+
+    def stats(self, runId):
+        raise NotImplementedError(
+            'The queue instance does not implement the stats method')
+
+    def close(self):
+        pass
+
+
+class WorkQueueError(Exception):
+    """Exception raised if the work queue is misconfigured or cannot be reached"""
+
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """Work queue stored in a sqlite database, shared by the processes that can reach the file, for local runs and
+    tests or a file system mounted by the lambdas
+
+    Leases are taken in an immediate transaction so two slaves never lease the same batch. The default rollback
+    journal only relies on file locks, the write ahead log needs memory shared between the processes and corrupts the
+    database on a network file system such as EFS, so journalMode WAL is only for a queue on a local disk.
+
+    :param queueConfig: dict with optional path (defaults to ./bigeye_queue.sqlite3), visibilityTimeout, maxAttempts,
+        retention, the seconds after which finished batches are purged (defaults to 7 days), and journalMode
+        (DELETE or WAL, defaults to DELETE)
+    :type queueConfig: dict
+    :raises WorkQueueError: if the journal mode is unknown
+    """
+
+    journalModes = ('DELETE', 'WAL')
+
+    def __init__(self, queueConfig):
+        super().__init__(float(queueConfig.get('visibilityTimeout', 900)), int(queueConfig.get('maxAttempts', 3)))
+        self.path = queueConfig.get('path', './bigeye_queue.sqlite3')
+        self.retention = float(queueConfig.get('retention', 7 * 86400))
+        self.journalMode = str(queueConfig.get('journalMode', 'DELETE')).upper()
+        if self.journalMode not in self.journalModes:
+            raise WorkQueueError('Unknown journal mode {0} for the SQLite work queue, expected one of {1}'.format(
+                self.journalMode, ', '.join(self.journalModes)))
+        # autocommit, transactions are opened explicitly
+        self.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode={}'.format(self.journalMode))
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS batches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id TEXT NOT NULL,
+            batch_id TEXT NOT NULL,
+            files_names TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            leased_by TEXT,
+            lease_until REAL,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS batches_state ON batches (state, lease_until, id)')
+
+    def enqueue(self, runId, batches):
+        """Adds the batches of a run in one transaction, and purges the batches finished before the retention
+
+        :param runId: id of the run
+        :type runId: string
+        :param batches: list of (batch id, files names)
+        :type batches: list of tuples
+        """
+
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.executemany(
+                'INSERT INTO batches (run_id, batch_id, files_names, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+                [(runId, batchId, dumps(filesNames), now, now) for batchId, filesNames in batches])
+            self.conn.execute("DELETE FROM batches WHERE state IN ('done', 'failed') AND updated_at < ?",
+                              (now - self.retention,))
+        except sqlite3.Error:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    def lease(self, workerId):
+        """Leases the oldest batch that is pending or whose lease expired, batches that expired maxAttempts times are
+        marked as failed instead
+
+        :param workerId: id of the slave, kept for debugging
+        :type workerId: string
+        :return: leased batch, None if there is nothing to run
+        :rtype: WorkItem
+        """
+
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.execute(
+                "UPDATE batches SET state = 'failed', error = 'lease expired', updated_at = ? "
+                "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?", (now, now, self.maxAttempts))
+            row = self.conn.execute(
+                "SELECT id, run_id, batch_id, files_names, attempts FROM batches "
+                "WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) ORDER BY id LIMIT 1",
+                (now,)).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    "UPDATE batches SET state = 'leased', attempts = attempts + 1, leased_by = ?, lease_until = ?, "
+                    "updated_at = ? WHERE id = ?", (workerId, now + self.visibilityTimeout, now, row[0]))
+        except sqlite3.Error:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+        if row is None:
+            return None
+        return WorkItem(row[0], row[1], row[2], loads(row[3]), row[4] + 1)
+
+    def ack(self, item):
+        """Marks a batch as done, ignored if the lease expired and the batch was leased again
+
+        :param item: leased batch
+        :type item: WorkItem
+        :return: true if the batch was marked as done
+        :rtype: bool
+        """
+
+        cursor = self.conn.execute(
+            "UPDATE batches SET state = 'done', updated_at = ? WHERE id = ? AND state = 'leased' AND attempts = ?",
+            (time.time(), item.id, item.attempt))
+        return cursor.rowcount == 1
+
+    def release(self, item, error=None):
+        """Gives a batch back to the queue to be retried right away, or marks it as failed after maxAttempts
+
+        :param item: leased batch
+        :type item: WorkItem
+        :param error: description of the error, defaults to None
+        :param error: str, optional
+        """
+
+        state = 'failed' if item.attempt >= self.maxAttempts else 'pending'
+        self.conn.execute(
+            "UPDATE batches SET state = ?, error = ?, lease_until = NULL, updated_at = ? "
+            "WHERE id = ? AND state = 'leased' AND attempts = ?",
+            (state, error, time.time(), item.id, item.attempt))
+
+    def stats(self, runId):
+        """Counts the batches of a run per state
+
+        :param runId: id of the run
+        :type runId: string
+        :return: dict of state to number of batches
+        :rtype: dict
+        """
+
+        return dict(self.conn.execute(
+            'SELECT state, count(*) FROM batches WHERE run_id = ? GROUP BY state', (runId,)).fetchall())
+
+    def close(self):
+        self.conn.close()
+
+
+WorkQueue.queueTypes['SQLite'] = SQLiteWorkQueue
@@ -11,6 +11,10 @@ setup(name='bigeye',
           'psycopg2-binary',
           'datadog',
           'ruamel.yaml',
-          'boto3'
+          'boto3',
+          'requests'
       ],
+      extras_require={
+          'files': ['pyarrow']
+      },
       zip_safe=False)
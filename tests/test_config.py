@@ -0,0 +1,114 @@
+from base64 import b64encode
+from json import dumps
+from unittest import mock
+import os
+import shutil
+import tempfile
+import unittest
+from bigeye import BigEye
+from bigeye import config
+from bigeye.config import Config
+# registers the Synthetic fetcher type
+from bigeye import benchmark
+
+
+class StubKmsClient:
+    """Stands in for the boto3 kms client, the plain text of a secret is its ciphertext prefixed with plain:"""
+
+    def __init__(self):
+        self.decrypted = []
+
+    def decrypt(self, CiphertextBlob):
+        self.decrypted.append(CiphertextBlob)
+        return {'Plaintext': b'plain:' + CiphertextBlob}
+
+
+def encrypted(value):
+    return b64encode(value.encode()).decode()
+
+
+class SecretsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rootFolder = tempfile.mkdtemp()
+        self.configPath = os.path.join(self.rootFolder, 'config.yaml')
+        self.kmsClient = StubKmsClient()
+        self.environ = mock.patch.dict(os.environ, {
+            'db_password': encrypted('db-secret'), 'unused_password': encrypted('unused-secret'),
+            'dd_apiKey': encrypted('api-key'), 'dd_appKey': encrypted('app-key')})
+        self.environ.start()
+        config._secretsCache.clear()
+
+    def tearDown(self):
+        self.environ.stop()
+        config._secretsCache.clear()
+        shutil.rmtree(self.rootFolder)
+
+    def writeConfig(self, fetcherType='PostgresDB', secretsTTL=900):
+        fetchers = {'db': {'type': fetcherType, 'host': 'localhost', 'database': 'db', 'user': 'bigeye'},
+                    'unused': {'type': 'PostgresDB', 'host': 'localhost', 'database': 'db', 'user': 'bigeye'}}
+        publishers = {'dd': {'type': 'Datadog', 'batchSize': 2000, 'spoolPath': False}}
+        runConfiguration = {'fetchers': ['db'], 'publishers': ['dd'], 'types': ['quality'], 'batchSize': 20,
+                            'maxTestDuration': 30, 'timeBetweenCalls': 0, 'iterations': 10, 'secretsTTL': secretsTTL}
+        # json is valid yaml
+        with open(self.configPath, 'w') as f:
+            f.write(dumps({'Fetchers': fetchers, 'Publishers': publishers, 'runConfiguration': runConfiguration}))
+
+    def testDecryptsOnlyTheSecretsOfTheRun(self):
+        self.writeConfig()
+        conf = Config(self.configPath, 'prod', 'slave', kmsClient=self.kmsClient)
+        self.assertEqual(conf.getValue('Fetchers', 'db', 'password'), 'plain:db-secret')
+        self.assertEqual(conf.getValue('Publishers', 'dd', 'apiKey'), 'plain:api-key')
+        self.assertEqual(conf.getValue('Publishers', 'dd', 'appKey'), 'plain:app-key')
+        self.assertNotIn('password', conf.getValue('Fetchers', 'unused'))
+        self.assertEqual(sorted(self.kmsClient.decrypted), [b'api-key', b'app-key', b'db-secret'])
+
+    def testMasterDecryptsNothing(self):
+        self.writeConfig()
+        Config(self.configPath, 'prod', 'master', kmsClient=self.kmsClient)
+        self.assertEqual(self.kmsClient.decrypted, [])
+
+    def testCachedSecretsAreReused(self):
+        self.writeConfig()
+        Config(self.configPath, 'prod', 'slave', kmsClient=self.kmsClient)
+        conf = Config(self.configPath, 'prod', 'slave', kmsClient=self.kmsClient)
+        self.assertEqual(len(self.kmsClient.decrypted), 3)
+        self.assertEqual(conf.getValue('Fetchers', 'db', 'password'), 'plain:db-secret')
+
+    def testExpiredSecretsAreDecryptedAgain(self):
+        self.writeConfig(secretsTTL=60)
+        now = config.time.time()
+        Config(self.configPath, 'prod', 'slave', kmsClient=self.kmsClient)
+        with mock.patch.object(config.time, 'time', return_value=now + 30):
+            Config(self.configPath, 'prod', 'slave', kmsClient=self.kmsClient)
+        self.assertEqual(len(self.kmsClient.decrypted), 3)
+        with mock.patch.object(config.time, 'time', return_value=now + 120):
+            Config(self.configPath, 'prod', 'slave', kmsClient=self.kmsClient)
+        self.assertEqual(len(self.kmsClient.decrypted), 6)
+
+    def testRotatedSecretIsDecryptedAgain(self):
+        self.writeConfig()
+        Config(self.configPath, 'prod', 'slave', kmsClient=self.kmsClient)
+        os.environ['db_password'] = encrypted('rotated-secret')
+        conf = Config(self.configPath, 'prod', 'slave', kmsClient=self.kmsClient)
+        self.assertEqual(self.kmsClient.decrypted[-1], b'rotated-secret')
+        self.assertEqual(conf.getValue('Fetchers', 'db', 'password'), 'plain:rotated-secret')
+
+    def testWarmRunnerRefreshesChangedSecrets(self):
+        self.writeConfig(fetcherType='Synthetic')
+        testsPath = os.path.join(self.rootFolder, 'tests', '*.yaml')
+        with mock.patch.object(config.boto3, 'client', return_value=self.kmsClient):
+            runner = BigEye('prod', 'slave', self.configPath, testsPath)
+            publisherManager = runner.publisherManager
+            runner.prepareForReuse({})
+            self.assertIs(runner.publisherManager, publisherManager)
+            os.environ['dd_apiKey'] = encrypted('rotated-api-key')
+            runner.prepareForReuse({})
+        self.assertEqual(runner.config.getValue('Publishers', 'dd', 'apiKey'), 'plain:rotated-api-key')
+        self.assertIsNot(runner.publisherManager, publisherManager)
+        self.assertEqual(self.kmsClient.decrypted.count(b'app-key'), 1)
+        runner.tearDown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from json import dumps, loads
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse
+import logging
+import threading
+import time
+import unittest
+from bigeye.fetchers import FetchError, HTTPAPI
+
+
+class LocalApi(ThreadingMixIn, HTTPServer):
+    """Local json api answering after delay seconds and recording the client port of each request"""
+
+    daemon_threads = True
+
+    def __init__(self, delay=0.):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), LocalApiHandler)
+        self.delay = delay
+        self.clientPorts = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.server_address[1])
+
+
+class LocalApiHandler(BaseHTTPRequestHandler):
+    # keeps the connections alive between requests
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.clientPorts.append(self.client_address[1])
+        time.sleep(self.server.delay)
+        path = urlparse(self.path).path
+        if path == '/error':
+            self.respond(500, {'errors': ['boom']})
+        else:
+            self.respond(200, {'data': {'count': 42, 'label': 'forty two', 'ratio': '0.5',
+                                        'items': [{'n': 1}, {'n': 2}, {'n': 3}]}})
+
+    def do_POST(self):
+        body = loads(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        self.respond(200, {'echo': body})
+
+    def respond(self, status, document):
+        body = dumps(document).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPAPITestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('tests')
+        self.fetchers = []
+
+    def tearDown(self):
+        for fetcher in self.fetchers:
+            fetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def startServer(self, delay=0.):
+        self.server = LocalApi(delay)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def fetcher(self, **apiConfig):
+        apiConfig['baseUrl'] = self.server.url
+        fetcher = HTTPAPI(apiConfig, self.logger, 'api')
+        self.fetchers.append(fetcher)
+        return fetcher
+
+    def testExtractsTheResult(self):
+        self.startServer()
+        fetcher = self.fetcher()
+        self.assertEqual(fetcher.fetchResults({'path': 'metrics', 'extract': '$.data.count'}), 42)
+        self.assertEqual(fetcher.fetchResults({'path': 'metrics', 'extract': '$.data.items[1].n'}), 2)
+        self.assertEqual(fetcher.fetchResults({'path': 'metrics', 'extract': '$.data.items.length()'}), 3)
+        self.assertEqual(fetcher.fetchResults({'path': 'metrics', 'extract': "$['data']['ratio']"}), 0.5)
+        self.assertEqual(fetcher.fetchResults({'path': 'echo', 'method': 'POST', 'json': {'value': 7},
+                                               'extract': '$.echo.value'}), 7)
+
+    def testRaisesFetchError(self):
+        self.startServer()
+        fetcher = self.fetcher()
+        for details in ({'path': 'error', 'extract': '$.errors.length()'},
+                        {'path': 'metrics', 'extract': '$.data.missing'},
+                        {'path': 'metrics', 'extract': '$.data.label'}):
+            with self.assertRaises(FetchError):
+                fetcher.fetchResults(details)
+
+    def testReusesTheConnection(self):
+        self.startServer()
+        fetcher = self.fetcher()
+        for _ in range(5):
+            fetcher.fetchResults({'path': 'metrics', 'extract': '$.data.count'})
+        self.assertEqual(len(set(self.server.clientPorts)), 1)
+
+    def testRunsRequestsConcurrently(self):
+        self.startServer(delay=0.2)
+        fetcher = self.fetcher(maxConcurrency=8)
+        start = time.time()
+        futures = [fetcher.submit({'path': 'metrics', 'extract': '$.data.count'}) for _ in range(8)]
+        results = [future.result()[0] for future in futures]
+        self.assertEqual(results, [42] * 8)
+        # serial requests would take 1.6 seconds
+        self.assertLess(time.time() - start, 1.)
+
+    def testRateLimitsTheHost(self):
+        self.startServer()
+        host = urlparse(self.server.url).netloc
+        fetcher = self.fetcher(rateLimits={host: 10})
+        start = time.time()
+        futures = [fetcher.submit({'path': 'metrics', 'extract': '$.data.count'}) for _ in range(6)]
+        for future in futures:
+            future.result()
+        # the 6th request waits for the 5 slots before it at 10 requests per second
+        self.assertGreaterEqual(time.time() - start, 0.45)
+
+
+if __name__ == '__main__':
+    unittest.main()
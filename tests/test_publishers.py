@@ -0,0 +1,77 @@
+import logging
+import socket
+import unittest
+from bigeye.publishers import DogStatsDPublisher
+from bigeye.tests import QualityTest
+
+
+class DogStatsDPublisherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.settimeout(0.5)
+        self.logger = logging.getLogger('tests')
+
+    def tearDown(self):
+        self.listener.close()
+
+    def publisher(self, **statsdConfig):
+        statsdConfig['port'] = self.listener.getsockname()[1]
+        return DogStatsDPublisher(statsdConfig, self.logger, 'statsd')
+
+    def receiveDatagrams(self):
+        datagrams = []
+        try:
+            while True:
+                datagrams.append(self.listener.recv(65535))
+        except socket.timeout:
+            return datagrams
+
+    @staticmethod
+    def buildTests(number, tags=None):
+        tests = []
+        for i in range(number):
+            test = QualityTest('test_{}'.format(i), 'description', 'quality', 'team', True, [],
+                               [{'name': 'statsd', 'details': {'dashboardName': 'My Board',
+                                                               'typeOfDashboard': 'screenboard'}}],
+                               tags if tags is not None else {'desco': 'desco{}'.format(i)})
+            test.result = i * 1.5
+            tests.append(test)
+        return tests
+
+    def testSendsTheDetailedAndSummaryGauges(self):
+        publisher = self.publisher()
+        publisher.publishResults(self.buildTests(2))
+        lines = [line for datagram in self.receiveDatagrams() for line in datagram.split(b'\n')]
+        self.assertEqual(lines, [
+            b'DataPolice.My_Board.test_0:0.0|g|#desco:desco0',
+            b'DataPolice.My_Board:0.0|g|#desco:desco0,test_name:test_0',
+            b'DataPolice.My_Board.test_1:1.5|g|#desco:desco1',
+            b'DataPolice.My_Board:1.5|g|#desco:desco1,test_name:test_1'])
+        publisher.tearDown()
+
+    def testPacksGaugesUpToThePacketSize(self):
+        publisher = self.publisher(maxPacketSize=300)
+        tests = self.buildTests(50)
+        publisher.publishResults(tests)
+        datagrams = self.receiveDatagrams()
+        lines = [line for datagram in datagrams for line in datagram.split(b'\n')]
+        self.assertEqual(len(lines), 100)
+        self.assertTrue(all(len(datagram) <= 300 for datagram in datagrams))
+        # several gauges per datagram
+        self.assertLess(len(datagrams), 50)
+        self.assertEqual(publisher.datagramsSent, len(datagrams))
+        self.assertEqual(publisher.datagramsDropped, 0)
+        publisher.tearDown()
+
+    def testSanitizesReservedCharacters(self):
+        publisher = self.publisher()
+        publisher.publishResults(self.buildTests(1, tags={'de|sc,o': 'a#b'}))
+        lines = self.receiveDatagrams()[0].split(b'\n')
+        self.assertEqual(lines[0], b'DataPolice.My_Board.test_0:0.0|g|#de_sc_o:a_b')
+        publisher.tearDown()
+
+
+if __name__ == '__main__':
+    unittest.main()